@@ -3,3 +3,14 @@ from django.apps import AppConfig
 
 class AuthenticationConfig(AppConfig):
     name = 'authentication'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from rest_framework_simplejwt import state
+        from rest_framework_simplejwt.settings import api_settings
+        from .jwt_keys import get_keyring, KeyRingTokenBackend
+        keyring = get_keyring()
+        if keyring is not None:
+            # simplejwt looks the backend up in state on every use
+            state.token_backend = KeyRingTokenBackend(
+                keyring, api_settings.AUDIENCE, api_settings.ISSUER)
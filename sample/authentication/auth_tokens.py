@@ -1,5 +1,26 @@
+"""
+Activation and reset password tokens.
+
+Tokens are made in the compact format: one HMAC-SHA256 (truncated to
+MAC_SIZE bytes) over the version, user uuid, event, part, expiry and
+a nonce, encoded with base64url, about 63 characters. token_A and
+token_B share the nonce and expiry and differ by their part.
+
+The legacy format (salted_hmac plus two TimestampSigner signatures) is
+still decoded while settings.AUTH_TOKEN_ACCEPT_LEGACY is on, the links
+sent before the upgrade expire after a day anyway.
+
+Views decode a link with decode_tokens.
+"""
+import hmac
+import struct
+import hashlib
 from os import urandom
+from time import time
+from uuid import UUID
 from datetime import timedelta
+from collections import namedtuple
+from django.conf import settings
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.utils import six
 from django.utils.http import (
@@ -8,11 +29,36 @@ from django.utils.http import (
 from django.utils.encoding import DjangoUnicodeDecodeError
 from django.utils.crypto import salted_hmac
 from django.utils.encoding import force_bytes, force_text
-from django.core.signing import TimestampSigner
+from django.core.signing import (
+    TimestampSigner,
+    BadSignature,
+    SignatureExpired,
+)
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework.exceptions import ValidationError
 
 from sample.settings.settings import SECRET_SALT
-from authentication.models import User
+from authentication.models import User, UserActivationResetToken as OTToken
+from utils.identity_map import identity_map
+
+COMPACT_VERSION = 1
+NONCE_SIZE = 8
+# version, uuid, event, part, expiry, nonce
+COMPACT = struct.Struct('>B16sBBI%ds' % NONCE_SIZE)
+MAC_SIZE = 16
+COMPACT_SIZE = COMPACT.size + MAC_SIZE
+PART_A, PART_B = 1, 2
+EVENT_CODES = {OTToken.ACTIVATE: 1, OTToken.RESETPASS: 2}
+# Derived once instead of on every token like salted_hmac
+_MAC_KEY = hmac.new(force_bytes(SECRET_SALT),
+                    b'authentication.auth_tokens.compact',
+                    hashlib.sha256).digest()
+
+CompactToken = namedtuple(
+    'CompactToken', ['user_id', 'event', 'part', 'expiry', 'nonce'])
+# Result of decode_tokens, token_A is None when only token_B was given
+DecodedTokens = namedtuple(
+    'DecodedTokens', ['user', 'event', 'token_A', 'token_B'])
 
 
 class TokenGenerator(PasswordResetTokenGenerator):
@@ -40,9 +86,98 @@ class TokenGenerator(PasswordResetTokenGenerator):
 generate_token = TokenGenerator()
 
 
-def token_generator(user):
+def _mac(payload):
+    return hmac.new(_MAC_KEY, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def _make_compact(user_id, event, part, expiry, nonce):
+    payload = COMPACT.pack(COMPACT_VERSION, user_id.bytes,
+                           EVENT_CODES[event], part, expiry, nonce)
+    return urlsafe_base64_encode(payload + _mac(payload))
+
+
+def compact_token_generator(user, event):
+    """
+    Compact token pair of the event
+    :Parameters:
+        user : User
+        event : (str) OTToken.ACTIVATE or OTToken.RESETPASS
+    :Returns:
+        token_A : (str)
+        token_B : (str)
+    """
+    expiry = int(time()) + settings.AUTH_TOKEN_MAX_AGE
+    nonce = urandom(NONCE_SIZE)
+    return (_make_compact(user.uuid, event, PART_A, expiry, nonce),
+            _make_compact(user.uuid, event, PART_B, expiry, nonce))
+
+
+def compact_bytes(token):
+    """
+    :Returns:
+        bytes of a compact token, None for a legacy token
+    """
+    try:
+        raw = urlsafe_base64_decode(token)
+    except ValueError:
+        return None
+    if len(raw) != COMPACT_SIZE or raw[0] != COMPACT_VERSION:
+        return None
+    return raw
+
+
+def unpack_compact(raw, part, event=None):
+    """
+    Verify a compact token without the database
+    :Parameters:
+        raw : (bytes) from compact_bytes
+        part : (int) PART_A or PART_B
+        event : (str) expected event, any if None
+    :Returns:
+        CompactToken
+    :Raises:
+        BadSignature, SignatureExpired
+    """
+    payload, mac = raw[:COMPACT.size], raw[COMPACT.size:]
+    if not hmac.compare_digest(_mac(payload), mac):
+        raise BadSignature('Token signature does not match')
+    _, uuid, event_code, token_part, expiry, nonce = COMPACT.unpack(payload)
+    if token_part != part or (
+            event is not None and event_code != EVENT_CODES[event]):
+        raise BadSignature('Token is not for this link')
+    if expiry < time():
+        raise SignatureExpired('Token has expired')
+    event = next(name for name, code in EVENT_CODES.items()
+                 if code == event_code)
+    return CompactToken(UUID(bytes=uuid), event, token_part, expiry, nonce)
+
+
+def check_token(user, token):
+    """
+    Checks a parsed token against the user.
+    Compact tokens were verified by their MAC when decoded.
+    """
+    if isinstance(token, CompactToken):
+        return token.user_id == user.uuid
+    return generate_token.check_token(user, token)
+
+
+def token_generator(user, event):
     """
     custom token generator
+    :Parameters:
+        user : User
+        event : (str) OTToken.ACTIVATE or OTToken.RESETPASS
+    :Returns:
+        token_A : (str)
+        token_B : (str)
+    """
+    return compact_token_generator(user, event)
+
+
+def legacy_token_generator(user):
+    """
+    Token pair of the legacy format
     :Parameters:
         user : User
     :Returns:
@@ -65,14 +200,10 @@ def token_generator(user):
     return token_A, token_B
 
 
-def token_decoder(token_A, _err_code=None):
+def legacy_unsign_A(token_A, _err_code=None):
     """
-    decoder for token_A
-    :Parameters:
-        token_A : (str)
-        _err_code : (str)
     :Returns:
-        user : User object
+        user id : (str)
         token : (str)
     """
     signer = TimestampSigner(salt=SECRET_SALT)
@@ -88,18 +219,13 @@ def token_decoder(token_A, _err_code=None):
     uid = force_text(urlsafe_base64_decode(tokenHash))
     _id = uid.split(':')[0]
     token = uid.split('|')[1]
-    user = User.objects.get(uuid=_id)
-    return user, token
+    return _id, token
 
 
-def token_decoder2(token_B, _err_code=None):
+def legacy_unsign_B(token_B, _err_code=None):
     """
-    decoder for token_B
-    :Parameters:
-        token_B : (str)
-        _err_code : (str)
     :Returns:
-        user : User object
+        user id : (str)
         token : (str)
     """
     signer = TimestampSigner(salt=SECRET_SALT)
@@ -113,5 +239,66 @@ def token_decoder2(token_B, _err_code=None):
     _id = uid.split(':')[0]
     _hash = ':'.join(uid.split(':')[1:])
     token = signer.unsign(_hash, max_age=timedelta(days=1))
-    user = User.objects.get(uuid=_id)
-    return user, token
+    return _id, token
+
+
+def _parse(token, part, event, _err_code):
+    """
+    Verify one half of a link without the database
+    :Returns:
+        user id : (str)
+        token : (str) or CompactToken
+    """
+    raw = compact_bytes(token)
+    if raw is not None:
+        compact = unpack_compact(raw, part, event)
+        return str(compact.user_id), compact
+    if not settings.AUTH_TOKEN_ACCEPT_LEGACY:
+        raise ValidationError(_err_code)
+    if part == PART_A:
+        return legacy_unsign_A(token, _err_code)
+    return legacy_unsign_B(token, _err_code)
+
+
+def _same_pair(token_A, token_B):
+    if isinstance(token_A, CompactToken):
+        return (isinstance(token_B, CompactToken)
+                and token_A.nonce == token_B.nonce)
+    # Both legacy halves carry the same hash
+    return token_A == token_B
+
+
+def decode_tokens(request, event, _err_code, token_B, token_A=None):
+    """
+    Parses and checks the halves of a link. The user is loaded once
+    through the identity map of the request.
+    :Parameters:
+        request : (obj) request object
+        event : (str) OTToken.ACTIVATE or OTToken.RESETPASS
+        _err_code : (str) error of an invalid link
+        token_B : (str)
+        token_A : (str) optional, change password only posts token_B
+    :Returns:
+        DecodedTokens
+    :Raises:
+        ValidationError, BadSignature, SignatureExpired
+    """
+    user_id, confirm_token = _parse(token_B, PART_B, event, _err_code)
+    token = None
+    if token_A is not None:
+        token_user_id, token = _parse(token_A, PART_A, event, _err_code)
+        if (token_user_id != user_id
+                or not _same_pair(token, confirm_token)):
+            raise ValidationError(_err_code)
+    try:
+        user = identity_map(request).get(user_id)
+    except (User.DoesNotExist, DjangoValidationError, ValueError):
+        raise ValidationError(_err_code)
+    checked = set()
+    for half in (token, confirm_token):
+        if half is None or half in checked:
+            continue
+        if not check_token(user, half):
+            raise ValidationError(_err_code)
+        checked.add(half)
+    return DecodedTokens(user, event, token, confirm_token)
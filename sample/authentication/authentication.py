@@ -0,0 +1,64 @@
+from django.utils.translation import ugettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import (
+    AuthenticationFailed,
+    InvalidToken,
+)
+from rest_framework_simplejwt.settings import api_settings
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from .user_cache import get_cached_user
+from .tokens import ClaimsUser, VERSION_CLAIM
+from .revocation import denylist
+
+User = get_user_model()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication which resolves the user from
+    authentication.user_cache instead of querying the users table
+    on every request. Access tokens revoked by a logout are rejected.
+    """
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if denylist.is_revoked(token.get(api_settings.JTI_CLAIM)):
+            raise InvalidToken(_('Token is blacklisted'))
+        return token
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(
+                _('Token contained no recognizable user identification'))
+        try:
+            user = get_cached_user(user_id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed(
+                _('User not found'), code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed(
+                _('User is inactive'), code='user_inactive')
+        return user
+
+
+class ClaimsJWTAuthentication(CachedJWTAuthentication):
+    """
+    Tokens from ClaimsRefreshToken are answered from their claims, as
+    long as their version claim is the token_version of the user.
+    The user is resolved like CachedJWTAuthentication does, a cache
+    miss reads the stored version so it never goes back.
+    Other tokens fall back to CachedJWTAuthentication.
+    """
+
+    def get_user(self, validated_token):
+        if (not settings.JWT_USER_CLAIMS
+                or VERSION_CLAIM not in validated_token):
+            return super().get_user(validated_token)
+        user = super().get_user(validated_token)
+        if validated_token[VERSION_CLAIM] != user.token_version:
+            raise AuthenticationFailed(
+                _('Token is outdated'), code='token_outdated')
+        return ClaimsUser(validated_token)
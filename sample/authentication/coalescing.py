@@ -0,0 +1,37 @@
+"""
+Coalesces the activation and reset password emails of a user.
+The first request of a user for an event sends a link and holds the
+(user, event) key for EMAIL_COALESCE_WINDOW seconds. The requests
+within the window get the same response without new tokens or email,
+the link already sent is still valid. The key is released once a link
+of the event is used, so the next request sends a new one.
+
+The keys are in the default cache, use a shared backend to coalesce
+across the workers.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+KEY = 'link:%s:%s'
+
+
+def claim_link(user, event):
+    """
+    :Parameters:
+        user : User object
+        event : (str) OTToken event
+    :Returns:
+        bool True if a link is to be sent, False if one was sent
+        within the window
+    """
+    window = settings.EMAIL_COALESCE_WINDOW
+    if not window:
+        return True
+    return cache.add(KEY % (user.pk, event), 1, window)
+
+
+def release_link(user, event):
+    """
+    Let the next request of the user for the event send a link
+    """
+    cache.delete(KEY % (user.pk, event))
@@ -0,0 +1,173 @@
+"""
+Deletes the token rows nothing can use anymore:
+- UserActivationResetToken rows used or older than AUTH_TOKEN_MAX_AGE
+- OutstandingToken rows past their expiry, with their BlacklistedToken
+- EmailOutbox rows sent more than EMAIL_OUTBOX_KEEP_SENT seconds ago
+
+Rows are deleted in chunks of TOKEN_COMPACTION_CHUNK_SIZE selected by
+primary key order (keyset pagination), every chunk in its own short
+transaction followed by a TOKEN_COMPACTION_PAUSE sleep, so live
+requests are not blocked behind the job.
+
+Run with `manage.py compact_tokens`, or in the server process every
+TOKEN_COMPACTION_INTERVAL seconds (see start_scheduler).
+"""
+import logging
+import threading
+from time import sleep
+from datetime import timedelta
+from collections import namedtuple
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.utils import aware_utcnow
+from .models import EmailOutbox, UserActivationResetToken as OTToken
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'compaction:lock'
+
+CompactionResult = namedtuple('CompactionResult', ['table', 'rows', 'bytes'])
+
+
+def expired_querysets(now=None):
+    """
+    :Returns:
+        list of the querysets of the dead rows
+    """
+    now = now or timezone.now()
+    link_expiry = now - timedelta(seconds=settings.AUTH_TOKEN_MAX_AGE)
+    return [
+        OTToken.objects.filter(
+            Q(used=True) | Q(created_at__lt=link_expiry)),
+        # BlacklistedToken rows go with their outstanding token. The
+        # expiries are stored in UTC, naive without USE_TZ
+        OutstandingToken.objects.filter(expires_at__lt=aware_utcnow()),
+        EmailOutbox.objects.filter(
+            status=EmailOutbox.SENT,
+            sent_at__lt=now - timedelta(
+                seconds=settings.EMAIL_OUTBOX_KEEP_SENT)),
+    ]
+
+
+def avg_row_bytes(model):
+    """
+    Average size of a row with its indexes as the database reports it
+    :Returns:
+        int bytes, None if the database does not tell
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT (data_length + index_length)'
+                ' / GREATEST(table_rows, 1) FROM information_schema.tables'
+                ' WHERE table_schema = DATABASE() AND table_name = %s',
+                [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT pg_total_relation_size(oid) / GREATEST(reltuples, 1)'
+                ' FROM pg_class WHERE relname = %s', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def compact(queryset, chunk_size=None, pause=None, dry_run=False):
+    """
+    Delete the rows of queryset chunk by chunk
+    :Parameters:
+        queryset : (QuerySet) rows to delete
+        chunk_size : (int) rows per transaction
+        pause : (float) seconds to sleep between chunks
+        dry_run : (bool) only count the rows
+    :Returns:
+        list of CompactionResult, one per table rows were deleted
+        from, bytes is an estimate or None
+    """
+    chunk_size = chunk_size or settings.TOKEN_COMPACTION_CHUNK_SIZE
+    pause = settings.TOKEN_COMPACTION_PAUSE if pause is None else pause
+    model = queryset.model
+    # Cascaded rows are counted under their own model
+    counts = {model: 0}
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        if dry_run:
+            counts[model] += len(pks)
+            continue
+        with transaction.atomic():
+            deleted = model.objects.filter(pk__in=pks).delete()[1]
+        for label, count in deleted.items():
+            related = apps.get_model(label)
+            counts[related] = counts.get(related, 0) + count
+        if len(pks) < chunk_size:
+            break
+        sleep(pause)
+    results = []
+    for related, rows in counts.items():
+        row_bytes = avg_row_bytes(related)
+        results.append(CompactionResult(
+            related._meta.db_table, rows,
+            rows * row_bytes if row_bytes is not None else None))
+    return results
+
+
+def compact_all(**kwargs):
+    """
+    :Returns:
+        list of CompactionResult
+    """
+    results = []
+    for queryset in expired_querysets():
+        results.extend(compact(queryset, **kwargs))
+    return results
+
+
+def _run_scheduled():
+    # One run per interval across the workers sharing the cache
+    if not cache.add(LOCK_KEY, 1, settings.TOKEN_COMPACTION_INTERVAL):
+        return
+    try:
+        for result in compact_all():
+            logger.info('Compacted %s: %d rows, %s bytes',
+                        result.table, result.rows, result.bytes)
+    except Exception as e:
+        logger.exception('Token compaction failed: %s', e)
+    finally:
+        connection.close()
+
+
+def _loop(interval):
+    while True:
+        sleep(interval)
+        _run_scheduled()
+
+
+_scheduler = None
+
+
+def start_scheduler():
+    """
+    Compact every TOKEN_COMPACTION_INTERVAL seconds in a daemon thread
+    of this process, nothing is started if the interval is None.
+    """
+    global _scheduler
+    interval = settings.TOKEN_COMPACTION_INTERVAL
+    if interval is None or _scheduler is not None:
+        return
+    _scheduler = threading.Thread(
+        target=_loop, args=(interval,), name='token-compaction',
+        daemon=True)
+    _scheduler.start()
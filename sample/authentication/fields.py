@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class DigestField(models.BinaryField):
+    """
+    Fixed width binary column for hash digests, BINARY(n) on MySQL so
+    it can be indexed. Other databases use the BinaryField type.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        if connection.vendor == 'mysql':
+            return 'binary(%d)' % self.max_length
+        return super().db_type(connection)
@@ -0,0 +1,93 @@
+"""
+django-axes handler that keeps the failed login counters in
+utils.attempt_store instead of the AccessAttempt table.
+Attempts are counted per IP address and per email, a client is
+locked out when either reaches AXES_FAILURE_LIMIT within
+AXES_COOLOFF_TIME.
+"""
+import logging
+from axes.conf import settings
+from axes.handlers.base import AbstractAxesHandler, AxesBaseHandler
+from axes.helpers import (
+    get_client_username,
+    get_failure_limit,
+    get_client_str,
+)
+from axes.signals import user_locked_out
+from utils.attempt_store import LocalAttemptStore, SharedAttemptStore
+
+logger = logging.getLogger(__name__)
+
+
+def get_attempt_store():
+    window = int(settings.AXES_COOLOFF_TIME.total_seconds())
+    if settings.AXES_STORE == 'shared':
+        return SharedAttemptStore(
+                window, settings.AXES_STORE_PATH,
+                slots=settings.AXES_STORE_SLOTS)
+    return LocalAttemptStore(window, slots=settings.AXES_STORE_SLOTS)
+
+
+def _keys(ip_address=None, username=None):
+    keys = []
+    if ip_address:
+        keys.append('ip:' + ip_address)
+    if username:
+        keys.append('email:' + username.strip().lower())
+    return keys
+
+
+class AxesAttemptStoreHandler(AbstractAxesHandler, AxesBaseHandler):
+
+    def __init__(self):
+        self.store = get_attempt_store()
+
+    def _request_keys(self, request, credentials=None):
+        return _keys(request.axes_ip_address,
+                     get_client_username(request, credentials))
+
+    def get_failures(self, request, credentials=None):
+        keys = self._request_keys(request, credentials)
+        return max([self.store.get(key) for key in keys] or [0])
+
+    def reset_attempts(self, *, ip_address=None, username=None,
+                       ip_or_username=False):
+        keys = _keys(ip_address, username)
+        for key in keys:
+            self.store.reset(key)
+        return len(keys)
+
+    def user_login_failed(self, sender, credentials, request=None,
+                          **kwargs):
+        if request is None:
+            logger.error('AXES: user_login_failed called without request.')
+            return
+        username = get_client_username(request, credentials)
+        client_str = get_client_str(
+            username, request.axes_ip_address,
+            request.axes_user_agent, request.axes_path_info)
+        if self.is_whitelisted(request, credentials):
+            logger.info('AXES: Login failed from whitelisted client %s.',
+                        client_str)
+            return
+        failures = max([
+            self.store.incr(key)
+            for key in self._request_keys(request, credentials)] or [0])
+        limit = get_failure_limit(request, credentials)
+        logger.warning('AXES: Login failure by %s. Count = %d of %d.',
+                       client_str, failures, limit)
+        if settings.AXES_LOCK_OUT_AT_FAILURE and failures >= limit:
+            logger.warning('AXES: Locking out %s after repeated login '
+                           'failures.', client_str)
+            request.axes_locked_out = True
+            user_locked_out.send(
+                'axes', request=request, username=username,
+                ip_address=request.axes_ip_address)
+
+    def user_logged_in(self, sender, request, user, **kwargs):
+        if settings.AXES_RESET_ON_SUCCESS:
+            self.reset_attempts(ip_address=request.axes_ip_address,
+                                username=user.get_username())
+
+    def user_logged_out(self, sender, request, user, **kwargs):
+        pass
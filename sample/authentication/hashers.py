@@ -0,0 +1,51 @@
+"""
+Password hashers with their cost taken from
+settings.PASSWORD_HASHER_PROFILE instead of the class attributes.
+The profile is generated per machine by `manage.py calibrate_hashers`,
+hashes made with an older profile are upgraded on login.
+"""
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class ProfiledHasherMixin():
+    """
+    cost_param: (str) hasher attribute that sets the work factor
+    logarithmic: (bool) True if adding one doubles the work
+    """
+    cost_param = None
+    logarithmic = False
+    # Set by calibrate_hashers to time a candidate cost
+    calibrating_cost = None
+
+    def get_cost(self):
+        if self.calibrating_cost is not None:
+            return self.calibrating_cost
+        profile = getattr(settings, 'PASSWORD_HASHER_PROFILE', {})
+        default = getattr(super(), self.cost_param)
+        return profile.get(self.algorithm, {}).get(self.cost_param, default)
+
+
+class ProfiledPBKDF2PasswordHasher(ProfiledHasherMixin,
+                                   hashers.PBKDF2PasswordHasher):
+    cost_param = 'iterations'
+    iterations = property(ProfiledHasherMixin.get_cost)
+
+
+class ProfiledPBKDF2SHA1PasswordHasher(ProfiledHasherMixin,
+                                       hashers.PBKDF2SHA1PasswordHasher):
+    cost_param = 'iterations'
+    iterations = property(ProfiledHasherMixin.get_cost)
+
+
+class ProfiledArgon2PasswordHasher(ProfiledHasherMixin,
+                                   hashers.Argon2PasswordHasher):
+    cost_param = 'time_cost'
+    time_cost = property(ProfiledHasherMixin.get_cost)
+
+
+class ProfiledBCryptSHA256PasswordHasher(ProfiledHasherMixin,
+                                         hashers.BCryptSHA256PasswordHasher):
+    cost_param = 'rounds'
+    logarithmic = True
+    rounds = property(ProfiledHasherMixin.get_cost)
@@ -0,0 +1,165 @@
+"""
+Asymmetric signing keys for the JWTs.
+Private keys are PEM files in settings.JWT_KEY_DIR named <kid>.pem, kid
+being the UTC time the key was created. The newest key signs, every key
+in the directory still verifies and is published in the JWKS, so other
+services can verify access tokens without calling this app.
+
+Keys are made and pruned with `manage.py rotate_jwt_keys`.
+"""
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+import jwt
+from jwt import InvalidTokenError
+from jwt.algorithms import RSAAlgorithm, OKPAlgorithm
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenBackendError
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
+
+ASYMMETRIC_ALGORITHMS = ('RS256', 'RS384', 'RS512', 'EdDSA')
+KID_FORMAT = '%Y%m%dT%H%M%SZ'
+
+
+def generate_key(algorithm):
+    """
+    :Returns:
+        bytes private key PEM
+    """
+    if algorithm == 'EdDSA':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+
+
+def kid_time(kid):
+    return datetime.strptime(kid, KID_FORMAT)
+
+
+def _public_jwk(algorithm, private_key, kid):
+    public_key = private_key.public_key()
+    if algorithm == 'EdDSA':
+        jwk = json.loads(OKPAlgorithm.to_jwk(public_key))
+    else:
+        jwk = json.loads(RSAAlgorithm.to_jwk(public_key))
+    jwk.update({'kid': kid, 'alg': algorithm, 'use': 'sig'})
+    return jwk
+
+
+class KeyRing():
+    """
+    Keys of JWT_KEY_DIR, reloaded when the directory changes so a
+    rotation is picked up by every worker.
+    """
+
+    def __init__(self, key_dir, algorithm):
+        self.key_dir = key_dir
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.keys = {}
+        self.active_kid = None
+        self.jwks = {'keys': []}
+        self.etag = None
+
+    def kids(self):
+        if not os.path.isdir(self.key_dir):
+            return []
+        return sorted(
+            name[:-4] for name in os.listdir(self.key_dir)
+            if name.endswith('.pem'))
+
+    def _load(self):
+        keys = {}
+        jwks = []
+        for kid in self.kids():
+            with open(os.path.join(self.key_dir, kid + '.pem'), 'rb') as f:
+                key = serialization.load_pem_private_key(
+                        f.read(), password=None)
+            keys[kid] = key
+            jwks.append(_public_jwk(self.algorithm, key, kid))
+        self.keys = keys
+        self.active_kid = max(keys) if keys else None
+        self.jwks = {'keys': jwks}
+        self.etag = '"%s"' % hashlib.sha256(
+            json.dumps(self.jwks, sort_keys=True).encode()).hexdigest()[:32]
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.key_dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._load()
+                    self._mtime = mtime
+        return self
+
+
+class KeyRingTokenBackend():
+    """
+    Same interface as simplejwt's TokenBackend, signs with the active
+    key of the key ring and verifies with the key named by the kid
+    header.
+    """
+
+    def __init__(self, keyring, audience=None, issuer=None):
+        self.keyring = keyring
+        self.algorithm = keyring.algorithm
+        self.audience = audience
+        self.issuer = issuer
+
+    def encode(self, payload):
+        keyring = self.keyring.refresh()
+        if keyring.active_kid is None:
+            raise TokenBackendError(_('No JWT signing key available'))
+        jwt_payload = payload.copy()
+        if self.audience is not None:
+            jwt_payload['aud'] = self.audience
+        if self.issuer is not None:
+            jwt_payload['iss'] = self.issuer
+        token = jwt.encode(
+            jwt_payload, keyring.keys[keyring.active_kid],
+            algorithm=self.algorithm,
+            headers={'kid': keyring.active_kid})
+        if isinstance(token, bytes):
+            return token.decode('utf-8')
+        return token
+
+    def decode(self, token, verify=True):
+        keyring = self.keyring.refresh()
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            key = keyring.keys.get(kid)
+            if key is None:
+                raise TokenBackendError(_('Token is invalid or expired'))
+            return jwt.decode(
+                token, key.public_key(), algorithms=[self.algorithm],
+                audience=self.audience, issuer=self.issuer,
+                options={'verify_signature': verify,
+                         'verify_exp': verify,
+                         'verify_aud': self.audience is not None})
+        except InvalidTokenError:
+            raise TokenBackendError(_('Token is invalid or expired'))
+
+
+_keyring = None
+
+
+def get_keyring():
+    """ Key ring of the settings, None when signing with HMAC """
+    global _keyring
+    if settings.JWT_ALGORITHM not in ASYMMETRIC_ALGORITHMS:
+        return None
+    if _keyring is None:
+        _keyring = KeyRing(settings.JWT_KEY_DIR, settings.JWT_ALGORITHM)
+    return _keyring.refresh()
@@ -0,0 +1,64 @@
+"""
+Compares the legacy and compact activation/reset token formats.
+Times making a token pair and verifying it, without the database.
+
+    manage.py bench_auth_tokens --iterations 5000
+"""
+from uuid import uuid4
+from timeit import timeit
+from django.core.management.base import BaseCommand
+from authentication.models import User, UserActivationResetToken as OTToken
+from authentication.auth_tokens import (
+    PART_A,
+    PART_B,
+    generate_token,
+    compact_token_generator,
+    legacy_token_generator,
+    legacy_unsign_A,
+    legacy_unsign_B,
+    unpack_compact,
+    compact_bytes,
+)
+
+
+def verify_legacy(user, token_A, token_B):
+    _, token = legacy_unsign_A(token_A)
+    _, confirm_token = legacy_unsign_B(token_B)
+    return (generate_token.check_token(user, token)
+            and generate_token.check_token(user, confirm_token))
+
+
+def verify_compact(user, token_A, token_B):
+    token = unpack_compact(compact_bytes(token_A), PART_A, OTToken.ACTIVATE)
+    confirm_token = unpack_compact(
+                        compact_bytes(token_B), PART_B, OTToken.ACTIVATE)
+    return token.user_id == user.uuid == confirm_token.user_id
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the legacy and compact activation token formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=2000,
+            help='Token pairs made and verified per format')
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        user = User(uuid=uuid4(), email='bench@mail.com')
+        formats = [
+            ('legacy', legacy_token_generator, verify_legacy),
+            ('compact',
+             lambda user: compact_token_generator(user, OTToken.ACTIVATE),
+             verify_compact),
+        ]
+        self.stdout.write('%-8s %12s %12s %10s' % (
+            'format', 'make (us)', 'verify (us)', 'length'))
+        for name, make, verify in formats:
+            token_A, token_B = make(user)
+            assert verify(user, token_A, token_B)
+            make_us = timeit(lambda: make(user), number=n) / n * 1e6
+            verify_us = timeit(
+                lambda: verify(user, token_A, token_B), number=n) / n * 1e6
+            self.stdout.write('%-8s %12.1f %12.1f %10d' % (
+                name, make_us, verify_us, len(token_A) + len(token_B)))
@@ -0,0 +1,72 @@
+"""
+Compares sending every email over its own SMTP connection, as send_mail
+does, with the mail connection pool of utils.mail_pool. Both send to a
+local fake SMTP server, --connect-delay stands for the TLS handshake
+and login of a real one.
+
+    manage.py bench_email_delivery --emails 500 --connect-delay 0.05
+"""
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand
+from lib.fake_smtp import FakeSMTPServer
+from utils.mail_pool import MailConnectionPool
+
+SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per email SMTP connections against the pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--emails', type=int, default=200,
+            help='Emails sent per strategy')
+        parser.add_argument(
+            '--connect-delay', type=float, default=0.02,
+            help='Seconds the fake server waits before its greeting')
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Threads sending, and connections of the pool')
+        parser.add_argument(
+            '--batch-size', type=int, default=25,
+            help='Emails per send_messages call of the pool')
+
+    def handle(self, *args, **options):
+        n = options['emails']
+        workers = options['workers']
+        messages = []
+        for i in range(n):
+            email = EmailMultiAlternatives(
+                        'Activation email', 'Activate your account',
+                        'bench@mail.com', ['user%d@mail.com' % i])
+            email.attach_alternative('<p>%s</p>' % ('x' * 1000), 'text/html')
+            messages.append(email)
+        batches = [messages[i:i + options['batch_size']]
+                   for i in range(0, n, options['batch_size'])]
+
+        self.stdout.write('%-12s %10s %12s %12s' % (
+            'strategy', 'seconds', 'emails/s', 'connections'))
+        with FakeSMTPServer(connect_delay=options['connect_delay']) as server:
+            def send_one(message):
+                get_connection(SMTP_BACKEND, host=server.host,
+                               port=server.port).send_messages([message])
+
+            pool = MailConnectionPool(workers, options['batch_size'],
+                                      backend=SMTP_BACKEND,
+                                      host=server.host, port=server.port)
+            strategies = [
+                ('per email', send_one, messages),
+                ('pooled', pool.send, batches),
+            ]
+            for name, send, jobs in strategies:
+                server.connections = 0
+                start = perf_counter()
+                with ThreadPoolExecutor(workers) as executor:
+                    list(executor.map(send, jobs))
+                seconds = perf_counter() - start
+                self.stdout.write('%-12s %10.2f %12.0f %12d' % (
+                    name, seconds, n / seconds, server.connections))
+            pool.close()
+            assert len(server.messages) == 2 * n
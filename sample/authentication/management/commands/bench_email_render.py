@@ -0,0 +1,50 @@
+"""
+Compares rendering an activation email through get_current_site and
+render_to_string with the compiled templates and cached domains of
+utils.create_email. Only the rendering is timed, nothing is queued.
+
+    manage.py bench_email_render --iterations 5000
+"""
+from timeit import timeit
+from django.conf import settings
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from utils.create_email import render_email, site_domain
+from utils.messages import EMAIL
+
+
+class Command(BaseCommand):
+    help = 'Benchmark rendering the activation email'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=2000,
+            help='Emails rendered per strategy')
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        request = RequestFactory().post(
+                    '/', HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        template = EMAIL('REGISTER').TEMPLATE
+        options = {'token_A': 'A' * 43, 'token_B': 'B' * 43}
+
+        def params(domain):
+            params = {'email_id': 'bench@mail.com', 'domain': domain,
+                      'protocol': settings.PROTOCOL}
+            params.update(options)
+            return params
+
+        def before():
+            domain = get_current_site(request).domain
+            return render_to_string(template, params(domain))
+
+        def after():
+            return render_email(template, params(site_domain(request)))
+
+        assert before() == after()
+        self.stdout.write('%-8s %14s' % ('render', 'per email (us)'))
+        for name, render in [('before', before), ('after', after)]:
+            self.stdout.write('%-8s %14.1f' % (
+                name, timeit(render, number=n) / n * 1e6))
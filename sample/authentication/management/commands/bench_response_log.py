@@ -0,0 +1,83 @@
+"""
+Compares the response building of CustomResponseLog with the one it
+replaced, which serialized the log line eagerly and copied the response
+through json.dumps/json.loads. Both log to a handler writing to
+os.devnull so the serialization is counted.
+
+    manage.py bench_response_log --iterations 20000
+"""
+import os
+import logging
+import simplejson as json
+from timeit import timeit
+from datetime import datetime
+from collections import OrderedDict
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from utils.client_ip import client_ip
+from utils.res_handler import CustomResponseLog, logger
+
+
+def legacy_response(app_name, request, params):
+    logInfo = OrderedDict()
+    logInfo['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if str(request.user) != 'AnonymousUser':
+        logInfo['email'] = request.user.email
+    elif 'email' in request.data:
+        logInfo['email'] = request.data['email']
+    else:
+        logInfo['email'] = ''
+    logInfo['ip'] = client_ip(request)
+    logInfo['message'] = 'OK'
+    logInfo['success'] = True
+    logInfo['app_name'] = app_name.__class__.__name__
+    logger.info(json.dumps(logInfo))
+    del logInfo['timestamp']
+    del logInfo['email']
+    del logInfo['ip']
+    del logInfo['app_name']
+    if len(params) != 0:
+        logInfo['data'] = params
+    return json.loads(json.dumps(logInfo), object_pairs_hook=OrderedDict)
+
+
+class APIBench():
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark building the response and log of CustomResponseLog'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=10000,
+            help='Responses built per implementation')
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        request = Request(APIRequestFactory().post(
+                    '/', {'email': 'bench@mail.com'}, format='json'),
+                    parsers=[JSONParser()])
+        params = OrderedDict([('email', 'bench@mail.com'), ('role', 'user'),
+                              ('last_login', str(datetime.now()))])
+        view = APIBench()
+        with open(os.devnull, 'w') as devnull:
+            handler = logging.StreamHandler(devnull)
+            handlers, propagate = logger.handlers, logger.propagate
+            logger.handlers, logger.propagate = [handler], False
+            try:
+                assert (legacy_response(view, request, params)
+                        == CustomResponseLog(view, request,
+                                             params).custom_response())
+                self.stdout.write('%-8s %14s' % ('builder', 'per call (us)'))
+                for name, build in [
+                    ('legacy', lambda: legacy_response(view, request, params)),
+                    ('current', lambda: CustomResponseLog(
+                                    view, request, params).custom_response()),
+                ]:
+                    self.stdout.write('%-8s %14.1f' % (
+                        name, timeit(build, number=n) / n * 1e6))
+            finally:
+                logger.handlers, logger.propagate = handlers, propagate
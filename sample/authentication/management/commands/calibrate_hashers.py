@@ -0,0 +1,143 @@
+"""
+Benchmarks the installed password hashers on this machine and writes
+the cost that hits the target milliseconds per hash into the settings
+modules as PASSWORD_HASHER_PROFILE.
+
+    manage.py calibrate_hashers --target-ms 250 --env local production
+"""
+import os
+import re
+from math import log2
+from time import perf_counter
+from django.conf import settings
+from django.contrib.auth.hashers import get_hashers
+from django.core.management.base import BaseCommand, CommandError
+from authentication.hashers import ProfiledHasherMixin
+
+ENVIRONMENTS = ['local', 'staging', 'production']
+BLOCK_START = '# PASSWORD HASHER PROFILE'
+BLOCK_END = '# END PASSWORD HASHER PROFILE'
+BLOCK_RE = re.compile(
+    re.escape(BLOCK_START) + r'.*?' + re.escape(BLOCK_END), re.DOTALL)
+SAMPLE_PASSWORD = 'Calibrate123@'
+
+
+def time_hash(hasher, cost, samples):
+    """
+    Best of n timing of one hash
+    :Parameters:
+        hasher : (obj) profiled hasher
+        cost : (int) work factor to try
+        samples : (int)
+    :Returns:
+        float milliseconds
+    """
+    hasher.calibrating_cost = cost
+    salt = hasher.salt()
+    best = None
+    try:
+        for _ in range(samples):
+            start = perf_counter()
+            hasher.encode(SAMPLE_PASSWORD, salt)
+            elapsed = (perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        hasher.calibrating_cost = None
+    return best
+
+
+def calibrate(hasher, target_ms, samples):
+    """
+    Scale the current cost of the hasher to the target time.
+    :Returns:
+        cost : (int)
+        ms : (float) measured time at that cost
+    """
+    cost = hasher.get_cost()
+    ms = time_hash(hasher, cost, samples)
+    if hasher.logarithmic:
+        cost = min(31, max(4, cost + round(log2(target_ms / ms))))
+    else:
+        cost = max(1, round(cost * target_ms / ms))
+        if cost >= 10000:
+            cost = round(cost, -3)
+    return cost, time_hash(hasher, cost, samples)
+
+
+def render_profile(profile, target_ms):
+    lines = [
+        BLOCK_START,
+        '# Generated by `manage.py calibrate_hashers --target-ms %g`'
+        % target_ms,
+        'PASSWORD_HASHER_PROFILE = {',
+    ]
+    for algorithm, params in profile.items():
+        lines.append('    %r: %r,' % (algorithm, params))
+    lines.extend(['}', BLOCK_END])
+    return '\n'.join(lines)
+
+
+def write_profile(path, block):
+    """
+    Replace the profile block of the settings module,
+    or append it if there is none yet.
+    """
+    with open(path) as f:
+        content = f.read()
+    if BLOCK_RE.search(content):
+        content = BLOCK_RE.sub(lambda _: block, content)
+    else:
+        content = content.rstrip('\n') + '\n\n' + block + '\n'
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark password hashers and write a hasher profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target-ms', type=float, default=250,
+            help='Target milliseconds per hash.')
+        parser.add_argument(
+            '--env', nargs='+', choices=ENVIRONMENTS, default=['local'],
+            help='Settings modules to write the profile into.')
+        parser.add_argument(
+            '--samples', type=int, default=3,
+            help='Number of timings per cost, the best is used.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Print the profile without writing it.')
+
+    def handle(self, *args, **options):
+        target_ms = options['target_ms']
+        profile = {}
+        for hasher in get_hashers():
+            if not isinstance(hasher, ProfiledHasherMixin):
+                continue
+            try:
+                if hasher.library:
+                    hasher._load_library()
+            except ValueError:
+                self.stdout.write('%s: library not installed, skipped'
+                                  % hasher.algorithm)
+                continue
+            cost, ms = calibrate(hasher, target_ms, options['samples'])
+            profile[hasher.algorithm] = {hasher.cost_param: cost}
+            self.stdout.write('%s: %s=%s (%.1f ms)' % (
+                hasher.algorithm, hasher.cost_param, cost, ms))
+        if not profile:
+            raise CommandError('No profiled hashers in PASSWORD_HASHERS.')
+
+        block = render_profile(profile, target_ms)
+        if options['dry_run']:
+            self.stdout.write(block)
+            return
+        for env in options['env']:
+            path = os.path.join(settings.BASE_DIR, 'settings', env + '.py')
+            if not os.path.exists(path):
+                self.stderr.write('%s does not exist, skipped' % path)
+                continue
+            write_profile(path, block)
+            self.stdout.write(self.style.SUCCESS('Profile written to %s'
+                                                 % path))
@@ -0,0 +1,38 @@
+"""
+Deletes the expired and used token rows, see authentication.compaction.
+
+    manage.py compact_tokens --chunk-size 500 --pause 0.05
+"""
+from django.core.management.base import BaseCommand
+from authentication.compaction import compact_all
+
+
+class Command(BaseCommand):
+    help = 'Delete expired activation/reset and JWT token rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Rows deleted per transaction')
+        parser.add_argument(
+            '--pause', type=float, default=None,
+            help='Seconds to sleep between chunks')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the rows')
+
+    def handle(self, *args, **options):
+        results = compact_all(chunk_size=options['chunk_size'],
+                              pause=options['pause'],
+                              dry_run=options['dry_run'])
+        verb = 'would delete' if options['dry_run'] else 'deleted'
+        total_rows = total_bytes = 0
+        for result in results:
+            size = ('%d bytes' % result.bytes if result.bytes is not None
+                    else 'size unknown')
+            self.stdout.write('%s: %s %d rows, %s' % (
+                result.table, verb, result.rows, size))
+            total_rows += result.rows
+            total_bytes += result.bytes or 0
+        self.stdout.write(self.style.SUCCESS(
+            'Total: %d rows, about %d bytes' % (total_rows, total_bytes)))
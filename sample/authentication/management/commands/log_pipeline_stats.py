@@ -0,0 +1,28 @@
+"""
+Prints the counters of the logstash shipper of every process, see
+utils.log_pipeline.
+
+    manage.py log_pipeline_stats
+"""
+import logging
+from time import time
+from django.core.management.base import BaseCommand, CommandError
+from utils.log_pipeline import COUNTERS, QueueLogstashHandler, read_stats
+
+
+class Command(BaseCommand):
+    help = 'Show the backlog and drop counters of the log shipping'
+
+    def handle(self, *args, **options):
+        handlers = [handler for handler in logging.getLogger().handlers
+                    if isinstance(handler, QueueLogstashHandler)]
+        if not handlers or handlers[0].spill_dir is None:
+            raise CommandError('No QueueLogstashHandler with a spill_dir')
+        columns = ('pid', 'age (s)', 'backlog') + COUNTERS + ('spill_bytes',)
+        self.stdout.write(' '.join('%12s' % column for column in columns))
+        now = time()
+        for stats in read_stats(handlers[0].spill_dir):
+            values = [stats['pid'], int(now - stats['at']), stats['backlog']]
+            values += [stats[name] for name in COUNTERS]
+            values.append(stats['spill_bytes'])
+            self.stdout.write(' '.join('%12s' % value for value in values))
@@ -0,0 +1,40 @@
+"""
+Prints the lines of the NDJSON log segments that match the filters,
+streaming them so any number of segments can be read, see
+utils.ndjson_log.
+
+    manage.py read_logs --app-name APILogin --ip 127.0.0.1
+    manage.py read_logs --email test@mail.com --dir /var/log/sample
+"""
+import json
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from utils.ndjson_log import NDJSONFileHandler, read_segments, segments
+
+
+class Command(BaseCommand):
+    help = 'Stream and filter the NDJSON log segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--app-name', help='View of the lines')
+        parser.add_argument('--email', help='User of the lines')
+        parser.add_argument('--ip', help='Client address of the lines')
+        parser.add_argument(
+            '--dir', help='Segments directory, default of the logfile handler')
+        parser.add_argument(
+            '--prefix', default=None, help='Segment file prefix')
+
+    def handle(self, *args, **options):
+        handlers = [handler for handler in logging.getLogger().handlers
+                    if isinstance(handler, NDJSONFileHandler)]
+        directory = options['dir'] or (
+                        handlers[0].directory if handlers else None)
+        if directory is None:
+            raise CommandError('No NDJSONFileHandler, give --dir')
+        prefix = options['prefix'] or (
+                    handlers[0].prefix if handlers else 'server')
+        filters = {key: options[option] for key, option in [
+            ('app_name', 'app_name'), ('email', 'email'), ('ip', 'ip'),
+        ] if options[option] is not None}
+        for line in read_segments(segments(directory, prefix), **filters):
+            self.stdout.write(json.dumps(line))
@@ -0,0 +1,16 @@
+"""
+Rebuilds the email existence filter from the users table.
+Run after importing users outside of UserManager._create,
+e.g. with loaddata.
+"""
+from django.core.management.base import BaseCommand
+from utils.email_filter import get_email_filter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the registered email filter.'
+
+    def handle(self, *args, **options):
+        count = get_email_filter().rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            'Email filter rebuilt with %s emails' % count))
@@ -0,0 +1,64 @@
+"""
+Creates a new JWT signing key and removes the keys no token can be
+signed with anymore.
+
+    manage.py rotate_jwt_keys           # new key, becomes the signing key
+    manage.py rotate_jwt_keys --prune   # also delete retired keys
+
+A key is retired once the key after it has been signing for longer
+than the refresh token lifetime.
+"""
+import os
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from authentication.jwt_keys import (
+    ASYMMETRIC_ALGORITHMS,
+    KID_FORMAT,
+    KeyRing,
+    generate_key,
+    kid_time,
+)
+
+
+class Command(BaseCommand):
+    help = 'Add a new JWT signing key and prune retired keys.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune', action='store_true',
+            help='Delete keys retired for longer than the refresh '
+                 'token lifetime.')
+        parser.add_argument(
+            '--no-new-key', action='store_true',
+            help='Only prune, do not create a key.')
+
+    def handle(self, *args, **options):
+        algorithm = settings.JWT_ALGORITHM
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise CommandError(
+                'JWT_ALGORITHM %s does not use key files.' % algorithm)
+        key_dir = settings.JWT_KEY_DIR
+        os.makedirs(key_dir, mode=0o700, exist_ok=True)
+        now = datetime.utcnow()
+
+        if not options['no_new_key']:
+            kid = now.strftime(KID_FORMAT)
+            path = os.path.join(key_dir, kid + '.pem')
+            tmp_path = path + '.tmp'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(generate_key(algorithm))
+            # Rename last so workers never load a partial key
+            os.replace(tmp_path, path)
+            self.stdout.write(self.style.SUCCESS(
+                'Created %s key %s' % (algorithm, kid)))
+
+        if options['prune']:
+            lifetime = settings.SIMPLE_JWT['REFRESH_TOKEN_LIFETIME']
+            kids = KeyRing(key_dir, algorithm).kids()
+            for kid, successor in zip(kids, kids[1:]):
+                if kid_time(successor) + lifetime < now:
+                    os.remove(os.path.join(key_dir, kid + '.pem'))
+                    self.stdout.write('Deleted retired key %s' % kid)
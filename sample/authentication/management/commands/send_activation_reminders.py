@@ -0,0 +1,53 @@
+"""
+Sends a new activation link to every inactive user, see
+authentication.reminders. Resumes an interrupted run from its
+checkpoint unless --restart is given.
+
+    manage.py send_activation_reminders --domain example.com --workers 8
+    manage.py send_activation_reminders --domain example.com --workers 0
+"""
+import os
+from django.core.management.base import BaseCommand
+from authentication.reminders import run_campaign
+from utils.mail_pool import get_mail_pool
+
+
+class Command(BaseCommand):
+    help = 'Send an activation reminder to every inactive user'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--domain', required=True,
+            help='Domain of the activation links')
+        parser.add_argument(
+            '--page-size', type=int, default=1000,
+            help='Users queued per transaction')
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Threads sending, 0 to leave it to send_emails')
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(
+                os.path.abspath('.'), 'run', 'activation_reminders.json'),
+            help='File of the last queued user')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore the checkpoint of an unfinished run')
+
+    def report(self, stats):
+        rate = stats.sent / stats.seconds if stats.seconds else 0
+        self.stdout.write(
+            '%d users, %d queued, %d skipped, %d sent, %.0f emails/s' % (
+                stats.users, stats.queued, stats.skipped, stats.sent, rate))
+
+    def handle(self, *args, **options):
+        try:
+            stats = run_campaign(options['domain'], options['checkpoint'],
+                                 page_size=options['page_size'],
+                                 workers=options['workers'],
+                                 restart=options['restart'],
+                                 progress=self.report)
+        finally:
+            get_mail_pool().close()
+        self.report(stats)
+        self.stdout.write(self.style.SUCCESS(
+            'Done in %.1f seconds' % stats.seconds))
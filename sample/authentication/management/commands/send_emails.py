@@ -0,0 +1,86 @@
+"""
+Sends the queued emails, see authentication.outbox.
+Runs until stopped, several can run side by side. The workers of one
+process share its mail connection pool.
+
+    manage.py send_emails --workers 4 --batch-size 50 --interval 1
+    manage.py send_emails --once
+    manage.py send_emails --requeue-dead
+"""
+import threading
+from time import sleep
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from authentication.outbox import deliver_pending, requeue_dead
+from utils.mail_pool import get_mail_pool
+
+
+class Command(BaseCommand):
+    help = 'Send the queued activation and reset password emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Emails claimed and sent together')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Threads sending in this process')
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='Seconds to wait when nothing is due')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Send the due emails and exit')
+        parser.add_argument(
+            '--requeue-dead', action='store_true',
+            help='Retry the emails that ran out of attempts and exit')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            self.stdout.write('Requeued %d emails' % requeue_dead())
+            return
+        batch_size = (options['batch_size']
+                      or settings.EMAIL_OUTBOX_BATCH_SIZE)
+        interval = (settings.EMAIL_OUTBOX_POLL_INTERVAL
+                    if options['interval'] is None else options['interval'])
+        workers = [
+            threading.Thread(target=self.work,
+                             args=(batch_size, interval, options['once']),
+                             name='send-emails-%d' % i, daemon=True)
+            for i in range(options['workers'])
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            get_mail_pool().close()
+
+    def work(self, batch_size, interval, once):
+        try:
+            while True:
+                try:
+                    result = deliver_pending(batch_size)
+                except Exception as e:
+                    # e.g. the database restarting, the rows are
+                    # claimed again after their lease
+                    self.stderr.write('Delivery failed: %s' % e)
+                    if once:
+                        return
+                    connection.close()
+                    sleep(interval)
+                    continue
+                if any(result):
+                    self.stdout.write(
+                        'Sent %d, retrying %d, dead %d' % result)
+                if sum(result) < batch_size:
+                    if once:
+                        return
+                    # Do not hold a connection while idle
+                    connection.close()
+                    sleep(interval)
+        finally:
+            # Each worker thread has its own connection
+            connection.close()
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.24 on 2026-10-19 04:27
+
+import authentication.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='useractivationresettoken',
+            name='digest',
+            field=authentication.fields.DigestField(max_length=32, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='useractivationresettoken',
+            index=models.Index(fields=['uuid', 'event', 'used'], name='uart_user_event_used'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Converts the stored tokens to digests in chunks, every chunk is
+# committed on its own so big tables are not locked for long. The
+# digest is unique, of the rows sharing a token only the newest one
+# keeps it, the older ones are marked used.
+
+import hashlib
+from django.db import migrations, transaction
+from django.utils.encoding import force_bytes
+
+CHUNK_SIZE = 1000
+
+
+def token_digest(token):
+    # Same as authentication.models.token_digest
+    return hashlib.sha256(force_bytes(token)).digest()
+
+
+def tokens_to_digests(apps, schema_editor):
+    OTToken = apps.get_model('authentication', 'UserActivationResetToken')
+    db_alias = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        rows = list(OTToken.objects.using(db_alias).filter(
+                    pk__gt=last_pk, digest__isnull=True,
+                    token_b__isnull=False).order_by('pk').only(
+                    'pk', 'token_b')[:CHUNK_SIZE])
+        if not rows:
+            break
+        latest = {}
+        stale = []
+        for row in rows:
+            row.digest = token_digest(row.token_b)
+            if row.digest in latest:
+                stale.append(latest[row.digest].pk)
+            latest[row.digest] = row
+        with transaction.atomic(using=db_alias):
+            # Rows of the previous chunks with the same token
+            stale.extend(OTToken.objects.using(db_alias).filter(
+                    digest__in=list(latest)).values_list('pk', flat=True))
+            if stale:
+                OTToken.objects.using(db_alias).filter(
+                    pk__in=stale).update(used=True, digest=None)
+            OTToken.objects.using(db_alias).bulk_update(
+                    list(latest.values()), ['digest'])
+        last_pk = rows[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('authentication', '0002_token_digest'),
+    ]
+
+    operations = [
+        migrations.RunPython(tokens_to_digests, migrations.RunPython.noop),
+    ]
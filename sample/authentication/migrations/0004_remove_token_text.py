@@ -0,0 +1,21 @@
+# Generated by Django 2.2.24 on 2026-10-19 04:27
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_token_digest_data'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='useractivationresettoken',
+            name='token_a',
+        ),
+        migrations.RemoveField(
+            model_name='useractivationresettoken',
+            name='token_b',
+        ),
+    ]
@@ -1,11 +1,18 @@
+import hashlib
 from uuid import uuid4
 from django.db import models
-from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth.base_user import BaseUserManager
 from rest_framework.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
+from django.utils import timezone
+from django.utils.encoding import force_bytes
 from utils.messages import ERR
+from utils.hash_executor import get_hash_executor
+from utils.background import run_in_background
+from utils.email_filter import get_email_filter
+from .fields import DigestField
+from .coalescing import release_link
 
 
 class UserManager(BaseUserManager):
@@ -14,6 +21,7 @@ class UserManager(BaseUserManager):
         user = self.model(email=self.normalize_email(email), **kwargs)
         user.set_password(password)
         user.save(using=self._db)
+        get_email_filter().add(user.email)
         return user
     
     def _get_email_password(self, **kwargs):
@@ -46,6 +54,8 @@ class UserManager(BaseUserManager):
 
     def update_role(self, _model, role):
         _model.role = role
+        # Tokens carrying the old role are outdated
+        _model.token_version += 1
         _model.save()
         return _model
 
@@ -65,9 +75,39 @@ class User(AbstractBaseUser):
     role = models.CharField(max_length=12, choices=ROLES, default=R_USER)
     created_at = models.DateTimeField(auto_now_add=True, null=False, blank=False)
     updated_at = models.DateTimeField(auto_now=True, null=False, blank=False)
+    # Version claim of the tokens, bumped by a role or password change
+    token_version = models.PositiveIntegerField(default=1)
 
     USERNAME_FIELD = 'email'
 
+    def set_password(self, raw_password):
+        self.password = get_hash_executor().make_password(raw_password)
+        self._password = raw_password
+        if not self._state.adding:
+            self.token_version += 1
+
+    def check_password(self, raw_password):
+        """
+        Same as AbstractBaseUser.check_password but the hashing is done
+        by the configured hash executor. Hashes made with an older
+        hasher profile are upgraded in the background so the login
+        does not pay for a second hash and a write.
+        """
+        def setter(raw_password):
+            run_in_background(
+                self._upgrade_password, raw_password, self.password)
+        return get_hash_executor().check_password(
+                raw_password, self.password, setter)
+
+    def _upgrade_password(self, raw_password, encoded):
+        """
+        Rehash with the current profile. Only updates the row if the
+        password was not changed in the meantime.
+        """
+        password = get_hash_executor().make_password(raw_password)
+        User.objects.filter(pk=self.pk, password=encoded).update(
+            password=password)
+
     class META:
         verbose_name = _('user')
         verbose_name_plural = _('users')
@@ -75,30 +115,59 @@ class User(AbstractBaseUser):
     objects = UserManager()
 
 
+def token_digest(token):
+    """
+    Only the digest of a link token is stored
+    :Parameters:
+        token : (str) token_B of the link
+    :Returns:
+        bytes sha256 digest
+    """
+    return hashlib.sha256(force_bytes(token)).digest()
+
+
 class ActivationResetManager(models.Manager):
 
-    def save_tokens(self, **kwargs):
-        tokenInfo = self.model(**kwargs)
+    def save_tokens(self, uuid, token, event):
+        """
+        :Parameters:
+            uuid : User object
+            token : (str) token_B of the link, every link flow has it
+            event : (str)
+        """
+        tokenInfo = self.model(
+                        uuid=uuid, digest=token_digest(token), event=event)
         tokenInfo.save()
 
     def update_used(self, user, token, event):
-        try:
-            tokenInfo = self.model.objects.get(
-                            uuid=user, used=False, event=event)
-            tokenInfo.used = True
-            tokenInfo.save()
-        except ObjectDoesNotExist:
+        """
+        Consumes the token of a link in one conditional UPDATE, of
+        concurrent requests with the same link only one gets the row.
+        :Returns:
+            int 1
+        :Raises:
+            ValidationError if the link is unknown or already used
+        """
+        updated = self.filter(
+                    digest=token_digest(token), uuid=user,
+                    used=False, event=event).update(
+                    used=True, updated_at=timezone.now())
+        if not updated:
             # Special case, have to pass the user object to get
             # the email address.
             raise ValidationError(ERR.LINK_USED, user)
-    
+        # The next request for the event sends a new link
+        release_link(user, event)
+        return updated
+
     def invalidate_token(self, user, event):
-        tokenInfo = self.model.objects.filter(
-                        uuid=user, used=False, event=event)
-        if len(tokenInfo) >= 1:
-            for tokens in tokenInfo:
-                tokens.used = True
-                tokens.save()
+        """
+        Marks every unused token of the user for the event as used
+        :Returns:
+            int number of tokens invalidated
+        """
+        return self.filter(uuid=user, used=False, event=event).update(
+                    used=True, updated_at=timezone.now())
 
 
 class UserActivationResetToken(models.Model):
@@ -114,8 +183,7 @@ class UserActivationResetToken(models.Model):
         (ACTIVATE, 'ACTIVATE'),
     )
     uuid = models.ForeignKey(User, on_delete=models.CASCADE)
-    token_a = models.TextField(null=True, blank=True)
-    token_b = models.TextField(null=True, blank=True)
+    digest = DigestField(max_length=32, unique=True, null=True)
     event = models.CharField(max_length=15, choices=EVENTS, default=RESETPASS)
     used = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True, null=False, blank=False)
@@ -125,3 +193,57 @@ class UserActivationResetToken(models.Model):
 
     class Meta:
         db_table = 'useractivationresettoken'
+        indexes = [
+            # Unused tokens of a user for an event
+            models.Index(fields=['uuid', 'event', 'used'],
+                         name='uart_user_event_used'),
+        ]
+
+
+class EmailOutboxManager(models.Manager):
+
+    def enqueue(self, to_email, subject, message, html_message, from_email):
+        """
+        Queue an email, it is sent by `manage.py send_emails`.
+        Call it in the transaction of the rows the email is about so
+        both commit or neither does.
+        :Returns:
+            EmailOutbox object
+        """
+        return self.create(to_email=to_email, subject=subject,
+                           message=message, html_message=html_message,
+                           from_email=from_email)
+
+
+class EmailOutbox(models.Model):
+    """
+        Emails waiting to be sent. Rows that failed EMAIL_OUTBOX_MAX_ATTEMPTS
+        times are kept as dead for inspection, see authentication.outbox.
+    """
+    PENDING, SENT, DEAD = ['pending', 'sent', 'dead']
+    STATUSES = (
+        (PENDING, 'PENDING'),
+        (SENT, 'SENT'),
+        (DEAD, 'DEAD'),
+    )
+    to_email = models.EmailField()
+    from_email = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    html_message = models.TextField(blank=True)
+    status = models.CharField(max_length=7, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    objects = EmailOutboxManager()
+
+    class Meta:
+        db_table = 'emailoutbox'
+        indexes = [
+            # Due rows of the workers
+            models.Index(fields=['status', 'next_attempt_at'],
+                         name='outbox_status_next'),
+        ]
@@ -0,0 +1,138 @@
+"""
+Delivery of the queued emails of authentication.models.EmailOutbox.
+
+The views only insert the row, in the transaction of the tokens the
+email links to. `manage.py send_emails` claims the due rows in batches
+of EMAIL_OUTBOX_BATCH_SIZE and sends them through the connection pool
+of utils.mail_pool.
+
+A claimed row is leased for EMAIL_OUTBOX_LEASE seconds, rows of a
+worker that died mid-batch are picked up again after it. Failed rows
+are retried after an exponential backoff, EMAIL_OUTBOX_RETRY_BASE
+seconds doubled per attempt up to EMAIL_OUTBOX_RETRY_MAX, and are
+marked dead after EMAIL_OUTBOX_MAX_ATTEMPTS attempts.
+"""
+import random
+import logging
+from datetime import timedelta
+from collections import namedtuple
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from utils.mail_pool import get_mail_pool
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+DeliveryResult = namedtuple('DeliveryResult', ['sent', 'retried', 'dead'])
+
+
+def retry_delay(attempts):
+    """
+    :Parameters:
+        attempts : (int) attempts made so far, 1 after the first failure
+    :Returns:
+        float seconds before the next attempt, with up to 10% jitter
+        so the rows of an outage are not all retried together
+    """
+    delay = min(settings.EMAIL_OUTBOX_RETRY_BASE * 2 ** (attempts - 1),
+                settings.EMAIL_OUTBOX_RETRY_MAX)
+    return delay + random.uniform(0, delay / 10)
+
+
+def _due(now):
+    return EmailOutbox.objects.filter(
+                status=EmailOutbox.PENDING,
+                next_attempt_at__lte=now).order_by('next_attempt_at')
+
+
+def claim(batch_size, now=None):
+    """
+    Lease the due rows so other workers skip them
+    :Returns:
+        list of EmailOutbox, attempts counts this one
+    """
+    now = now or timezone.now()
+    lease = now + timedelta(seconds=settings.EMAIL_OUTBOX_LEASE)
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            rows = list(_due(now).select_for_update(
+                            skip_locked=True)[:batch_size])
+            if rows:
+                EmailOutbox.objects.filter(
+                    pk__in=[row.pk for row in rows]).update(
+                    attempts=F('attempts') + 1, next_attempt_at=lease)
+        else:
+            # Without skip locked (MySQL 5.7, sqlite) another worker
+            # can select the same rows, a row is only leased if it is
+            # still due when it is updated
+            rows = [row for row in _due(now)[:batch_size]
+                    if _due(now).filter(pk=row.pk).update(
+                        attempts=F('attempts') + 1, next_attempt_at=lease)]
+    for row in rows:
+        row.attempts += 1
+    return rows
+
+
+def _failed(row, error, now):
+    row.last_error = str(error)
+    if row.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        row.status = EmailOutbox.DEAD
+        logger.error('Email %s to %s is dead after %d attempts: %s',
+                     row.pk, row.to_email, row.attempts, error)
+    else:
+        row.next_attempt_at = now + timedelta(
+                                seconds=retry_delay(row.attempts))
+    row.save(update_fields=['status', 'next_attempt_at', 'last_error'])
+
+
+def deliver(rows):
+    """
+    Send the claimed rows through the mail connection pool
+    :Returns:
+        DeliveryResult
+    """
+    messages = []
+    for row in rows:
+        email = EmailMultiAlternatives(
+                    row.subject, row.message, row.from_email, [row.to_email])
+        if row.html_message:
+            email.attach_alternative(row.html_message, 'text/html')
+        messages.append(email)
+    errors = get_mail_pool().send(messages)
+    sent = [row.pk for row, error in zip(rows, errors) if error is None]
+    failed = [(row, error) for row, error in zip(rows, errors)
+              if error is not None]
+    now = timezone.now()
+    if sent:
+        EmailOutbox.objects.filter(pk__in=sent).update(
+            status=EmailOutbox.SENT, sent_at=now, last_error='')
+    for row, error in failed:
+        _failed(row, error, now)
+    dead = sum(1 for row, _ in failed if row.status == EmailOutbox.DEAD)
+    return DeliveryResult(len(sent), len(failed) - dead, dead)
+
+
+def deliver_pending(batch_size=None):
+    """
+    Send one batch of the due emails
+    :Returns:
+        DeliveryResult, all 0 if nothing was due
+    """
+    rows = claim(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not rows:
+        return DeliveryResult(0, 0, 0)
+    return deliver(rows)
+
+
+def requeue_dead():
+    """
+    Give the dead emails another EMAIL_OUTBOX_MAX_ATTEMPTS attempts
+    :Returns:
+        int number of rows requeued
+    """
+    return EmailOutbox.objects.filter(status=EmailOutbox.DEAD).update(
+                status=EmailOutbox.PENDING, attempts=0,
+                next_attempt_at=timezone.now())
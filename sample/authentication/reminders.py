@@ -0,0 +1,216 @@
+"""
+Activation reminder campaign: sends a new activation link to every
+inactive user, see `manage.py send_activation_reminders`.
+
+The inactive users are read in pages of primary key order (keyset
+pagination), each page read with iterator(), over a server-side cursor
+where the database has them. The links of a page are made, their token
+rows and emails inserted with bulk_create in one transaction, then the
+page is checkpointed. Worker threads send the queued emails through the
+outbox meanwhile (authentication.outbox).
+
+After a crash the campaign resumes after the last checkpointed page.
+A page committed but not checkpointed is queued again, its users get
+two reminders.
+"""
+import os
+import json
+import logging
+import threading
+from time import sleep, monotonic
+from collections import namedtuple
+from django.conf import settings
+from django.db import connection, transaction
+from utils.create_email import render_email
+from utils.messages import EMAIL
+from .auth_tokens import token_generator
+from .coalescing import claim_link, release_link
+from .models import (
+    EmailOutbox,
+    User,
+    UserActivationResetToken as OTToken,
+    token_digest,
+)
+from .outbox import deliver_pending
+
+logger = logging.getLogger(__name__)
+
+CampaignStats = namedtuple(
+    'CampaignStats', ['users', 'queued', 'skipped', 'sent', 'seconds'])
+
+
+def inactive_users(after=None, page_size=1000):
+    """
+    :Parameters:
+        after : (str) primary key the pages start after
+        page_size : (int)
+    :Returns:
+        generator of the pages, lists of User with only uuid and email
+    """
+    while True:
+        users = User.objects.filter(is_active=False).only(
+                    'uuid', 'email').order_by('pk')
+        if after is not None:
+            users = users.filter(pk__gt=after)
+        page = list(users[:page_size].iterator(chunk_size=page_size))
+        if not page:
+            return
+        yield page
+        after = page[-1].pk
+
+
+def queue_reminders(users, domain):
+    """
+    Make the activation links of the users and queue their emails
+    :Parameters:
+        users : (list) of User
+        domain : (str) domain of the links
+    :Returns:
+        int number of emails queued, users with a link sent within
+        EMAIL_COALESCE_WINDOW are skipped
+    """
+    msg = EMAIL('ACTV_RESEND')
+    claimed, tokens, emails = [], [], []
+    for user in users:
+        if not claim_link(user, OTToken.ACTIVATE):
+            continue
+        claimed.append(user)
+        token_A, token_B = token_generator(user, OTToken.ACTIVATE)
+        tokens.append(OTToken(uuid=user, digest=token_digest(token_B),
+                              event=OTToken.ACTIVATE))
+        emails.append(EmailOutbox(
+            to_email=user.email, from_email=settings.DEFAULT_FROM_EMAIL,
+            subject=msg.TITLE, message=msg.MSG,
+            html_message=render_email(msg.TEMPLATE, {
+                'email_id': user.email,
+                'domain': domain,
+                'protocol': settings.PROTOCOL,
+                'token_A': token_A,
+                'token_B': token_B,
+            })))
+    try:
+        with transaction.atomic():
+            OTToken.objects.bulk_create(tokens)
+            EmailOutbox.objects.bulk_create(emails)
+    except Exception:
+        for user in claimed:
+            release_link(user, OTToken.ACTIVATE)
+        raise
+    return len(emails)
+
+
+def load_checkpoint(path):
+    """
+    :Returns:
+        dict of the last run, empty if there is none
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    Replace the checkpoint file in one rename so a crash leaves the old
+    or the new one
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class _Senders():
+    """
+    Threads sending the outbox until the campaign is queued and nothing
+    is due
+    """
+
+    def __init__(self, workers, batch_size):
+        self.batch_size = batch_size
+        self.sent = 0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name='reminders-%d' % i,
+                             daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        try:
+            while True:
+                try:
+                    result = deliver_pending(self.batch_size)
+                except Exception as e:
+                    # The rows are claimed again after their lease
+                    logger.exception('Reminder delivery failed: %s', e)
+                    if self.done.is_set():
+                        return
+                    connection.close()
+                    sleep(1)
+                    continue
+                with self._lock:
+                    self.sent += result.sent
+                if not any(result):
+                    if self.done.is_set():
+                        return
+                    sleep(0.1)
+        finally:
+            # Each worker thread has its own connection
+            connection.close()
+
+    def join(self):
+        self.done.set()
+        for thread in self._threads:
+            thread.join()
+
+
+def run_campaign(domain, checkpoint_path, page_size=1000, workers=4,
+                 restart=False, progress=None):
+    """
+    :Parameters:
+        domain : (str) domain of the links
+        checkpoint_path : (str)
+        page_size : (int) users per transaction
+        workers : (int) threads sending the emails, 0 to only queue
+            them for `manage.py send_emails`
+        restart : (bool) ignore the checkpoint of an unfinished run
+        progress : (function) called with the CampaignStats of every page
+    :Returns:
+        CampaignStats of this run
+    """
+    checkpoint = {} if restart else load_checkpoint(checkpoint_path)
+    after = checkpoint.get('after')
+    users = queued = skipped = 0
+    start = monotonic()
+    senders = None
+    if workers:
+        senders = _Senders(workers, settings.EMAIL_OUTBOX_BATCH_SIZE)
+    try:
+        for page in inactive_users(after, page_size):
+            count = queue_reminders(page, domain)
+            users += len(page)
+            queued += count
+            skipped += len(page) - count
+            after = str(page[-1].pk)
+            save_checkpoint(checkpoint_path, {'after': after})
+            if progress is not None:
+                progress(CampaignStats(
+                    users, queued, skipped,
+                    senders.sent if senders else 0, monotonic() - start))
+    finally:
+        if senders is not None:
+            senders.join()
+    # Finished, the next run starts over
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return CampaignStats(users, queued, skipped,
+                         senders.sent if senders else 0, monotonic() - start)
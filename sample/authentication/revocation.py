@@ -0,0 +1,209 @@
+"""
+Denylist of revoked token ids (jti).
+A revoked jti is kept in a dict of the worker until the token expires,
+so checking a token is a dict lookup. Revocations are also written to
+the shared cache (settings.REVOCATION_CACHE_ALIAS) with the remaining
+lifetime of the token as timeout, a jti unknown to the worker is looked
+up there. Neither touches the database.
+
+The BlacklistedToken rows, of the refresh tokens and of the access
+tokens revoked by a logout, stay the durable record. The denylist is
+rebuilt from them when the server starts (see sample/wsgi.py), and
+every worker loads the rows added since its last load every
+REVOCATION_SYNC_INTERVAL seconds, so a revocation is seen by the
+workers that do not share the cache too.
+
+The token buffers of several processes insert the rows in batches, a
+row can commit after rows of higher ids were loaded. A sync reads from
+the highest id loaded by a sync at least REVOCATION_SYNC_OVERLAP
+seconds before the previous one: a row not seen by the previous sync
+was inserted after that, so it has a higher id as long as its
+transaction (and the clock skew of its host) took less than the
+overlap.
+"""
+import heapq
+import logging
+import threading
+from collections import deque
+from time import sleep, time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from rest_framework_simplejwt.utils import aware_utcnow, datetime_to_epoch
+
+logger = logging.getLogger(__name__)
+
+REVOKED_KEY = 'revoked:%s'
+
+
+class Denylist():
+
+    def __init__(self, cache_alias, max_size, overlap=60):
+        """
+        :Parameters:
+            cache_alias : (str) shared cache of the revocations
+            max_size : (int) jtis kept by the worker, the ones expiring
+                first are left to the shared cache when it is full
+            overlap : (int) seconds a row can take to commit after its
+                id was taken
+        """
+        self.cache_alias = cache_alias
+        self.max_size = max_size
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._expiry = []
+        # (start, highest BlacklistedToken id) of the loads
+        self._marks = deque()
+        self._sync_thread = None
+
+    def _cache(self):
+        return caches[self.cache_alias]
+
+    def _expire(self, now):
+        while self._expiry and (self._expiry[0][0] <= now
+                                or len(self._entries) > self.max_size):
+            exp, jti = heapq.heappop(self._expiry)
+            if self._entries.get(jti) == exp:
+                del self._entries[jti]
+
+    def add(self, jti, exp, now=None):
+        """
+        Deny jti in this worker only
+        :Parameters:
+            jti : (str)
+            exp : (int) expiry of the token, epoch seconds
+        """
+        now = now or time()
+        if exp <= now:
+            return
+        with self._lock:
+            if self._entries.get(jti) != exp:
+                self._entries[jti] = exp
+                heapq.heappush(self._expiry, (exp, jti))
+            self._expire(now)
+
+    def revoke(self, jti, exp, now=None):
+        """
+        Deny jti in every worker until exp
+        """
+        now = now or time()
+        if exp <= now:
+            return
+        self.add(jti, exp, now)
+        self._cache().set(REVOKED_KEY % jti, exp, int(exp - now) + 1)
+
+    def is_revoked(self, jti, now=None):
+        """
+        :Returns:
+            bool True if jti was revoked and has not expired yet
+        """
+        now = now or time()
+        exp = self._entries.get(jti)
+        if exp is None:
+            exp = self._cache().get(REVOKED_KEY % jti)
+            if exp is None:
+                return False
+            self.add(jti, exp, now)
+        return exp > now
+
+    def _load(self, after_id=None, now=None):
+        """
+        Load the unexpired blacklisted tokens of the database
+        :Parameters:
+            after_id : (int) only the rows past this id
+            now : (float) start of the load, epoch seconds
+        :Returns:
+            list of (jti, exp), by expiry
+        """
+        from rest_framework_simplejwt.token_blacklist.models import (
+            BlacklistedToken
+        )
+        now = now or time()
+        rows = BlacklistedToken.objects.filter(
+                    token__expires_at__gt=aware_utcnow())
+        if after_id is not None:
+            rows = rows.filter(id__gt=after_id)
+        # Ordered by expiry, a batch is cached as long as its last
+        # token lives, is_revoked checks the exp of every entry
+        rows = rows.order_by('token__expires_at').values_list(
+                    'id', 'token__jti', 'token__expires_at').iterator()
+        loaded = []
+        last_id = self._marks[-1][1] if self._marks else 0
+        for row_id, jti, expires_at in rows:
+            # Stored in UTC, naive without USE_TZ
+            exp = datetime_to_epoch(expires_at)
+            self.add(jti, exp, now)
+            loaded.append((jti, exp))
+            last_id = max(last_id, row_id)
+        self._marks.append((now, last_id))
+        return loaded
+
+    def rebuild(self):
+        """
+        Load the unexpired blacklisted tokens of the database, in this
+        worker and in the shared cache
+        :Returns:
+            int number of jtis loaded
+        """
+        now = time()
+        loaded = self._load()
+        shared = {}
+        for jti, exp in loaded:
+            shared[REVOKED_KEY % jti] = exp
+            if len(shared) >= 1000:
+                self._cache().set_many(shared, int(exp - now) + 1)
+                shared = {}
+        if shared:
+            self._cache().set_many(shared, int(exp - now) + 1)
+        return len(loaded)
+
+    def sync(self, now=None):
+        """
+        Load the blacklisted tokens added since the last load, in this
+        worker only. Everything is loaded until a load is overlap
+        seconds older than the previous one.
+        :Returns:
+            int number of jtis loaded
+        """
+        after_id = None
+        if self._marks:
+            since = self._marks[-1][0] - self.overlap
+            while len(self._marks) > 1 and self._marks[1][0] <= since:
+                self._marks.popleft()
+            if self._marks[0][0] <= since:
+                after_id = self._marks[0][1]
+        return len(self._load(after_id, now))
+
+    def _sync_loop(self, interval):
+        while True:
+            sleep(interval)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.exception('Denylist sync failed: %s', e)
+            finally:
+                connection.close()
+
+    def start_sync(self, interval):
+        """
+        Sync every interval seconds in a daemon thread of this
+        process, nothing is started if the interval is None
+        """
+        if interval is None or self._sync_thread is not None:
+            return
+        self._sync_thread = threading.Thread(
+            target=self._sync_loop, args=(interval,),
+            name='denylist-sync', daemon=True)
+        self._sync_thread.start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self._marks.clear()
+
+
+denylist = Denylist(settings.REVOCATION_CACHE_ALIAS,
+                    settings.REVOCATION_LOCAL_SIZE,
+                    settings.REVOCATION_SYNC_OVERLAP)
@@ -2,9 +2,17 @@ import re, requests, json
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.serializers import ModelSerializer, Serializer
-from django.contrib.auth import get_user_model, authenticate
-from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_login_failed
+from axes.exceptions import AxesBackendPermissionDenied
+from axes.handlers.proxy import AxesProxyHandler
+from axes.helpers import get_credentials
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
 from utils.messages import ERR
+from utils.email_filter import get_email_filter
+from utils.identity_map import identity_map
+from .tokens import RevocableRefreshToken
 
 User = get_user_model()
 STRONG_PASS = r"^(?=.*[a-z])(?=.*[A-Z])(?=.*[0-9])(?=.*[!@#\$%\^&\*])(?=.{8,})"
@@ -14,6 +22,28 @@ NAME_PASS = r"^[a-zA-Z \-\.]*$"
 USERNAME_VALID = r"^[a-zA-Z0-9-_]+$"
 
 
+def email_exists(email):
+    """
+    The email filter answers unknown emails without a query,
+    only possible matches are checked in the users table.
+    """
+    return (get_email_filter().might_contain(email)
+            and User.objects.filter(email=email).exists())
+
+
+def find_user(email, request=None):
+    """
+    User of the email, None if it is not registered. Unknown emails
+    are answered by the email filter, the row is loaded through the
+    identity map of the request.
+    """
+    if not get_email_filter().might_contain(email):
+        return None
+    if not request:
+        return User.objects.filter(email=email).first()
+    return identity_map(request).get_by_email(email)
+
+
 class UserRegisterSerializer(Serializer):
 
     email = serializers.EmailField(
@@ -44,7 +74,7 @@ class UserRegisterSerializer(Serializer):
         fields = ('email', 'password', 'role', 'confirm_password')
 
     def validate_email(self, email):
-        if User.objects.filter(email=email).exists():
+        if email_exists(email):
             raise ValidationError(ERR.EMAIL_EXIST)
         if not re.match(VALID_EMAIL, email):
             raise ValidationError(ERR.EMAIL_INVALID)
@@ -68,8 +98,12 @@ class UserRegisterSerializer(Serializer):
 
 
 class UserLoginSerializer(ModelSerializer):
-    
-    verify_email = None
+    """
+    Login validation.
+    The user row is loaded once and the password hash is checked once,
+    the same user object is returned in validated_data['user'] so the
+    view can pass it to login() and RefreshToken.for_user.
+    """
 
     email = serializers.EmailField(
         error_messages = {
@@ -91,47 +125,69 @@ class UserLoginSerializer(ModelSerializer):
         fields = ('email', 'password',)
 
     def validate_email(self, email):
-        if not User.objects.filter(email=email).exists():
-            raise ValidationError(ERR.USER_NOT_EXIST)
         if not email:
             raise ValidationError(ERR.EMAIL_PASS_NULL)
-        if not re.match(VALID_EMAIL, email):
-            raise ValidationError(ERR.EMAIL_PASS_NULL)
-        self.verify_email = email
         return email
 
     def validate_password(self, password):
         if not password:
             raise ValidationError(ERR.EMAIL_PASS_NULL)
-        try:
-            user = User.objects.get(email=self.verify_email)
-            if not user.check_password(password):
-                raise ValidationError(ERR.LOGIN_INVALID)
-        except ObjectDoesNotExist:
-            # Already raised in validate_email, no need to raise again
-            pass
         return password
 
-    def _validate_email(self, email, password):
-        user = None
-        if email and password:
-            user = authenticate(
-                self.context, email=email, password=password)
+    def _get_user(self, email):
+        """
+        Single query for the user row
+        :Parameters:
+            email : (str)
+        :Returns:
+            user : User object
+        """
+        user = find_user(email, self.context)
+        if user is None:
+            raise ValidationError({'email': [ERR.USER_NOT_EXIST]})
+        if not re.match(VALID_EMAIL, email):
+            raise ValidationError({'email': [ERR.EMAIL_PASS_NULL]})
+        return user
+
+    def _login_failed(self, email):
+        """
+        Emits the same signal authenticate() does on failure so axes
+        can record the attempt.
+        """
+        user_login_failed.send(
+            sender=__name__, credentials=get_credentials(email),
+            request=self.context)
+
+    def _authenticate(self, user, email, password):
+        """
+        Replacement for authenticate() which reuses the loaded user
+        instead of querying and hashing again in the backends.
+        :Parameters:
+            user : User object
+            email : (str)
+            password : (str)
+        :Returns:
+            user : User object
+        """
+        # Locked out clients are denied before the hash, like
+        # AxesBackend does
+        if not AxesProxyHandler.is_allowed(
+                self.context, get_credentials(email)):
+            self._login_failed(email)
+            raise AxesBackendPermissionDenied(ERR.USER_BLOCKED)
+        if not user.check_password(password):
+            self._login_failed(email)
+            raise ValidationError({'password': [ERR.LOGIN_INVALID]})
+        if not user.is_active:
+            self._login_failed(email)
+            raise ValidationError(ERR.USER_INACTIVE)
         return user
 
     def validate(self, validated_data):
         email = validated_data.get('email')
         password = validated_data.get('password')
-
-        user = None
-        email = self.validate_email(email)
-        password = self.validate_password(password)
-        if email and password:
-            user = self._validate_email(email, password)
-        if not user:
-            if not User.objects.get(email=email).is_active:
-                raise ValidationError(ERR.USER_INACTIVE)
-        validated_data['user'] = user
+        user = self._get_user(email)
+        validated_data['user'] = self._authenticate(user, email, password)
         return validated_data
 
 
@@ -146,7 +202,7 @@ class EmailSerializer(Serializer):
     )
 
     def validate_email(self, email):
-        if not User.objects.filter(email=email).exists():
+        if find_user(email, self.context) is None:
             raise ValidationError(ERR.USER_NOT_EXIST)
         if not email:
             raise ValidationError(ERR.EMAIL_PASS_NULL)
@@ -154,6 +210,12 @@ class EmailSerializer(Serializer):
             raise ValidationError(ERR.EMAIL_PASS_NULL)
         return email
 
+    def validate(self, validated_data):
+        # Loaded by validate_email, no query with a request context
+        validated_data['user'] = find_user(
+                                    validated_data['email'], self.context)
+        return validated_data
+
 
 class PasswordChangeSerializer(ModelSerializer):
     password = serializers.CharField(
@@ -200,3 +262,21 @@ class ChangeRoleSerializer(Serializer):
         if not role in roles:
             raise ValidationError(ERR.ROLE_INVALID)
         return role
+
+
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Same as simplejwt's refresh, with the revocation check and the
+    blacklist after rotation going through the denylist.
+    """
+
+    def validate(self, attrs):
+        refresh = RevocableRefreshToken(attrs['refresh'])
+        data = {'access': str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            data['refresh'] = str(refresh)
+        return data
@@ -0,0 +1,36 @@
+"""
+Receivers keeping authentication.user_cache in line with the users
+table. Connected in AuthenticationConfig.ready.
+"""
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .user_cache import invalidate_user
+
+
+def _invalidate(user):
+    invalidate_user(user)
+    if transaction.get_connection().in_atomic_block:
+        # A request may cache the row before the change commits, it
+        # is dropped again once the change is visible
+        transaction.on_commit(lambda: invalidate_user(user))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, **kwargs):
+    """
+    Any save (admin, shell, views) or delete makes the cached copies
+    stale, a deleted user is not authenticated from the cache
+    """
+    _invalidate(instance)
+
+
+@receiver(user_logged_in)
+def user_logged_in_changed(sender, request, user, **kwargs):
+    """
+    The login updates last_login
+    """
+    _invalidate(user)
@@ -1,26 +1,147 @@
 """
 Test cases for the whole authentication module
 """
+import os
 import json
+import tempfile
+import socket
+import logging
+import threading
+from time import sleep
+from smtplib import SMTPException
+from datetime import timedelta
+from unittest.mock import patch
 from django.urls.exceptions import NoReverseMatch
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.client import Client, RequestFactory
+from django.template.loader import render_to_string
+from django.db import connection, transaction
+from django.utils import timezone
+from django.core.cache import cache
 from django.urls import reverse
 from django.core import mail
+from django.contrib.auth.hashers import get_hasher
 from rest_framework.authtoken.models import Token
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from axes.handlers.proxy import AxesProxyHandler
+from rest_framework.exceptions import ValidationError
+from axes.models import AccessAttempt
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.utils import aware_utcnow
 
-from .models import User
+from .models import (
+    EmailOutbox,
+    User,
+    UserActivationResetToken as OTToken,
+)
+from .user_cache import (
+    LocalUserCache,
+    get_cached_user,
+    get_user_version,
+    local_users,
+)
+from .revocation import Denylist, denylist
+from .compaction import compact_all
+from . import outbox
+from .outbox import claim, deliver_pending, requeue_dead
+from .reminders import run_campaign, save_checkpoint
+from .auth_tokens import (
+    compact_token_generator,
+    legacy_token_generator,
+)
+from .token_buffer import TokenWriteBuffer, replay_spools
+from .tokens import RevocableRefreshToken
+from .jwt_keys import KeyRing, KeyRingTokenBackend, generate_key
+from utils.messages import ERR
+from utils.custom_exceptions import ServiceBusy
+from utils.hash_executor import InlineHashExecutor
+from utils.email_filter import EmailFilter, get_email_filter
+from utils.attempt_store import LocalAttemptStore
+from utils.rate_limit import RateLimiter, limiter
+from utils.mail_pool import MailConnectionPool
+from utils import res_handler
+from utils.res_handler import CustomResponseLog, SuccessLog
+from utils.ndjson_log import NDJSONFileHandler, read_segments, segments
+from utils.log_pipeline import QueueLogstashHandler
+from utils.log_sampling import Aggregator
+from utils.create_email import (
+    get_email_template,
+    render_email,
+    site_domain,
+)
 from lib._test_utils import get_code, req_post, req_get
+from lib.jwt_verifier import JWKSVerifier
+from lib.fake_smtp import FakeSMTPServer
 
 
-class AuthenticationTest(TestCase):
+# Runtime files of the tests, kept out of the working directory
+RUN_DIR = tempfile.mkdtemp()
+run_dir_settings = override_settings(
+    AXES_STORE_PATH=os.path.join(RUN_DIR, 'axes.bin'),
+    EMAIL_FILTER_PATH=os.path.join(RUN_DIR, 'email_filter.bin'),
+    TOKEN_BUFFER_DIR=os.path.join(RUN_DIR, 'token_spool'),
+)
+
+
+class RunDirMixin():
+    """
+    Use with run_dir_settings, the stores and log files are made in
+    RUN_DIR
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The log handlers are made with the settings, their files are
+        # moved with the attributes they read when writing
+        log_dir = os.path.join(RUN_DIR, 'logs')
+        for name in ('', 'authentication'):
+            for handler in logging.getLogger(name).handlers:
+                if isinstance(handler, NDJSONFileHandler):
+                    handler.directory = log_dir
+                elif isinstance(handler, QueueLogstashHandler):
+                    handler.spill_dir = os.path.join(log_dir, 'spill')
+
+    def setUp(self):
+        super().setUp()
+        # Stores made again from run_dir_settings
+        patcher = patch('utils.email_filter._filter', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        AxesProxyHandler.get_implementation(force=True)
+
+
+@run_dir_settings
+class AuthenticationTest(RunDirMixin, TestCase):
     REG_URL = reverse('users-api:register')
     LOGIN_URL = reverse('users-api:login')
     PASS_RESET_URL = reverse('reset-password')
     RESEND_ACT_URL = reverse('resend-activation')
 
     def setUp(self):
+        super().setUp()
         # Control data for the test to be made
         User.objects._create('test@mail.com', 'Abcd123@')
+        get_email_filter().rebuild()
+        # Failed attempts are not stored in the test database
+        AxesProxyHandler.reset_attempts(
+            ip_address='127.0.0.1', username='test@mail.com')
+        # Rate limit buckets are kept in memory and in the cache
+        limiter.reset()
+        cache.clear()
+        local_users.clear()
+        denylist.clear()
+        # Token rows are written by flush() only
+        patcher = patch('authentication.token_buffer._buffer',
+                        TokenWriteBuffer(tempfile.mkdtemp(), 1000, None))
+        self.token_buffer = patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_register(self):
         user = User.objects.get(email='test@mail.com')
@@ -180,6 +301,8 @@ class AuthenticationTest(TestCase):
         # Verify if response if 201
         self.assertEqual(201, response.status_code)
 
+        # Send the queued email
+        deliver_pending()
         # Check mail if sent
         self.assertEqual(len(mail.outbox), 1)
         # Get token from email
@@ -259,6 +382,857 @@ class AuthenticationTest(TestCase):
         token_B = response.data['data']['access']
         self.assertNotEqual(token_A, token_B)
 
+    def test_login(self):
+        _info = {
+            'email': 'test_1@mail.com',
+            'password': 'Abcd123@'
+        }
+        # Post request with email does not exist
+        response = req_post(self, _info, self.LOGIN_URL)
+        # Verify if response if 400
+        self.assertEqual(400, response.status_code)
+        # Verify error message, user does not exist
+        self.assertEqual(ERR.USER_NOT_EXIST, response.data['errors'])
+
+        # Post request with inactive user
+        _info['email'] = 'test@mail.com'
+        response = req_post(self, _info, self.LOGIN_URL)
+        # Verify if response if 400
+        self.assertEqual(400, response.status_code)
+        # Verify error message, user is inactive
+        self.assertEqual(ERR.USER_INACTIVE, response.data['errors'])
+
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+
+        # Post request with incorrect password
+        _info['password'] = 'Abcd123!'
+        response = req_post(self, _info, self.LOGIN_URL)
+        # Verify if response if 400
+        self.assertEqual(400, response.status_code)
+        # Verify error message, incorrect password
+        self.assertEqual(ERR.LOGIN_INVALID, response.data['errors'])
+
+        # Post request with correct password, password is hashed once
+        _info['password'] = 'Abcd123@'
+        with patch.object(User, 'check_password',
+                          autospec=True,
+                          side_effect=User.check_password) as check:
+            response = req_post(self, _info, self.LOGIN_URL)
+        # Verify status code, 200
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, check.call_count)
+        self.assertIn('access', response.data['data'])
+
+    def test_hash_executor_busy(self):
+        executor = InlineHashExecutor(max_pending=1, timeout=1)
+        encoded = executor.make_password('Abcd123@')
+        # Verify password hashed through the executor
+        self.assertTrue(executor.check_password('Abcd123@', encoded))
+        self.assertEqual(2, executor.metrics()['hashes'])
+        # Occupy the only slot, next hash should fail fast
+        executor._slots.acquire()
+        with self.assertRaises(ServiceBusy):
+            executor.check_password('Abcd123@', encoded)
+        executor._slots.release()
+        self.assertEqual(1, executor.metrics()['rejected'])
+        self.assertEqual(0, executor.metrics()['queue_depth'])
+        # Verify metrics are logged for the operators
+        with self.assertLogs('utils.hash_executor', 'INFO') as logs:
+            executor.log_metrics()
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual('HASH_METRICS', line['message'])
+        self.assertEqual(2, line['hashes'])
+
+        # Login returns 503 when the executor is full
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        with patch('authentication.models.get_hash_executor',
+                   return_value=executor):
+            executor._slots.acquire()
+            response = req_post(self, _info, self.LOGIN_URL)
+            executor._slots.release()
+        self.assertEqual(503, response.status_code)
+
+    def test_login_upgrades_hash(self):
+        # Store a hash made with an older profile
+        user = User.objects.get(email='test@mail.com')
+        hasher = get_hasher('default')
+        user.password = hasher.encode('Abcd123@', hasher.salt(), 1000)
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        # Run the background upgrade right away
+        with patch('authentication.models.run_in_background',
+                   side_effect=lambda func, *args: func(*args)):
+            response = req_post(self, _info, self.LOGIN_URL)
+        self.assertEqual(200, response.status_code)
+        # Verify hash was upgraded to the current profile
+        user = User.objects.get(email='test@mail.com')
+        self.assertFalse(hasher.must_update(user.password))
+        self.assertTrue(user.check_password('Abcd123@'))
+
+    def test_email_filter(self):
+        path = os.path.join(tempfile.mkdtemp(), 'email_filter.bin')
+        email_filter = EmailFilter(path, 1000, 0.001)
+        # Verify filter is built from the users table
+        self.assertEqual(1, email_filter.rebuild())
+        self.assertTrue(email_filter.might_contain('test@mail.com'))
+        self.assertTrue(email_filter.might_contain('TEST@mail.com'))
+        self.assertFalse(email_filter.might_contain('test_1@mail.com'))
+        # Verify added email is seen by another process' filter
+        email_filter.add('test_1@mail.com')
+        self.assertTrue(
+            EmailFilter(path, 1000, 0.001).might_contain('test_1@mail.com'))
+        # Verify a rebuild elsewhere does not close the map in use
+        in_use = email_filter._map
+        EmailFilter(path, 1000, 0.001).rebuild()
+        self.assertTrue(email_filter.might_contain('test@mail.com'))
+        self.assertIsNot(in_use, email_filter._map)
+        self.assertFalse(in_use.closed)
+        # Missing filter falls through to the DB, rebuilt once aside
+        missing = EmailFilter(path + '.new', 1000, 0.001)
+        with patch('utils.email_filter.run_in_background',
+                   side_effect=lambda func, *args: func(*args)) as bg:
+            self.assertTrue(missing.might_contain('test_2@mail.com'))
+            self.assertFalse(missing.might_contain('test_2@mail.com'))
+        self.assertEqual(1, bg.call_count)
+        # Verify waiter skips a rebuild already done by another process
+        self.assertEqual(0, missing.rebuild(force=False))
+
+        # Unknown email is rejected without a query
+        _info = {
+            'email': 'test_2@mail.com',
+            'password': 'Abcd123@'
+        }
+        with patch('authentication.serializers.get_email_filter',
+                   return_value=email_filter):
+            with self.assertNumQueries(0):
+                response = req_post(self, _info, self.LOGIN_URL)
+        self.assertEqual(ERR.USER_NOT_EXIST, response.data['errors'])
+
+    def test_login_lockout(self):
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123!'
+        }
+        # Fail up to the limit, attempts are not saved in the database
+        for _ in range(settings.AXES_FAILURE_LIMIT):
+            response = req_post(self, _info, self.LOGIN_URL)
+            self.assertEqual(400, response.status_code)
+        self.assertEqual(0, AccessAttempt.objects.count())
+
+        # Correct password is denied while locked out, without a hash
+        _info['password'] = 'Abcd123@'
+        with patch.object(User, 'check_password') as check:
+            response = req_post(self, _info, self.LOGIN_URL)
+        self.assertEqual(403, response.status_code)
+        check.assert_not_called()
+
+        # Counters expire a window after the last attempt
+        store = LocalAttemptStore(60)
+        store.incr('ip:127.0.0.1', now=1000)
+        store.incr('ip:127.0.0.1', now=1001)
+        self.assertEqual(2, store.get('ip:127.0.0.1', now=1010))
+        self.assertEqual(2, store.get('ip:127.0.0.1', now=1050))
+        self.assertEqual(0, store.get('ip:127.0.0.1', now=1062))
+        self.assertEqual(0, store.get('ip:127.0.0.1', now=1200))
+        # Verify a lockout crossing a window boundary lasts the cool-off
+        store = LocalAttemptStore(3600)
+        for now in range(3590, 3595):
+            self.assertEqual(now - 3589, store.incr('email:a', now=now))
+        self.assertEqual(5, store.get('email:a', now=3601))
+        self.assertEqual(5, store.get('email:a', now=3594 + 3599))
+        self.assertEqual(0, store.get('email:a', now=3594 + 3601))
+        # Next attempt counts on from the count reached
+        self.assertEqual(6, store.incr('email:a', now=3700))
+
+    def test_rate_limit(self):
+        policy = settings.RATE_LIMITS['reset-password']
+        _info = {
+            'email': 'test@mail.com'
+        }
+        # Requests up to the bucket size are allowed
+        for _ in range(policy['burst']):
+            response = req_post(self, _info, self.PASS_RESET_URL)
+            self.assertEqual(200, response.status_code)
+        # Next request is rejected before the view runs
+        with self.assertNumQueries(0):
+            response = req_post(self, _info, self.PASS_RESET_URL)
+        self.assertEqual(429, response.status_code)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(ERR.TOO_MANY_REQUESTS, response.json()['errors'])
+
+        # Tokens used by another worker are taken off on sync
+        other = RateLimiter(sync_interval=0)
+        worker = RateLimiter(sync_interval=0)
+        policy = {'rate': 2, 'period': 60, 'burst': 2, 'keys': ('ip',)}
+        self.assertEqual(0, other.consume('test', policy, now=1000))
+        self.assertEqual(0, other.consume('test', policy, now=1000))
+        self.assertEqual(0, worker.consume('test', policy, now=1000))
+        self.assertNotEqual(0, worker.consume('test', policy, now=1000))
+
+        # Verify the buckets stay at max_buckets under a flood of keys
+        flood = RateLimiter(sync_interval=3600, max_buckets=10)
+        for i in range(100):
+            flood.consume('email:%d' % i, policy, now=1000)
+        self.assertEqual(10, len(flood.buckets))
+        self.assertIn('email:99', flood.buckets)
+        # Verify a request rejected on one key spends no other token
+        flood.consume('email:a', policy, now=1000)
+        flood.consume('email:a', policy, now=1000)
+        self.assertNotEqual(
+            0, flood.consume_all(['ip:x', 'email:a'], policy, now=1000))
+        self.assertEqual(2, flood.buckets['ip:x'][0].tokens)
+
+    def test_user_cache(self):
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        response = req_post(self, _info, self.LOGIN_URL)
+        auth = 'Bearer ' + response.data['data']['access']
+        url = reverse('users-api:user-detail')
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(200, response.status_code)
+        # Verify user is resolved from cache, the view only reads the
+        # fresh row
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(200, response.status_code)
+        # Verify a new login is shown right away
+        last_login = response.data['data']['last_login']
+        response = req_post(self, _info, self.LOGIN_URL)
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertNotEqual(last_login, response.data['data']['last_login'])
+        self.assertEqual(
+            str(User.objects.get(pk=user.pk).last_login),
+            response.data['data']['last_login'])
+
+        # Verify role update invalidates the cached user
+        self.assertEqual(User.R_USER, get_cached_user(user.uuid).role)
+        User.objects.update_role(user, User.R_ADMIN)
+        self.assertEqual(User.R_ADMIN, get_cached_user(user.uuid).role)
+        # Verify a save outside the views (admin, shell) is seen
+        User.objects.filter(pk=user.pk).first().save()
+        with self.assertNumQueries(1):
+            get_cached_user(user.uuid)
+        # Verify worker entries expire after USER_CACHE_TIMEOUT
+        cache_ = LocalUserCache(10, 300)
+        cache_.set('id', 1, user, now=1000)
+        self.assertIs(user, cache_.get('id', 1, now=1299))
+        self.assertIsNone(cache_.get('id', 1, now=1300))
+        # Verify a deleted user is not authenticated from the cache
+        user.delete()
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(401, response.status_code)
+
+    @override_settings(JWT_USER_CLAIMS=True)
+    def test_user_detail_claims(self):
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        response = req_post(self, _info, self.LOGIN_URL)
+        auth = 'Bearer ' + response.data['data']['access']
+        url = reverse('users-api:user-detail')
+        # First request loads the user changed by the login
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(200, response.status_code)
+        # Verify user detail is answered from the token claims
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(200, response.status_code)
+        user = User.objects.get(email='test@mail.com')
+        self.assertEqual('test@mail.com', response.data['data']['email'])
+        self.assertEqual(user.role, response.data['data']['role'])
+        self.assertEqual(
+            str(user.last_login), response.data['data']['last_login'])
+
+        # Verify role change invalidates the token
+        User.objects.update_role(user, User.R_ADMIN)
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(401, response.status_code)
+        # Verify token stays outdated when the caches are lost, e.g.
+        # on a restart
+        cache.clear()
+        local_users.clear()
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(401, response.status_code)
+        # Verify password change invalidates the new tokens too
+        response = req_post(self, _info, self.LOGIN_URL)
+        auth = 'Bearer ' + response.data['data']['access']
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(200, response.status_code)
+        user = User.objects.get(email='test@mail.com')
+        user.set_password('Abcd1234@')
+        user.save()
+        response = self.client.get(url, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(401, response.status_code)
+
+    def test_jwks(self):
+        # Key ring with one RS256 key
+        key_dir = tempfile.mkdtemp()
+        with open(os.path.join(key_dir, '20260101T000000Z.pem'), 'wb') as f:
+            f.write(generate_key('RS256'))
+        keyring = KeyRing(key_dir, 'RS256').refresh()
+        backend = KeyRingTokenBackend(keyring)
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        url = reverse('jwks')
+        with patch('rest_framework_simplejwt.state.token_backend', backend), \
+                patch('authentication.views.get_keyring',
+                      return_value=keyring):
+            response = req_post(self, _info, self.LOGIN_URL)
+            access = response.data['data']['access']
+            # Verify token is accepted by this app
+            response = self.client.get(
+                reverse('users-api:user-detail'),
+                HTTP_AUTHORIZATION='Bearer ' + access)
+            self.assertEqual(200, response.status_code)
+
+            # Verify JWKS is published with cache headers
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertIn('max-age', response['Cache-Control'])
+            self.assertEqual(
+                '20260101T000000Z', response.json()['keys'][0]['kid'])
+            response = self.client.get(
+                url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(304, response.status_code)
+
+            # Verify another service can check the token with the JWKS
+            verifier = JWKSVerifier(
+                url, fetch=lambda url: (self.client.get(url).json(), 60))
+            claims = verifier.verify(access)
+            self.assertEqual(str(user.uuid), claims['user_id'])
+
+    def test_token_revocation(self):
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        response = req_post(self, _info, self.LOGIN_URL)
+        access = response.data['data']['access']
+        refresh = response.data['data']['refresh']
+        refresh_url = reverse('token_refresh')
+
+        # Verify refresh rotates and denies the old refresh token
+        response = req_post(self, {'refresh': refresh}, refresh_url)
+        self.assertEqual(200, response.status_code)
+        new_refresh = response.data['refresh']
+        with self.assertNumQueries(0):
+            response = req_post(self, {'refresh': refresh}, refresh_url)
+        self.assertEqual(401, response.status_code)
+
+        # Verify logout revokes the access and refresh tokens
+        auth = 'Bearer ' + access
+        response = self.client.post(
+            reverse('logout'), data=json.dumps({'refresh': new_refresh}),
+            content_type='application/json', HTTP_AUTHORIZATION=auth)
+        self.assertEqual(200, response.status_code)
+        response = self.client.get(
+            reverse('users-api:user-detail'), HTTP_AUTHORIZATION=auth)
+        self.assertEqual(401, response.status_code)
+        response = req_post(self, {'refresh': new_refresh}, refresh_url)
+        self.assertEqual(401, response.status_code)
+
+        # Verify the denylist is rebuilt from the database, with the
+        # revoked access token
+        self.token_buffer.flush()
+        denylist.clear()
+        cache.clear()
+        self.assertEqual(3, denylist.rebuild())
+        response = req_post(self, {'refresh': new_refresh}, refresh_url)
+        self.assertEqual(401, response.status_code)
+        response = self.client.get(
+            reverse('users-api:user-detail'), HTTP_AUTHORIZATION=auth)
+        self.assertEqual(401, response.status_code)
+
+        # Verify a worker not sharing the cache syncs new revocations
+        other = Denylist(settings.REVOCATION_CACHE_ALIAS, 1000)
+        self.assertEqual(3, other.sync())
+        response = req_post(self, _info, self.LOGIN_URL)
+        access = AccessToken(response.data['data']['access'])
+        self.client.post(
+            reverse('logout'), content_type='application/json',
+            HTTP_AUTHORIZATION='Bearer ' + str(access))
+        self.token_buffer.flush()
+        cache.clear()
+        other.sync()
+        self.assertTrue(other.is_revoked(access['jti']))
+
+        # Verify a row committed after rows of higher ids is synced
+        user = User.objects.get(email='test@mail.com')
+
+        def blacklist(row_id):
+            token = OutstandingToken.objects.create(
+                user=user, jti='late-%s' % row_id, token='late',
+                expires_at=aware_utcnow() + timedelta(hours=1))
+            BlacklistedToken.objects.create(id=row_id, token=token)
+
+        other = Denylist(settings.REVOCATION_CACHE_ALIAS, 1000, 60)
+        blacklist(1000)
+        other.sync(now=1000)
+        blacklist(1200)
+        other.sync(now=1100)
+        blacklist(1100)
+        other.sync(now=1200)
+        self.assertTrue(other.is_revoked('late-1100'))
+
+    def test_token_buffer(self):
+        user = User.objects.get(email='test@mail.com')
+        user.is_active = True
+        user.save()
+        _info = {
+            'email': 'test@mail.com',
+            'password': 'Abcd123@'
+        }
+        response = req_post(self, _info, self.LOGIN_URL)
+        refresh = response.data['data']['refresh']
+        # Verify login does not wait for the outstanding token row
+        self.assertEqual(0, OutstandingToken.objects.count())
+        self.assertEqual(1, self.token_buffer.pending())
+        # Verify the spool of a running worker is not replayed
+        spool_dir = self.token_buffer.spool_dir
+        self.assertEqual(0, replay_spools(spool_dir))
+        self.assertEqual(1, self.token_buffer.flush())
+        self.assertEqual(1, OutstandingToken.objects.filter(
+                                user=user).count())
+        self.assertEqual(0, sum(
+            os.path.getsize(os.path.join(spool_dir, name))
+            for name in os.listdir(spool_dir)))
+
+        # Verify the spool of a crashed worker is written on startup
+        crashed = TokenWriteBuffer(tempfile.mkdtemp(), 1000, None)
+        crashed.blacklist(RevocableRefreshToken(refresh))
+        os.close(crashed._fd)
+        self.assertEqual(1, replay_spools(crashed.spool_dir))
+        self.assertEqual([], os.listdir(crashed.spool_dir))
+        self.assertEqual(1, BlacklistedToken.objects.filter(
+                                token__user=user).count())
+
+    def test_auth_token_formats(self):
+        user = User.objects.get(email='test@mail.com')
+        token_A, token_B = compact_token_generator(user, OTToken.ACTIVATE)
+        self.assertLess(len(token_A) + len(token_B), 130)
+        # Verify reset link does not accept activation tokens
+        response = self.client.get(
+                reverse('reset-token-check', args=[token_A, token_B]))
+        self.assertEqual(400, response.status_code)
+        # Verify token_B is not accepted as token_A
+        response = self.client.get(
+                reverse('activate-token-check', args=[token_B, token_B]))
+        self.assertEqual(400, response.status_code)
+
+        # Verify expired tokens
+        with override_settings(AUTH_TOKEN_MAX_AGE=-1):
+            old_A, old_B = compact_token_generator(user, OTToken.ACTIVATE)
+        response = self.client.get(
+                reverse('activate-token-check', args=[old_A, old_B]))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(ERR.ACTIVATION_EXPIRED, response.data['errors'])
+
+        # Verify legacy links are accepted during the transition only
+        legacy_A, legacy_B = legacy_token_generator(user)
+        url = reverse('activate-token-check', args=[legacy_A, legacy_B])
+        with override_settings(AUTH_TOKEN_ACCEPT_LEGACY=False):
+            response = self.client.get(url)
+        self.assertEqual(400, response.status_code)
+        OTToken.objects.save_tokens(uuid=user, token=legacy_B,
+                                    event=OTToken.ACTIVATE)
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(User.objects.get(email='test@mail.com').is_active)
+
+    def test_decode_tokens(self):
+        user = User.objects.get(email='test@mail.com')
+        token_A, token_B = compact_token_generator(user, OTToken.RESETPASS)
+        # Verify both halves are checked with one user query
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                    reverse('reset-token-check', args=[token_A, token_B]))
+        self.assertEqual(200, response.status_code)
+        # Verify halves of different links are rejected
+        other_A, _ = compact_token_generator(user, OTToken.RESETPASS)
+        response = self.client.get(
+                reverse('reset-token-check', args=[other_A, token_B]))
+        self.assertEqual(400, response.status_code)
+        # Verify legacy halves are checked once
+        legacy_A, legacy_B = legacy_token_generator(user)
+        with patch('authentication.auth_tokens.generate_token.check_token',
+                   return_value=True) as check_token:
+            response = self.client.get(
+                    reverse('reset-token-check', args=[legacy_A, legacy_B]))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, check_token.call_count)
+
+    def test_token_digest(self):
+        user = User.objects.get(email='test@mail.com')
+        token_A, token_B = compact_token_generator(user, OTToken.ACTIVATE)
+        OTToken.objects.save_tokens(
+            uuid=user, token=token_B, event=OTToken.ACTIVATE)
+        # Verify only the fixed width digest is stored
+        row = OTToken.objects.get(uuid=user)
+        self.assertEqual(32, len(row.digest))
+        self.assertNotIn(token_B.encode(), bytes(row.digest))
+        # Verify the row is found by the digest of its token only
+        with self.assertRaises(ValidationError):
+            OTToken.objects.update_used(user, token_A, OTToken.ACTIVATE)
+        OTToken.objects.update_used(user, token_B, OTToken.ACTIVATE)
+        self.assertTrue(OTToken.objects.get(uuid=user).used)
+
+    def test_compact_tokens(self):
+        user = User.objects.get(email='test@mail.com')
+        # Dead rows: used links and expired refresh tokens
+        for i in range(3):
+            OTToken.objects.save_tokens(
+                uuid=user, token='used%d' % i, event=OTToken.ACTIVATE)
+        OTToken.objects.invalidate_token(user, OTToken.ACTIVATE)
+        # Token expiries are in UTC like simplejwt stores them
+        utc_now = aware_utcnow()
+        for i in range(3):
+            token = OutstandingToken.objects.create(
+                        user=user, jti='old%d' % i, token='old',
+                        expires_at=utc_now - timedelta(minutes=1))
+            BlacklistedToken.objects.create(token=token)
+        # Live rows, a token expiring before the local time is not
+        # expired yet
+        OTToken.objects.save_tokens(
+            uuid=user, token='live', event=OTToken.RESETPASS)
+        OutstandingToken.objects.create(
+            user=user, jti='live', token='live',
+            expires_at=utc_now + timedelta(minutes=1))
+
+        results = compact_all(chunk_size=2, pause=0, dry_run=True)
+        self.assertEqual(6, sum(result.rows for result in results))
+        self.assertEqual(4, OTToken.objects.count())
+        results = compact_all(chunk_size=2, pause=0)
+        rows = {result.table: result.rows for result in results}
+        self.assertEqual(3, rows[OTToken._meta.db_table])
+        self.assertEqual(3, rows[OutstandingToken._meta.db_table])
+        self.assertEqual(3, rows[BlacklistedToken._meta.db_table])
+        # Verify live rows are kept
+        self.assertEqual(1, OTToken.objects.count())
+        self.assertEqual(['live'], list(
+            OutstandingToken.objects.values_list('jti', flat=True)))
+
+    def test_email_outbox(self):
+        _info = {
+            'email': 'outbox@mail.com',
+            'password': 'Abcd123@',
+            'confirm_password': 'Abcd123@',
+            'role': 'user',
+        }
+        response = req_post(self, _info, self.REG_URL)
+        self.assertEqual(201, response.status_code)
+        # Verify the email is queued, not sent
+        self.assertEqual(0, len(mail.outbox))
+        email = EmailOutbox.objects.get(to_email='outbox@mail.com')
+        self.assertEqual(EmailOutbox.PENDING, email.status)
+
+        # Failed delivery is retried later
+        with patch('django.core.mail.backends.locmem.EmailBackend.'
+                   'send_messages', side_effect=SMTPException('down')):
+            self.assertEqual((0, 1, 0), deliver_pending())
+        email.refresh_from_db()
+        self.assertEqual(1, email.attempts)
+        self.assertEqual('down', email.last_error)
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual((0, 0, 0), deliver_pending())
+
+        # Dead after the last attempt
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        with override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2), \
+                patch('django.core.mail.backends.locmem.EmailBackend.'
+                      'send_messages', side_effect=SMTPException('down')):
+            self.assertEqual((0, 0, 1), deliver_pending())
+        email.refresh_from_db()
+        self.assertEqual(EmailOutbox.DEAD, email.status)
+
+        # Verify a row selected by two workers is leased by one only
+        self.assertEqual(1, requeue_dead())
+        pks = list(EmailOutbox.objects.filter(
+                    status=EmailOutbox.PENDING).values_list('pk', flat=True))
+        selected = [EmailOutbox.objects.filter(pk__in=pks)]
+        self.assertEqual(1, len(claim(10)))
+        due = outbox._due
+        with patch('authentication.outbox._due', side_effect=(
+                lambda now: selected.pop() if selected else due(now))):
+            self.assertEqual([], claim(10))
+
+        # Requeued dead emails are sent
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual((1, 0, 0), deliver_pending())
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(['outbox@mail.com'], mail.outbox[0].to)
+        email.refresh_from_db()
+        self.assertEqual(EmailOutbox.SENT, email.status)
+
+    def test_mail_pool(self):
+        messages = [
+            mail.EmailMessage('Subject', 'Body', 'from@mail.com',
+                              ['user%d@mail.com' % i])
+            for i in range(5)
+        ]
+        with FakeSMTPServer() as server:
+            pool = MailConnectionPool(
+                        1, 2, backend='django.core.mail.backends.smtp.'
+                        'EmailBackend', host=server.host, port=server.port)
+            # Verify every batch goes over the same connection
+            self.assertEqual([None] * 5, pool.send(messages))
+            self.assertEqual(5, len(server.messages))
+            self.assertEqual(1, server.connections)
+            # Verify a dropped connection is reconnected
+            server.drop_connections()
+            self.assertEqual([None] * 2, pool.send(messages[:2]))
+            self.assertEqual(7, len(server.messages))
+            self.assertEqual(2, server.connections)
+            pool.close()
+
+    def test_email_render(self):
+        request = RequestFactory().post('/', HTTP_HOST='localhost')
+        params = {'domain': 'localhost', 'protocol': 'http',
+                  'token_A': 'abc', 'token_B': 'def'}
+        # Verify the compiled template renders as render_to_string does
+        self.assertEqual(render_to_string('activation.html', params),
+                         render_email('activation.html', params))
+        self.assertIs(get_email_template('activation.html'),
+                      get_email_template('activation.html'))
+        # Verify the domain is resolved once per host
+        self.assertEqual('localhost', site_domain(request))
+        with patch('utils.create_email.get_current_site') as current_site:
+            self.assertEqual('localhost', site_domain(request))
+            current_site.assert_not_called()
+
+    def test_link_coalescing(self):
+        user = User.objects.get(email='test@mail.com')
+        _info = {'email': 'test@mail.com'}
+        first = req_post(self, _info, self.PASS_RESET_URL)
+        second = req_post(self, _info, self.PASS_RESET_URL)
+        # Verify the repeated request gets the same response
+        self.assertEqual(200, second.status_code)
+        self.assertEqual(first.data, second.data)
+        # Verify only one link was made and queued
+        self.assertEqual(1, OTToken.objects.filter(uuid=user).count())
+        self.assertEqual(1, EmailOutbox.objects.count())
+
+        # Verify a new link is sent once the last one is used
+        deliver_pending()
+        emailBody = mail.outbox[0].message().get_payload()[1].as_string()
+        token_B = emailBody.split('reset/')[1].split('/" ')[0].split('/')[1]
+        OTToken.objects.update_used(user, token_B, OTToken.RESETPASS)
+        req_post(self, _info, self.PASS_RESET_URL)
+        self.assertEqual(2, EmailOutbox.objects.count())
+
+    def test_activation_reminders(self):
+        User.objects.bulk_create([
+            User(email='inactive%d@mail.com' % i, password='!')
+            for i in range(4)
+        ] + [User(email='active@mail.com', password='!', is_active=True)])
+        pks = list(User.objects.filter(is_active=False).order_by(
+                    'pk').values_list('pk', flat=True))
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reminders.json')
+        # Verify a run resumes after its checkpoint
+        save_checkpoint(checkpoint, {'after': str(pks[1])})
+        stats = run_campaign('localhost', checkpoint, page_size=2,
+                             workers=0)
+        self.assertEqual((3, 3, 0), stats[:3])
+        self.assertFalse(os.path.exists(checkpoint))
+        # Verify users with a recent link are skipped
+        stats = run_campaign('localhost', checkpoint, page_size=2,
+                             workers=0)
+        self.assertEqual((5, 2, 3), stats[:3])
+        self.assertEqual(5, OTToken.objects.count())
+        self.assertEqual(5, EmailOutbox.objects.count())
+        self.assertEqual((5, 0, 0), deliver_pending())
+        self.assertNotIn('active@mail.com',
+                         [email.to[0] for email in mail.outbox])
+
+    def test_response_log(self):
+        request = Request(RequestFactory().post(
+                    '/', json.dumps({'email': 'test@mail.com'}),
+                    content_type='application/json'),
+                    parsers=[JSONParser()])
+        params = {'token': 'abc'}
+        with self.assertLogs('utils.res_handler', 'INFO') as logs:
+            response = CustomResponseLog(
+                        self, request, params).custom_response()
+        self.assertEqual(
+            {'message': 'OK', 'success': True, 'data': params}, response)
+        # Verify the log line keeps its keys and order
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(['timestamp', 'email', 'ip', 'message', 'success',
+                          'app_name'], list(line))
+        self.assertEqual('test@mail.com', line['email'])
+        self.assertEqual('AuthenticationTest', line['app_name'])
+
+    def test_log_pipeline(self):
+        log = logging.getLogger('test_log_pipeline')
+        log.propagate = False
+        # Verify a full queue drops instead of blocking
+        with patch.object(QueueLogstashHandler, '_ship'):
+            handler = QueueLogstashHandler('127.0.0.1', max_queue=1)
+            log.addHandler(handler)
+            log.warning('queued')
+            log.warning('dropped')
+            log.removeHandler(handler)
+        self.assertEqual(1, handler.stats()['dropped'])
+        self.assertEqual(1, handler.stats()['backlog'])
+
+        # A free port nothing listens on yet
+        sink = socket.socket()
+        sink.bind(('127.0.0.1', 0))
+        handler = QueueLogstashHandler(
+                    '127.0.0.1', sink.getsockname()[1], version=1,
+                    flush_interval=0.05, spill_dir=tempfile.mkdtemp(),
+                    timeout=1)
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+        # Verify the events are spilled while the sink is down
+        for i in range(3):
+            log.warning('event %d', i)
+        handler.flush(timeout=5)
+        for _ in range(50):
+            if handler.stats()['spilled'] == 3:
+                break
+            sleep(0.05)
+        self.assertEqual(3, handler.stats()['spilled'])
+
+        # Verify the spilled events are sent first once the sink is up
+        sink.listen(1)
+        handler._retry_at = 0
+        log.warning('event 3')
+        conn, _ = sink.accept()
+        conn.settimeout(5)
+        received = b''
+        while received.count(b'\n') < 4:
+            received += conn.recv(65536)
+        self.assertLess(received.index(b'event 0'),
+                        received.index(b'event 3'))
+        handler.close()
+        conn.close()
+        sink.close()
+        self.assertEqual(3, handler.stats()['replayed'])
+        self.assertEqual(1, handler.stats()['shipped'])
+
+        # Verify a replay that keeps failing does not grow the file name
+        spill_dir = tempfile.mkdtemp()
+        with patch.object(QueueLogstashHandler, '_ship'):
+            handler = QueueLogstashHandler(
+                        '127.0.0.1', batch_size=1, spill_dir=spill_dir,
+                        spill_max_bytes=30)
+            handler._start()
+        with open(os.path.join(spill_dir, '1.spill'), 'wb') as f:
+            f.write(b'a\n' * 5)
+        for _ in range(4):
+            with patch.object(handler, '_send', side_effect=[True, False]):
+                self.assertFalse(handler._replay())
+        names = os.listdir(spill_dir)
+        self.assertEqual(1, len(names))
+        self.assertEqual(len('%s.12345678.spill' % handler._pid),
+                         len(names[0]))
+        self.assertEqual(4, handler.stats()['replayed'])
+
+        # Verify an error puts the claimed file back
+        with patch.object(handler, '_send', side_effect=OSError):
+            with self.assertRaises(OSError):
+                handler._replay()
+        self.assertTrue(os.listdir(spill_dir)[0].endswith('.spill'))
+
+        # Verify the limit counts the spill files of every process
+        with open(os.path.join(spill_dir, '2.spill'), 'wb') as f:
+            f.write(b'b\n' * 15)
+        handler._spill([b'c\n'])
+        self.assertEqual(1, handler.stats()['dropped'])
+        self.assertFalse(os.path.exists(handler._spill_path()))
+
+    def test_ndjson_log(self):
+        directory = tempfile.mkdtemp()
+        handler = NDJSONFileHandler(directory, max_bytes=1, backup_count=2,
+                                    flush_interval=0.05)
+        log = logging.getLogger('test_ndjson_log')
+        log.propagate = False
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+        log.info(SuccessLog('test@mail.com', '127.0.0.1', 'APILogin'))
+        sleep(0.2)
+        log.info(json.dumps({'email': 'test@mail.com', 'ip': '127.0.0.1',
+                             'app_name': 'APILogout'}))
+        sleep(0.2)
+        log.info(SuccessLog('other@mail.com', '127.0.0.1', 'APILogin'))
+        handler.close()
+        # Verify the segments are rotated, compressed and pruned
+        paths = segments(directory)
+        self.assertEqual(2, len(paths))
+        self.assertTrue(all(path.endswith('.ndjson.gz') for path in paths))
+        # Verify the filters see the fields of both kinds of messages
+        lines = list(read_segments(paths, email='test@mail.com'))
+        self.assertEqual(1, len(lines))
+        self.assertIn('APILogout', lines[0]['message'])
+        lines = list(read_segments(paths, app_name='APILogin'))
+        self.assertEqual(['other@mail.com'],
+                         [line['email'] for line in lines])
+
+        # Verify a segment of a previous run with a reused pid is rotated
+        directory = tempfile.mkdtemp()
+        stale = os.path.join(directory, 'server-20260101T000000.000-%s'
+                             '.ndjson.part' % os.getpid())
+        with open(stale, 'w') as f:
+            f.write('{}\n')
+        handler = NDJSONFileHandler(directory, compress=False)
+        handler._pid = os.getpid()
+        handler._recover()
+        self.assertEqual([stale[:-len('.part')]], segments(directory))
+
+    def test_success_log_sampling(self):
+        request = Request(RequestFactory().get('/'))
+        # Verify a view sampled at 0 is not logged
+        with override_settings(
+                SUCCESS_LOG_SAMPLE_RATES={'AuthenticationTest': 0}), \
+                patch.object(res_handler.logger, 'info') as info:
+            CustomResponseLog(self, request).custom_response()
+        info.assert_not_called()
+        # Verify the requests are rolled up per view
+        aggregator = Aggregator(3600)
+        with patch('utils.log_sampling._aggregator', aggregator):
+            response = self.client.get(reverse('users-api:user-detail'))
+            self.assertEqual(401, response.status_code)
+            for latency in range(1, 101):
+                aggregator.add('APILogin', latency, False)
+            with self.assertLogs('utils.log_sampling', 'INFO') as logs:
+                rollups = aggregator.flush()
+        self.assertEqual(2, len(logs.records))
+        login, detail = [rollup.as_dict() for rollup in rollups]
+        self.assertEqual('APIUserDetail', detail['app_name'])
+        self.assertEqual((1, 1), (detail['requests'], detail['errors']))
+        self.assertEqual((100, 0), (login['requests'], login['errors']))
+        self.assertEqual((51, 91, 100),
+                         (login['p50'], login['p90'], login['p99']))
+
     def test_reset_password(self):
         _info = {
             'email': None
@@ -304,6 +1278,8 @@ class AuthenticationTest(TestCase):
         response = req_post(self, _info, self.PASS_RESET_URL)
         # Verify if response if 200
         self.assertEqual(200, response.status_code)
+        # Send the queued email
+        deliver_pending()
         # Check mail if sent
         self.assertEqual(len(mail.outbox), 1)
         # Get token from email
@@ -531,6 +1507,8 @@ class AuthenticationTest(TestCase):
         response = req_post(self, _info, self.RESEND_ACT_URL)
         # Verify if response if 200
         self.assertEqual(200, response.status_code)
+        # Send the queued email
+        deliver_pending()
         # Check mail if sent
         self.assertEqual(len(mail.outbox), 1)
         # Get token from email
@@ -547,3 +1525,83 @@ class AuthenticationTest(TestCase):
         self.assertEqual(
             'Sample <sample@gmail.com>', mail.outbox[0].from_email)
 
+
+@run_dir_settings
+class TokenConsumptionTest(RunDirMixin, TransactionTestCase):
+    """
+    Requests racing with the same link, run on real transactions
+    """
+    THREADS = 4
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects._create('race@mail.com', 'Abcd123@')
+        _, self.token_B = compact_token_generator(
+                                self.user, OTToken.RESETPASS)
+        OTToken.objects.save_tokens(
+            uuid=self.user, token=self.token_B, event=OTToken.RESETPASS)
+
+    def _race(self, func):
+        barrier = threading.Barrier(self.THREADS)
+        results = [None] * self.THREADS
+
+        def run(i):
+            try:
+                barrier.wait()
+                results[i] = func(i)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_update_used_once(self):
+        def consume(i):
+            try:
+                return OTToken.objects.update_used(
+                        self.user, self.token_B, OTToken.RESETPASS)
+            except ValidationError:
+                return 0
+        # Verify only one request consumes the link
+        self.assertEqual(1, sum(self._race(consume)))
+        self.assertEqual(0, OTToken.objects.invalidate_token(
+                                self.user, OTToken.RESETPASS))
+
+    def test_change_password_once(self):
+        url = reverse('change-password', args=[self.token_B])
+
+        def change(i):
+            password = 'Abcd123@%d' % i
+            response = Client().post(
+                url, data=json.dumps({
+                    'password': password,
+                    'confirm_password': password
+                }), content_type='application/json')
+            return response.status_code, password
+        results = self._race(change)
+        # Verify one password change wins, the others get LINK_USED
+        winners = [password for status, password in results
+                   if status == 200]
+        self.assertEqual(1, len(winners))
+        self.assertEqual(
+            [400] * (self.THREADS - 1),
+            [status for status, _ in results if status != 200])
+        user = User.objects.get(email='race@mail.com')
+        self.assertTrue(user.check_password(winners[0]))
+
+    def test_user_cache_after_commit(self):
+        # A row cached while the change is not committed yet
+        with transaction.atomic():
+            User.objects.update_role(self.user, User.R_ADMIN)
+            stale = User.objects.get(pk=self.user.pk)
+            stale.role = User.R_USER
+            local_users.set(str(self.user.pk),
+                            get_user_version(self.user.pk), stale)
+            self.assertEqual(User.R_USER,
+                             get_cached_user(self.user.pk).role)
+        # Verify it is dropped once the change commits
+        self.assertEqual(User.R_ADMIN, get_cached_user(self.user.pk).role)
@@ -0,0 +1,264 @@
+"""
+Write-behind buffer of the OutstandingToken and BlacklistedToken rows.
+Logins and refreshes append a record to the buffer instead of inserting
+a row, the buffer is written with bulk_create once it holds
+TOKEN_BUFFER_MAX_SIZE records or its oldest record is
+TOKEN_BUFFER_MAX_DELAY seconds old.
+
+Every record is also appended to a spool file of the worker process
+(TOKEN_BUFFER_DIR/<pid>-<id>.spool) before the request returns. A
+spool is removed once its records are in the database, the spools left
+by a crashed worker are written by replay_spools() when the server
+starts (see sample/wsgi.py).
+
+Revocation checks do not wait for the rows, revoked jtis are in
+authentication.revocation as soon as they are blacklisted.
+"""
+import os
+import json
+import glob
+import fcntl
+import atexit
+import logging
+import threading
+from time import time
+from uuid import uuid4
+from django.conf import settings
+from django.db import transaction
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.utils import (
+    datetime_from_epoch,
+    datetime_to_epoch,
+)
+from utils.background import run_in_background
+
+logger = logging.getLogger(__name__)
+
+OUTSTANDING = 'outstanding'
+BLACKLISTED = 'blacklisted'
+BATCH_SIZE = 500
+
+
+def write_records(records):
+    """
+    Insert the rows of the records, rows already in the database are
+    skipped so a record can be written more than once.
+    :Parameters:
+        records : (list) of dict
+    """
+    outstanding = {}
+    blacklisted = {}
+    for record in records:
+        jti = record['jti']
+        if record['kind'] == OUTSTANDING:
+            outstanding[jti] = OutstandingToken(
+                user_id=record['user'],
+                jti=jti,
+                token=record['token'],
+                created_at=datetime_from_epoch(record['created_at']),
+                expires_at=datetime_from_epoch(record['expires_at']))
+        else:
+            # Same as BlacklistMixin.blacklist, the outstanding row is
+            # made if the token is not known
+            outstanding.setdefault(jti, OutstandingToken(
+                jti=jti,
+                token=record['token'],
+                expires_at=datetime_from_epoch(record['expires_at'])))
+            blacklisted[jti] = datetime_from_epoch(record['at'])
+    with transaction.atomic():
+        OutstandingToken.objects.bulk_create(
+            outstanding.values(), batch_size=BATCH_SIZE,
+            ignore_conflicts=True)
+        jtis = list(blacklisted)
+        for start in range(0, len(jtis), BATCH_SIZE):
+            ids = OutstandingToken.objects.filter(
+                    jti__in=jtis[start:start + BATCH_SIZE]).values_list(
+                    'jti', 'id')
+            BlacklistedToken.objects.bulk_create([
+                BlacklistedToken(token_id=token_id,
+                                 blacklisted_at=blacklisted[jti])
+                for jti, token_id in ids
+            ], ignore_conflicts=True)
+
+
+def _read_spool(path):
+    records = []
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Torn write of a crash, the record never returned
+                logger.warning('Skipped a broken record of %s', path)
+    return records
+
+
+def replay_spools(spool_dir):
+    """
+    Write the spools no running worker holds, i.e. of crashed workers
+    :Returns:
+        int number of records written
+    """
+    count = 0
+    for path in sorted(glob.glob(os.path.join(spool_dir, '*.spool'))):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            records = _read_spool(path)
+            write_records(records)
+            os.remove(path)
+            count += len(records)
+        finally:
+            os.close(fd)
+    return count
+
+
+class TokenWriteBuffer():
+
+    def __init__(self, spool_dir, max_size, max_delay):
+        """
+        :Parameters:
+            spool_dir : (str)
+            max_size : (int) records written together
+            max_delay : (float) seconds a record waits at most,
+                None to only write on max_size or flush()
+        """
+        self.spool_dir = spool_dir
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._records = []
+        self._timer = None
+        self._pid = None
+        self._fd = None
+        self._path = None
+        # Spools whose records are not in the database yet
+        self._flushing = []
+
+    def _open_spool(self):
+        """
+        The spool is held locked so replay_spools skips it
+        """
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._pid = os.getpid()
+        self._path = os.path.join(
+            self.spool_dir, '%s-%s.spool' % (self._pid, uuid4().hex[:8]))
+        self._fd = os.open(self._path,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked, the spool of the parent is not ours
+                self._records = []
+                self._timer = None
+                self._flushing = []
+                self._open_spool()
+            os.write(self._fd, line.encode())
+            self._records.append(record)
+            pending = len(self._records)
+            self._arm()
+        if pending % self.max_size == 0:
+            run_in_background(self.flush)
+
+    def _arm(self):
+        """
+        Start the max_delay timer of the buffered records
+        """
+        if self._timer is None and self.max_delay is not None:
+            self._timer = threading.Timer(
+                self.max_delay, run_in_background, (self.flush,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def outstanding(self, user_id, token):
+        """
+        Record a token made for a user
+        """
+        self._append({
+            'kind': OUTSTANDING,
+            'user': str(user_id),
+            'jti': token[api_settings.JTI_CLAIM],
+            'token': str(token),
+            'created_at': datetime_to_epoch(token.current_time),
+            'expires_at': token['exp'],
+        })
+
+    def blacklist(self, token):
+        """
+        Record a blacklisted token
+        """
+        self._append({
+            'kind': BLACKLISTED,
+            'jti': token[api_settings.JTI_CLAIM],
+            'token': str(token),
+            'expires_at': token['exp'],
+            'at': int(time()),
+        })
+
+    def pending(self):
+        with self._lock:
+            return len(self._records)
+
+    def flush(self):
+        """
+        Write the buffered records. On failure they stay in the buffer
+        and their spool is kept for the next flush.
+        :Returns:
+            int number of records written
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                records, self._records = self._records, []
+                if self._fd is not None and records:
+                    # New records go to a new spool
+                    self._flushing.append((self._path, self._fd))
+                    self._open_spool()
+                flushing, self._flushing = self._flushing, []
+            if not records:
+                return 0
+            try:
+                write_records(records)
+            except Exception as e:
+                logger.exception('Token rows not written: %s', e)
+                with self._lock:
+                    self._records[:0] = records
+                    self._flushing[:0] = flushing
+                    self._arm()
+                return 0
+            for path, fd in flushing:
+                os.remove(path)
+                os.close(fd)
+            return len(records)
+
+
+_buffer = None
+
+
+def get_token_buffer():
+    """
+    Returns the token buffer, created once per process.
+    """
+    global _buffer
+    if _buffer is None:
+        _buffer = TokenWriteBuffer(settings.TOKEN_BUFFER_DIR,
+                                   settings.TOKEN_BUFFER_MAX_SIZE,
+                                   settings.TOKEN_BUFFER_MAX_DELAY)
+        atexit.register(_buffer.flush)
+    return _buffer
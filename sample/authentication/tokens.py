@@ -0,0 +1,96 @@
+"""
+Token classes of the app.
+
+RevocableRefreshToken checks and records revocations in
+authentication.revocation instead of querying the blacklist tables, its
+OutstandingToken and BlacklistedToken rows are written behind by
+authentication.token_buffer.
+
+ClaimsRefreshToken is opt-in (settings.JWT_USER_CLAIMS), its tokens
+carry the user details. Requests with these tokens are answered from
+the verified claims, the version claim is checked against the
+token_version of the user so a role or password change invalidates the
+tokens issued before it.
+"""
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from .revocation import denylist
+from .token_buffer import get_token_buffer
+
+VERSION_CLAIM = 'ver'
+
+
+class RevocableRefreshToken(RefreshToken):
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Same as simplejwt's, without waiting for the OutstandingToken row
+        """
+        user_id = getattr(user, api_settings.USER_ID_FIELD)
+        if not isinstance(user_id, int):
+            user_id = str(user_id)
+        token = cls()
+        token[api_settings.USER_ID_CLAIM] = user_id
+        get_token_buffer().outstanding(user.pk, token)
+        return token
+
+    def check_blacklist(self):
+        if denylist.is_revoked(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
+
+    def blacklist(self):
+        """
+        Denied right away, the BlacklistedToken row is kept for the
+        denylist rebuild
+        """
+        denylist.revoke(self.payload[api_settings.JTI_CLAIM],
+                        self.payload['exp'])
+        get_token_buffer().blacklist(self)
+
+
+def revoke_access_token(token):
+    """
+    Denied right away like RevocableRefreshToken.blacklist, the
+    BlacklistedToken row of the access token is kept for the denylist
+    rebuild and sync
+    :Parameters:
+        token : validated access token
+    """
+    denylist.revoke(token[api_settings.JTI_CLAIM], token['exp'])
+    get_token_buffer().blacklist(token)
+
+
+class ClaimsRefreshToken(RevocableRefreshToken):
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token['email'] = user.email
+        token['role'] = user.role
+        token['last_login'] = str(user.last_login)
+        token[VERSION_CLAIM] = user.token_version
+        return token
+
+
+class ClaimsUser(TokenUser):
+    """ Stateless user built from the claims of the access token """
+
+    @cached_property
+    def email(self):
+        return self.token['email']
+
+    @cached_property
+    def role(self):
+        return self.token['role']
+
+    @cached_property
+    def last_login(self):
+        return self.token['last_login']
+
+    def get_username(self):
+        return self.email
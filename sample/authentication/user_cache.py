@@ -0,0 +1,131 @@
+"""
+Versioned cache of the users resolved from access tokens.
+A user is looked up in a small LRU of the worker first, then in the
+shared cache (settings.USER_CACHE_ALIAS), and only then in the database.
+
+Every user has a version number in the shared cache. invalidate_user
+bumps it, so the entries of every worker become stale at once. It is
+called on every save and delete of a user and on login (see
+authentication.signals). Entries of the worker are also dropped after
+USER_CACHE_TIMEOUT, like the ones of the shared cache, so a change the
+worker missed is seen within it.
+
+The version only names the cache entries. The version claim of the
+tokens is User.token_version, stored with the user.
+"""
+import threading
+from time import time, monotonic
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.contrib.auth import get_user_model
+
+VERSION_KEY = 'user-version:%s'
+USER_KEY = 'user:%s:%s'
+
+
+class LocalUserCache():
+    """ Thread safe LRU of (version, user, expiry) per user id """
+
+    def __init__(self, size, timeout):
+        """
+        :Parameters:
+            size : (int) users kept at most
+            timeout : (float) seconds an entry is used at most
+        """
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+
+    def get(self, user_id, version, now=None):
+        now = now or monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[0] != version:
+                return None
+            if entry[2] <= now:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, version, user, now=None):
+        now = now or monotonic()
+        with self._lock:
+            self._users[user_id] = (version, user, now + self.timeout)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+local_users = LocalUserCache(settings.USER_CACHE_LOCAL_SIZE,
+                             settings.USER_CACHE_TIMEOUT)
+
+
+def _shared():
+    return caches[settings.USER_CACHE_ALIAS]
+
+
+def _new_version():
+    # Versions lost with the cache are not reused, the entries cached
+    # under them stay stale
+    return int(time() * 1000)
+
+
+def get_user_version(user_id):
+    """
+    Current cache version of the user
+    """
+    cache = _shared()
+    key = VERSION_KEY % user_id
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def get_cached_user(user_id):
+    """
+    :Parameters:
+        user_id : (str) uuid of the user
+    :Returns:
+        User object
+    :Raises:
+        User.DoesNotExist
+    """
+    user_id = str(user_id)
+    version = get_user_version(user_id)
+    user = local_users.get(user_id, version)
+    if user is not None:
+        return user
+    key = USER_KEY % (user_id, version)
+    user = _shared().get(key)
+    if user is None:
+        User = get_user_model()
+        user = User.objects.get(uuid=user_id)
+        _shared().set(key, user, settings.USER_CACHE_TIMEOUT)
+    local_users.set(user_id, version, user)
+    return user
+
+
+def invalidate_user(user):
+    """
+    Makes every cached copy of the user stale
+    :Parameters:
+        user : User object
+    """
+    cache = _shared()
+    key = VERSION_KEY % user.pk
+    try:
+        cache.incr(key)
+    except ValueError:
+        # No version yet, start past the one being cached
+        if not cache.add(key, _new_version() + 1, None):
+            cache.incr(key)
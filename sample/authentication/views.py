@@ -1,5 +1,7 @@
 import json
 from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
 from django.views.decorators.cache import never_cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth import get_user_model, login
@@ -19,20 +21,26 @@ from .serializers import (
     EmailSerializer,
     PasswordChangeSerializer,
     ChangeRoleSerializer,
+    RevocableTokenRefreshSerializer,
 )
 from axes.handlers.proxy import AxesProxyHandler
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.views import TokenRefreshView
 from utils.messages import ERR, SCS, EMAIL
-from utils.custom_exceptions import InternalError
+from utils.custom_exceptions import InternalError, ServiceBusy
 from utils.res_handler import CustomResponseLog
 from utils.create_email import make_email
-from .auth_tokens import (
-    generate_token,
-    token_generator,
-    token_decoder,
-    token_decoder2
-)
+from .auth_tokens import token_generator, decode_tokens
 from .models import UserActivationResetToken as OTToken
+from .tokens import (
+    ClaimsRefreshToken,
+    ClaimsUser,
+    RevocableRefreshToken,
+    revoke_access_token,
+)
+from .coalescing import claim_link, release_link
+from .jwt_keys import get_keyring
 
 User = get_user_model()
 
@@ -41,6 +49,7 @@ def _save_tokens(user, token_A, token_B, event):
     """
     Saves the tokens generated upon registration
     reset password and resend activation email.
+    Only the digest of token_B is stored, it is part of every link.
 
     Parameters:
         user: (obj)
@@ -53,19 +62,56 @@ def _save_tokens(user, token_A, token_B, event):
     """
     tokenInfo = OrderedDict()
     tokenInfo['uuid'] = user
-    tokenInfo['token_a'] = token_A
-    tokenInfo['token_b'] = token_B
+    tokenInfo['token'] = token_B
     tokenInfo['event'] = event
     OTToken.objects.save_tokens(**tokenInfo)
 
 
+def _send_link(request, user, event, email_event, invalidate=False):
+    """
+    Makes the tokens of a link and queues its email, unless a link
+    for the event was sent to the user within EMAIL_COALESCE_WINDOW.
+
+    Parameters:
+        request: (obj) to get the requested domain
+        user: (obj)
+        event: (str) OTToken event of the link
+        email_event: (str) EMAIL message
+        invalidate: (bool) invalidate the unused links of the event
+
+    Returns:
+        bool True if an email was queued
+    """
+    if not claim_link(user, event):
+        return False
+    try:
+        token_A, token_B = token_generator(user, event)
+        tokenInfo = OrderedDict()
+        tokenInfo['token_A'] = token_A
+        tokenInfo['token_B'] = token_B
+        msg = EMAIL(email_event)
+        # The email is queued only with its token
+        with transaction.atomic():
+            if invalidate:
+                OTToken.objects.invalidate_token(user, event)
+            _save_tokens(user, token_A, token_B, event)
+            make_email(msg.TITLE, msg.MSG, user.email,
+                        msg.TEMPLATE, tokenInfo, request)
+    except Exception:
+        release_link(user, event)
+        raise
+    return True
+
+
 class APILogin(APIView):
 
     serializer_class = UserLoginSerializer
     permission_classes = [AllowAny]
 
     def get_jwt_token(self, user):
-        authTokens = RefreshToken.for_user(user)
+        if settings.JWT_USER_CLAIMS:
+            return ClaimsRefreshToken.for_user(user)
+        authTokens = RevocableRefreshToken.for_user(user)
         return authTokens
 
     def post(self, request):
@@ -84,7 +130,7 @@ class APILogin(APIView):
             }
             res = CustomResponseLog(self, request, res)
             return Response(res.custom_response())
-        except ValidationError:
+        except (ValidationError, ServiceBusy):
             raise
         except Exception as e:
             if AxesProxyHandler().is_locked(request):
@@ -96,14 +142,27 @@ class APILogin(APIView):
 class APILogout(APIView):
     """
     Logout API
-    Due to the app uses JWT, only the frontend can delete the
-    token to invalidate the users.
+    Revokes the access token of the request and the refresh
+    token posted as `refresh`, the frontend should still delete them.
     """
     permission_classes = [AllowAny,]
 
     def logout(self, request):
         if not request.META.get('HTTP_AUTHORIZATION'):
             raise PermissionDenied(ERR.PERMISSION_DENIED)
+        access = request.auth
+        if access is not None:
+            revoke_access_token(access)
+        if request.data.get('refresh'):
+            try:
+                refresh = RevocableRefreshToken(request.data['refresh'])
+            except TokenError:
+                raise ValidationError(ERR.TOKEN_INVALID)
+            user_claim = api_settings.USER_ID_CLAIM
+            if (access is not None
+                    and refresh.get(user_claim) != access.get(user_claim)):
+                raise PermissionDenied(ERR.PERMISSION_DENIED)
+            refresh.blacklist()
         res = CustomResponseLog(self, request, SCS.LOGOUT)
         return Response(res.custom_response())
 
@@ -126,17 +185,10 @@ class APIRegister(APIView):
                 res = SCS.REGISTER
             else:
                 raise Exception
-            token_A, token_B = token_generator(user)
-            tokenInfo = OrderedDict()
-            tokenInfo['token_A'] = token_A
-            tokenInfo['token_B'] = token_B
-            msg = EMAIL('REGISTER')
-            _save_tokens(user, token_A, token_B, OTToken.ACTIVATE)
-            make_email(msg.TITLE, msg.MSG, user.email,
-                        msg.TEMPLATE, tokenInfo, request)
+            _send_link(request, user, OTToken.ACTIVATE, 'REGISTER')
             res = CustomResponseLog(self, request, res)
             return Response(res.custom_response(), status=201)
-        except ValidationError:
+        except (ValidationError, ServiceBusy):
             raise
         except Exception as e:
             raise InternalError(ERR.SERVER_ERROR, str(e))
@@ -149,19 +201,13 @@ class APIResetPassword(APIView):
 
     def post(self, request):
         try:
-            userInfo = self.serializer_class(data=request.data)
+            userInfo = self.serializer_class(
+                            data=request.data, context=request)
             userInfo.is_valid(raise_exception=True)
-            email = userInfo.data['email']
-            user = User.objects.get(email=email)
-            OTToken.objects.invalidate_token(user, OTToken.RESETPASS)
-            token_A, token_B = token_generator(user)
-            tokenInfo = OrderedDict()
-            tokenInfo['token_A'] = token_A
-            tokenInfo['token_B'] = token_B
-            _save_tokens(user, token_A, token_B, OTToken.RESETPASS)
-            msg = EMAIL('RESET')
-            make_email(msg.TITLE, msg.MSG, user.email,
-                        msg.TEMPLATE, tokenInfo, request)
+            user = userInfo.validated_data['user']
+            # Only the new link is valid once it is sent
+            _send_link(request, user, OTToken.RESETPASS, 'RESET',
+                       invalidate=True)
             res = CustomResponseLog(self, request)
             return Response(res.custom_response())
         except ValidationError:
@@ -177,21 +223,25 @@ class APIChangePassword(APIView):
 
     def post(self, request, token):
         try:
-            user, token = token_decoder2(token, ERR.RST_PSW_INVALID)
-            if not generate_token.check_token(user, token):
-                raise ValidationError(ERR.RST_PSW_INVALID)
+            decoded = decode_tokens(
+                        request, OTToken.RESETPASS, ERR.RST_PSW_INVALID,
+                        token)
+            user = decoded.user
             if 'confirm_password' not in request.data:
                 raise ValidationError(ERR.PASS_NOT_MATCH)
             userInfo = self.serializer_class(data=request.data,
                         context=request.data['confirm_password'])
             userInfo.is_valid(raise_exception=True)
+            # Hashed before the transaction so no lock waits for it
             user.set_password(userInfo.validated_data['confirm_password'])
-            user.save()
-            OTToken.objects.update_used(user, token, OTToken.RESETPASS)
-            res = CustomResponseLog(
-                    self, request, SCS.PSW_RESET, user.email)
+            with transaction.atomic():
+                # Consumed first, of concurrent requests with the same
+                # link only one gets past this
+                OTToken.objects.update_used(user, token, OTToken.RESETPASS)
+                user.save()
+            res = CustomResponseLog(self, request, SCS.PSW_RESET)
             return Response(res.custom_response())
-        except ValidationError:
+        except (ValidationError, ServiceBusy):
             raise
         except SignatureExpired:
             raise ValidationError(ERR.RST_PSW_EXPIRED)
@@ -211,16 +261,11 @@ class ResetTokenURL(APIView):
     @never_cache
     def get(self, request, token_A, token_B):
         try:
-            user, token = token_decoder(token_A, ERR.RST_PSW_INVALID)
-            if not generate_token.check_token(user, token):
-                raise ValidationError(ERR.RST_PSW_INVALID)
-            confirm_user, confirm_token = token_decoder2(
-                                        token_B, ERR.RST_PSW_INVALID)
-            if not generate_token.check_token(confirm_user, confirm_token):
-                raise ValidationError(ERR.RST_PSW_INVALID)
+            decode_tokens(request, OTToken.RESETPASS, ERR.RST_PSW_INVALID,
+                          token_B, token_A)
             tokenInfo = OrderedDict()
             tokenInfo['token'] = token_B
-            res = CustomResponseLog(self, request, tokenInfo, user.email)
+            res = CustomResponseLog(self, request, tokenInfo)
             return Response(res.custom_response(), status=200)
         except ValidationError:
             raise
@@ -242,19 +287,16 @@ class UserActivationUrl(APIView):
     @never_cache
     def get(self, request, token_A, token_B):
         try:
-            user, token = token_decoder(token_A, ERR.ACTIVATION_INVALID)
-            if not generate_token.check_token(user, token):
-                raise ValidationError(ERR.ACTIVATION_INVALID)
-            confirm_user, confirm_token = token_decoder2(
-                                        token_B, ERR.ACTIVATION_INVALID)
-            if not generate_token.check_token(confirm_user, confirm_token):
-                raise ValidationError(ERR.ACTIVATION_INVALID)
+            decoded = decode_tokens(
+                        request, OTToken.ACTIVATE, ERR.ACTIVATION_INVALID,
+                        token_B, token_A)
+            user = decoded.user
             user.is_active = True
             user.save()
             userInfo = OrderedDict()
             userInfo['email'] = user.email
-            OTToken.objects.update_used(user, token, OTToken.ACTIVATE)
-            res = CustomResponseLog(self, request, {}, user.email)
+            OTToken.objects.update_used(user, token_B, OTToken.ACTIVATE)
+            res = CustomResponseLog(self, request, {})
             return Response(res.custom_response(), status=200)
         except SignatureExpired:
             raise ValidationError(ERR.ACTIVATION_EXPIRED)
@@ -276,18 +318,12 @@ class APIResendActivation(APIView):
     def post(self, request):
         try:
             # validate email address
-            emailInfo = self.serializer_class(data=request.data)
+            emailInfo = self.serializer_class(
+                            data=request.data, context=request)
             emailInfo.is_valid(raise_exception=True)
-            email = emailInfo.validated_data.get('email', '')
-            user = User.objects.get(email=email)
-            token_A, token_B = token_generator(user)
-            tokenInfo = OrderedDict()
-            tokenInfo['token_A'] = token_A
-            tokenInfo['token_B'] = token_B
-            msg = EMAIL('ACTV_RESEND')
-            _save_tokens(user, token_A, token_B, OTToken.ACTIVATE)
-            make_email(msg.TITLE, msg.MSG, user.email,
-                        msg.TEMPLATE, tokenInfo, request)
+            user = emailInfo.validated_data['user']
+            # Same response when the last link is reused
+            _send_link(request, user, OTToken.ACTIVATE, 'ACTV_RESEND')
             res = CustomResponseLog(self, request, SCS.ACTV_SENT)
             return Response(res.custom_response(), status=200)
         except ValidationError:
@@ -307,7 +343,12 @@ class APIUserDetail(APIView):
     def get(self, request):
         try:
             email = request.user.email
-            user = User.objects.get(email=email)
+            if isinstance(request.user, ClaimsUser):
+                # Verified token claims, no need to query
+                user = request.user
+            else:
+                # The cached user may predate the last login
+                user = User.objects.get(pk=request.user.pk)
             userInfo = OrderedDict()
             userInfo['email'] = email
             userInfo['role'] = user.role
@@ -333,3 +374,35 @@ class APIUserDetail(APIView):
         except Exception as e:
             raise Exception(ERR.SERVER_ERROR, str(e))
 
+
+class APITokenRefresh(TokenRefreshView):
+    """
+    Token refresh checked against the revocation denylist
+    """
+    serializer_class = RevocableTokenRefreshSerializer
+
+
+class JWKSView(APIView):
+    """
+    Public keys of the JWT signing keys, so other services can verify
+    the access tokens themselves. Cached by the clients for
+    JWKS_MAX_AGE seconds.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny,]
+
+    def get(self, request):
+        keyring = get_keyring()
+        if keyring is None:
+            jwks, etag = {'keys': []}, None
+        else:
+            jwks, etag = keyring.jwks, keyring.etag
+        if etag and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = Response(status=304)
+        else:
+            response = Response(jwks)
+        response['Cache-Control'] = 'public, max-age=%d' % (
+                                        settings.JWKS_MAX_AGE)
+        if etag:
+            response['ETag'] = etag
+        return response
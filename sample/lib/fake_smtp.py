@@ -0,0 +1,136 @@
+"""
+Local SMTP server that accepts every email and keeps it in memory,
+for the tests and the delivery benchmark. Only the commands smtplib
+sends without TLS or login are understood.
+
+    with FakeSMTPServer(connect_delay=0.05) as server:
+        get_connection('django.core.mail.backends.smtp.EmailBackend',
+                       host=server.host, port=server.port)
+        ...
+        server.messages      # list of (mail_from, rcpt_tos, data)
+        server.connections   # connections accepted
+
+connect_delay stands for the TCP/TLS handshake and login of a real
+server, it is slept before the greeting of every connection.
+"""
+import socket
+import threading
+import socketserver
+from time import sleep
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.opened(self.connection)
+        try:
+            if server.connect_delay:
+                sleep(server.connect_delay)
+            self._reply('220 fake ESMTP')
+            mail_from, rcpt_tos = None, []
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command = line.decode('ascii', 'replace').strip()
+                verb = command[:4].upper()
+                if verb == 'EHLO':
+                    self._reply('250-fake')
+                    self._reply('250 8BITMIME')
+                elif verb == 'HELO':
+                    self._reply('250 fake')
+                elif verb == 'MAIL':
+                    mail_from, rcpt_tos = command[10:], []
+                    self._reply('250 OK')
+                elif verb == 'RCPT':
+                    rcpt_tos.append(command[8:])
+                    self._reply('250 OK')
+                elif verb == 'DATA':
+                    self._reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = []
+                    for line in self.rfile:
+                        if line == b'.\r\n':
+                            break
+                        data.append(line)
+                    server.received(mail_from, rcpt_tos, b''.join(data))
+                    self._reply('250 OK')
+                elif verb in ('RSET', 'NOOP'):
+                    mail_from, rcpt_tos = None, []
+                    self._reply('250 OK')
+                elif verb == 'QUIT':
+                    self._reply('221 Bye')
+                    return
+                else:
+                    self._reply('502 Command not implemented')
+        except OSError:
+            # Dropped by drop_connections() or the client
+            pass
+        finally:
+            server.closed(self.connection)
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, connect_delay=0):
+        """
+        :Parameters:
+            port : (int) 0 for a free port
+            connect_delay : (float) seconds before the greeting
+        """
+        super().__init__((host, port), _SMTPHandler)
+        self.host, self.port = self.server_address[:2]
+        self.connect_delay = connect_delay
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._open = set()
+        self._thread = None
+
+    def opened(self, sock):
+        with self._lock:
+            self.connections += 1
+            self._open.add(sock)
+
+    def closed(self, sock):
+        with self._lock:
+            self._open.discard(sock)
+
+    def received(self, mail_from, rcpt_tos, data):
+        with self._lock:
+            self.messages.append((mail_from, rcpt_tos, data))
+
+    def drop_connections(self):
+        """
+        Close the open connections as a server restart would
+        """
+        with self._lock:
+            open_socks = list(self._open)
+        for sock in open_socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name='fake-smtp', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
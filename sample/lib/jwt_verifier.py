@@ -0,0 +1,113 @@
+"""
+Verifies the access tokens of the login system in other services,
+without calling back into it. Only needs PyJWT and cryptography,
+Django is not required.
+
+    from jwt_verifier import JWKSVerifier
+
+    verifier = JWKSVerifier('https://login.example.com/.well-known/jwks.json')
+    claims = verifier.verify(token)   # raises jwt.InvalidTokenError
+
+The JWKS is cached for the max-age the endpoint sends. A token signed
+with an unknown kid (a key rotated in after the last fetch) triggers
+one refetch, at most every `min_refresh` seconds.
+"""
+import re
+import json
+import threading
+from time import time
+from urllib.request import urlopen
+import jwt
+from jwt.algorithms import RSAAlgorithm, OKPAlgorithm
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def _fetch(url, timeout=5):
+    """
+    :Returns:
+        jwks : (dict)
+        max_age : (int) None if the response did not say
+    """
+    with urlopen(url, timeout=timeout) as response:
+        match = MAX_AGE.search(response.headers.get('Cache-Control', ''))
+        return (json.loads(response.read().decode('utf-8')),
+                int(match.group(1)) if match else None)
+
+
+class JWKSVerifier():
+
+    def __init__(self, jwks_url, audience=None, issuer=None,
+                 token_type='access', cache_ttl=300, min_refresh=30,
+                 fetch=_fetch):
+        """
+        :Parameters:
+            jwks_url : (str) /.well-known/jwks.json of the login system
+            audience : (str) expected aud claim, if any
+            issuer : (str) expected iss claim, if any
+            token_type : (str) expected token_type claim, None to skip
+            cache_ttl : (int) seconds to keep the keys when the endpoint
+                        sends no max-age
+            min_refresh : (int) minimum seconds between two fetches
+            fetch : (function) url -> (jwks, max_age), for testing
+        """
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.issuer = issuer
+        self.token_type = token_type
+        self.cache_ttl = cache_ttl
+        self.min_refresh = min_refresh
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._expires = 0
+        self._fetched = 0
+
+    def _load(self, force=False):
+        now = time()
+        with self._lock:
+            if not force and now < self._expires:
+                return
+            if force and now - self._fetched < self.min_refresh:
+                return
+            jwks, max_age = self.fetch(self.jwks_url)
+            keys = {}
+            for jwk in jwks.get('keys', []):
+                data = json.dumps(jwk)
+                if jwk.get('kty') == 'OKP':
+                    keys[jwk['kid']] = (jwk['alg'],
+                                        OKPAlgorithm.from_jwk(data))
+                else:
+                    keys[jwk['kid']] = (jwk['alg'],
+                                        RSAAlgorithm.from_jwk(data))
+            self._keys = keys
+            self._fetched = now
+            self._expires = now + (
+                max_age if max_age is not None else self.cache_ttl)
+
+    def _key(self, kid):
+        self._load()
+        if kid not in self._keys:
+            self._load(force=True)
+        if kid not in self._keys:
+            raise jwt.InvalidTokenError('Unknown signing key %s' % kid)
+        return self._keys[kid]
+
+    def verify(self, token):
+        """
+        :Parameters:
+            token : (str) access token
+        :Returns:
+            dict verified claims
+        :Raises:
+            jwt.InvalidTokenError
+        """
+        kid = jwt.get_unverified_header(token).get('kid')
+        algorithm, key = self._key(kid)
+        claims = jwt.decode(
+            token, key, algorithms=[algorithm],
+            audience=self.audience, issuer=self.issuer,
+            options={'verify_aud': self.audience is not None})
+        if self.token_type and claims.get('token_type') != self.token_type:
+            raise jwt.InvalidTokenError('Token has wrong type')
+        return claims
@@ -45,5 +45,133 @@ DEFAULT_FROM_EMAIL = 'Sample <sample@gmail.com>'
 PROTOCOL = 'http'
 
 # AXES CONFIG
+# Cooldown in minutes
 AXES_COOLDOWN = 60
 AXES_LIMIT = 5
+# Failed attempt counters, 'local' to the worker or 'shared' by the
+# workers of the host through AXES_STORE_PATH
+AXES_STORE = 'shared'
+AXES_STORE_PATH = os.path.join(os.path.abspath('.'), 'run', 'axes.bin')
+AXES_STORE_SLOTS = 65536
+
+# RATE LIMITS
+# Token buckets per url name, keyed by client ip and/or submitted email
+RATE_LIMITS = {
+    'users-api:login': {
+        'rate': 20, 'period': 60, 'burst': 20, 'keys': ('ip', 'email')},
+    'users-api:register': {
+        'rate': 20, 'period': 60, 'burst': 20, 'keys': ('ip',)},
+    'reset-password': {
+        'rate': 5, 'period': 60, 'burst': 5, 'keys': ('ip', 'email')},
+    'resend-activation': {
+        'rate': 5, 'period': 60, 'burst': 5, 'keys': ('ip', 'email')},
+}
+# Cache used to share the consumption between workers
+RATE_LIMIT_CACHE = 'default'
+RATE_LIMIT_SYNC_INTERVAL = 1
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+# AUTHENTICATED USER CACHE
+# Use a shared backend (memcached, redis) when running several workers
+USER_CACHE_ALIAS = 'default'
+# Seconds a user is cached, by the worker and by the shared cache
+USER_CACHE_TIMEOUT = 300
+USER_CACHE_LOCAL_SIZE = 10000
+
+# REVOKED TOKENS
+# Denied jtis are shared through this cache, use a shared backend
+# when running several workers
+REVOCATION_CACHE_ALIAS = 'default'
+REVOCATION_LOCAL_SIZE = 100000
+# Seconds between the loads of the new revocations from the database
+# by every worker, None to only load them on start
+REVOCATION_SYNC_INTERVAL = 5
+# Seconds a blacklisted token row can take to commit, token buffer
+# flushes included, plus the clock skew between the hosts
+REVOCATION_SYNC_OVERLAP = 60
+# OutstandingToken/BlacklistedToken rows are inserted in batches
+TOKEN_BUFFER_DIR = os.path.join(os.path.abspath('.'), 'run', 'token_spool')
+TOKEN_BUFFER_MAX_SIZE = 200
+TOKEN_BUFFER_MAX_DELAY = 2
+
+# TOKEN COMPACTION
+# Seconds between the in-process runs, None to only run
+# `manage.py compact_tokens` from cron
+TOKEN_COMPACTION_INTERVAL = 3600
+TOKEN_COMPACTION_CHUNK_SIZE = 500
+TOKEN_COMPACTION_PAUSE = 0.05
+# Sent emails are deleted with the tokens after this many seconds
+EMAIL_OUTBOX_KEEP_SENT = 604800
+
+# EMAIL OUTBOX
+# Emails are queued by the requests and sent by `manage.py send_emails`
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_POLL_INTERVAL = 1
+# Seconds a worker holds the emails it claimed
+EMAIL_OUTBOX_LEASE = 300
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_RETRY_BASE = 30
+EMAIL_OUTBOX_RETRY_MAX = 3600
+# Open EMAIL_BACKEND connections per worker process, reused for
+# EMAIL_POOL_MAX_IDLE seconds or EMAIL_POOL_MAX_MESSAGES emails
+EMAIL_POOL_SIZE = 4
+EMAIL_POOL_BATCH_SIZE = 25
+EMAIL_POOL_MAX_IDLE = 30
+EMAIL_POOL_MAX_MESSAGES = 100
+# Seconds a sent activation/reset link is reused for the repeated
+# requests of the user, 0 to send a new link every time
+EMAIL_COALESCE_WINDOW = 300
+
+# ACTIVATION / RESET PASSWORD TOKENS
+# Seconds the links are valid
+AUTH_TOKEN_MAX_AGE = 86400
+# Accept the links of the format used before the compact tokens,
+# can be turned off a day after the upgrade
+AUTH_TOKEN_ACCEPT_LEGACY = True
+
+# Put email, role and a version in the access token so the user
+# detail is answered from the token claims
+JWT_USER_CLAIMS = False
+
+# JWT SIGNING
+# HS256 signs with SECRET_SALT. RS256/RS384/RS512/EdDSA sign with the
+# newest key of JWT_KEY_DIR, see `manage.py rotate_jwt_keys`.
+JWT_ALGORITHM = 'HS256'
+JWT_KEY_DIR = os.path.join(os.path.abspath('.'), 'keys')
+JWKS_MAX_AGE = 300
+
+# PASSWORD HASHING
+# utils.hash_executor.InlineHashExecutor hashes in the request thread
+PASSWORD_HASH_EXECUTOR = 'utils.hash_executor.ProcessPoolHashExecutor'
+HASH_POOL_WORKERS = 2
+HASH_POOL_MAX_PENDING = 16
+HASH_POOL_TIMEOUT = 10
+# Seconds between the queue depth and latency log lines of a process,
+# None to turn them off
+HASH_METRICS_INTERVAL = 60
+
+# EMAIL EXISTENCE FILTER
+# Shared by the workers of the host through a memory-mapped file
+EMAIL_FILTER_ENABLED = True
+EMAIL_FILTER_PATH = os.path.join(
+    os.path.abspath('.'), 'run', 'email_filter.bin')
+EMAIL_FILTER_CAPACITY = 1000000
+EMAIL_FILTER_ERROR_RATE = 0.001
+
+# SUCCESS LOGS
+# Share of the successful requests logged, per view class name
+SUCCESS_LOG_SAMPLE_RATE = 1
+SUCCESS_LOG_SAMPLE_RATES = {
+    'APIUserDetail': 0.01,
+}
+# Seconds between the per view roll-ups (requests, errors, latency
+# percentiles), None to turn them off. Errors are always logged.
+SUCCESS_LOG_ROLLUP_INTERVAL = 60
+
+# PASSWORD HASHER PROFILE
+# Generated by `manage.py calibrate_hashers --target-ms 250`
+PASSWORD_HASHER_PROFILE = {
+    'pbkdf2_sha256': {'iterations': 150000},
+    'pbkdf2_sha1': {'iterations': 150000},
+}
+# END PASSWORD HASHER PROFILE
@@ -1,5 +1,6 @@
 import os
 import importlib
+from datetime import timedelta
 from .site_logger import *
 from ._aws import *
 
@@ -39,6 +40,11 @@ if DEBUG:
 ALLOWED_HOSTS = MODULE.ALLOWED_HOSTS
 SIMPLE_JWT = MODULE.SIMPLE_JWT
 SIMPLE_JWT['SIGNING_KEY'] = SECRET_SALT
+# Asymmetric algorithms replace the simplejwt token backend,
+# see authentication.jwt_keys
+JWT_ALGORITHM = MODULE.JWT_ALGORITHM
+JWT_KEY_DIR = MODULE.JWT_KEY_DIR
+JWKS_MAX_AGE = MODULE.JWKS_MAX_AGE
 
 # EMAIL SETTINGS
 EMAIL_BACKEND = MODULE.EMAIL_BACKEND
@@ -52,6 +58,79 @@ DEFAULT_FROM_EMAIL = MODULE.DEFAULT_FROM_EMAIL
 PROTOCOL = MODULE.PROTOCOL
 
 DATABASES = MODULE.DATABASES
+
+# RATE LIMIT SETTINGS
+RATE_LIMITS = MODULE.RATE_LIMITS
+RATE_LIMIT_CACHE = MODULE.RATE_LIMIT_CACHE
+RATE_LIMIT_SYNC_INTERVAL = MODULE.RATE_LIMIT_SYNC_INTERVAL
+RATE_LIMIT_MAX_BUCKETS = MODULE.RATE_LIMIT_MAX_BUCKETS
+
+# USER CACHE SETTINGS
+USER_CACHE_ALIAS = MODULE.USER_CACHE_ALIAS
+USER_CACHE_TIMEOUT = MODULE.USER_CACHE_TIMEOUT
+USER_CACHE_LOCAL_SIZE = MODULE.USER_CACHE_LOCAL_SIZE
+JWT_USER_CLAIMS = MODULE.JWT_USER_CLAIMS
+
+# ACTIVATION / RESET PASSWORD TOKEN SETTINGS
+AUTH_TOKEN_MAX_AGE = MODULE.AUTH_TOKEN_MAX_AGE
+AUTH_TOKEN_ACCEPT_LEGACY = MODULE.AUTH_TOKEN_ACCEPT_LEGACY
+
+# TOKEN COMPACTION SETTINGS
+TOKEN_COMPACTION_INTERVAL = MODULE.TOKEN_COMPACTION_INTERVAL
+TOKEN_COMPACTION_CHUNK_SIZE = MODULE.TOKEN_COMPACTION_CHUNK_SIZE
+TOKEN_COMPACTION_PAUSE = MODULE.TOKEN_COMPACTION_PAUSE
+EMAIL_OUTBOX_KEEP_SENT = MODULE.EMAIL_OUTBOX_KEEP_SENT
+
+# EMAIL OUTBOX SETTINGS
+EMAIL_OUTBOX_BATCH_SIZE = MODULE.EMAIL_OUTBOX_BATCH_SIZE
+EMAIL_OUTBOX_POLL_INTERVAL = MODULE.EMAIL_OUTBOX_POLL_INTERVAL
+EMAIL_OUTBOX_LEASE = MODULE.EMAIL_OUTBOX_LEASE
+EMAIL_OUTBOX_MAX_ATTEMPTS = MODULE.EMAIL_OUTBOX_MAX_ATTEMPTS
+EMAIL_OUTBOX_RETRY_BASE = MODULE.EMAIL_OUTBOX_RETRY_BASE
+EMAIL_OUTBOX_RETRY_MAX = MODULE.EMAIL_OUTBOX_RETRY_MAX
+EMAIL_POOL_SIZE = MODULE.EMAIL_POOL_SIZE
+EMAIL_POOL_BATCH_SIZE = MODULE.EMAIL_POOL_BATCH_SIZE
+EMAIL_POOL_MAX_IDLE = MODULE.EMAIL_POOL_MAX_IDLE
+EMAIL_POOL_MAX_MESSAGES = MODULE.EMAIL_POOL_MAX_MESSAGES
+EMAIL_COALESCE_WINDOW = MODULE.EMAIL_COALESCE_WINDOW
+
+# SUCCESS LOG SETTINGS
+SUCCESS_LOG_SAMPLE_RATE = MODULE.SUCCESS_LOG_SAMPLE_RATE
+SUCCESS_LOG_SAMPLE_RATES = MODULE.SUCCESS_LOG_SAMPLE_RATES
+SUCCESS_LOG_ROLLUP_INTERVAL = MODULE.SUCCESS_LOG_ROLLUP_INTERVAL
+
+# TOKEN REVOCATION SETTINGS
+REVOCATION_CACHE_ALIAS = MODULE.REVOCATION_CACHE_ALIAS
+REVOCATION_LOCAL_SIZE = MODULE.REVOCATION_LOCAL_SIZE
+REVOCATION_SYNC_INTERVAL = MODULE.REVOCATION_SYNC_INTERVAL
+REVOCATION_SYNC_OVERLAP = MODULE.REVOCATION_SYNC_OVERLAP
+TOKEN_BUFFER_DIR = MODULE.TOKEN_BUFFER_DIR
+TOKEN_BUFFER_MAX_SIZE = MODULE.TOKEN_BUFFER_MAX_SIZE
+TOKEN_BUFFER_MAX_DELAY = MODULE.TOKEN_BUFFER_MAX_DELAY
+
+# PASSWORD HASHING SETTINGS
+PASSWORD_HASH_EXECUTOR = MODULE.PASSWORD_HASH_EXECUTOR
+HASH_POOL_WORKERS = MODULE.HASH_POOL_WORKERS
+HASH_POOL_MAX_PENDING = MODULE.HASH_POOL_MAX_PENDING
+HASH_POOL_TIMEOUT = MODULE.HASH_POOL_TIMEOUT
+HASH_METRICS_INTERVAL = MODULE.HASH_METRICS_INTERVAL
+# Cost of each hasher, see `manage.py calibrate_hashers`
+PASSWORD_HASHER_PROFILE = MODULE.PASSWORD_HASHER_PROFILE
+
+# EMAIL FILTER SETTINGS
+EMAIL_FILTER_ENABLED = MODULE.EMAIL_FILTER_ENABLED
+EMAIL_FILTER_PATH = MODULE.EMAIL_FILTER_PATH
+EMAIL_FILTER_CAPACITY = MODULE.EMAIL_FILTER_CAPACITY
+EMAIL_FILTER_ERROR_RATE = MODULE.EMAIL_FILTER_ERROR_RATE
+
+# First hasher is used for new passwords, the rest can still verify
+# and get upgraded on login.
+PASSWORD_HASHERS = [
+    'authentication.hashers.ProfiledPBKDF2PasswordHasher',
+    'authentication.hashers.ProfiledPBKDF2SHA1PasswordHasher',
+    'authentication.hashers.ProfiledArgon2PasswordHasher',
+    'authentication.hashers.ProfiledBCryptSHA256PasswordHasher',
+]
  
 # AUTH MODEL
 AUTH_USER_MODEL = 'authentication.User'
@@ -74,7 +153,7 @@ INSTALLED_APPS = [
 # DRF SETTINGS
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'authentication.authentication.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -96,9 +175,6 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
     },
-    'axes_cache': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-    }
     # "redis": {
     #     "BACKEND": "django_redis.cache.RedisCache",
     #     "LOCATION": "redis://127.0.0.1:6379/1",
@@ -108,12 +184,21 @@ CACHES = {
     # }
 }
 
-AXES_CACHE = 'axes_cache'
+# AXES SETTINGS
+# Lockouts are counted in utils.attempt_store, not in the database
+AXES_HANDLER = 'authentication.handlers.AxesAttemptStoreHandler'
+AXES_FAILURE_LIMIT = MODULE.AXES_LIMIT
+AXES_COOLOFF_TIME = timedelta(minutes=MODULE.AXES_COOLDOWN)
+AXES_STORE = MODULE.AXES_STORE
+AXES_STORE_PATH = MODULE.AXES_STORE_PATH
+AXES_STORE_SLOTS = MODULE.AXES_STORE_SLOTS
 
 MIDDLEWARE = [
+    'utils.log_sampling.LogRollupMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'utils.rate_limit.RateLimitMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -25,13 +25,17 @@ logging.config.dictConfig({
         'django.server': DEFAULT_LOGGING['formatters']['django.server'],
     },
     'handlers': {
+        # NDJSON segments written by a background thread, see
+        # utils.ndjson_log and `manage.py read_logs`
         'logfile': {
-            'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
-            'filename': os.path.join(LOG_DIR, 'server.log'),
-            'maxBytes': 50000,
-            'backupCount': 2,
-            'formatter': 'standard',
+            'level': 'INFO',
+            'class': 'utils.ndjson_log.NDJSONFileHandler',
+            'directory': LOG_DIR,
+            'prefix': 'server',
+            'max_bytes': 64 * 1024 * 1024,
+            'max_age': 3600,
+            'backup_count': 48,
+            'compress': True,
         },
         # console logs to stderr
         'console': {
@@ -39,26 +43,32 @@ logging.config.dictConfig({
             'class': 'logging.StreamHandler',
             'formatter': 'standard'
         },
+        # Sent by a background thread, see utils.log_pipeline
         'logstash': {
             'level': 'INFO',
-            'class': 'logstash.TCPLogstashHandler',
+            'class': 'utils.log_pipeline.QueueLogstashHandler',
             'host': 'localhost',
             'port': 5959,
             'version': 1,
             'message_type': 'django',
             'fqdn': False,
             'tags': ['django.request'],
+            'max_queue': 10000,
+            'batch_size': 500,
+            'flush_interval': 1.0,
+            'spill_dir': os.path.join(LOG_DIR, 'spill'),
+            'spill_max_bytes': 100 * 1024 * 1024,
         },
         'django.server': DEFAULT_LOGGING['handlers']['django.server'],
     },
     'loggers': {
         '': {
             'level': 'INFO',
-            'handlers': ['console', 'logstash'],
+            'handlers': ['console', 'logstash', 'logfile'],
         },
         'authentication': {
             'level': LOGLEVEL,
-            'handlers': ['console', 'logstash'],
+            'handlers': ['console', 'logstash', 'logfile'],
             'propagate': False,
         },
         'axes':  {
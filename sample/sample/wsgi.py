@@ -14,3 +14,24 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sample.settings.settings')
 
 application = get_wsgi_application()
+
+# Rebuild the shared email filter from the users table on startup
+from utils.email_filter import get_email_filter  # noqa: E402
+get_email_filter().rebuild()
+
+# Compile the email templates before the first request
+from utils.create_email import precompile_email_templates  # noqa: E402
+precompile_email_templates()
+
+# Write the token rows spooled by crashed workers, then load the
+# revoked tokens into the denylist and keep loading the new ones
+from django.conf import settings  # noqa: E402
+from authentication.token_buffer import replay_spools  # noqa: E402
+from authentication.revocation import denylist  # noqa: E402
+replay_spools(settings.TOKEN_BUFFER_DIR)
+denylist.rebuild()
+denylist.start_sync(settings.REVOCATION_SYNC_INTERVAL)
+
+# Delete the expired token rows every TOKEN_COMPACTION_INTERVAL
+from authentication.compaction import start_scheduler  # noqa: E402
+start_scheduler()
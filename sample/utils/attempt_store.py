@@ -0,0 +1,171 @@
+"""
+Fixed memory sliding-window counters for failed login attempts.
+Used by authentication.handlers.AxesAttemptStoreHandler so the lockout
+bookkeeping never touches the database.
+
+Every key is hashed into `depth` rows of `slots` counters (count-min
+sketch), the count of a key is the smallest of its counters. A slot
+holds the counts of the current and previous window, the count over
+the last `window` seconds is estimated from both. Collisions can only
+over-count.
+
+Like the AccessAttempt rows of axes, the count a key reached is kept
+until `window` seconds after its last attempt, so a lockout lasts the
+whole cool-off even when it crosses a window boundary.
+
+LocalAttemptStore keeps the counters in the worker process,
+SharedAttemptStore keeps them in a memory-mapped file shared by all
+the workers of the host.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+from time import time
+from contextlib import contextmanager
+
+# window number, count of the window, count of the previous window,
+# time of the last attempt, count reached by it
+SLOT = struct.Struct('<IHHIH')
+MAX_COUNT = 0xFFFF
+
+
+class AttemptStore():
+
+    def __init__(self, window, slots=65536, depth=2):
+        """
+        :Parameters:
+            window : (int) seconds attempts are counted for
+            slots : (int) counters per row
+            depth : (int) rows, more rows means less over-counting
+        """
+        self.window = window
+        self.slots = slots
+        self.depth = depth
+        self.size = SLOT.size * slots * depth
+        self._thread_lock = threading.Lock()
+        self._buffer = None
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            yield
+
+    def _offsets(self, key):
+        digest = hashlib.blake2b(
+                    key.encode(), digest_size=8 * self.depth).digest()
+        hashes = struct.unpack('<%dQ' % self.depth, digest)
+        return [
+            (row * self.slots + h % self.slots) * SLOT.size
+            for row, h in enumerate(hashes)
+        ]
+
+    def _read(self, offset, now):
+        """
+        Read a slot, rolled forward to the window of now
+        :Returns:
+            window, current, previous, last, reached
+        """
+        window = int(now // self.window)
+        slot_window, current, previous, last, reached = SLOT.unpack_from(
+                                                    self._buffer, offset)
+        if slot_window == window:
+            return window, current, previous, last, reached
+        if slot_window == window - 1:
+            return window, 0, current, last, reached
+        return window, 0, 0, last, reached
+
+    def _estimate(self, now, current, previous, last, reached):
+        elapsed = (now % self.window) / self.window
+        count = int(previous * (1 - elapsed) + current)
+        if now < last + self.window:
+            # Not decayed within window of the last attempt
+            count = max(count, reached)
+        return count
+
+    def get(self, key, now=None):
+        """
+        Number of attempts of key in the last window
+        """
+        now = now or time()
+        with self._locked():
+            return min(
+                self._estimate(now, *self._read(offset, now)[1:])
+                for offset in self._offsets(key)
+            )
+
+    def incr(self, key, now=None):
+        """
+        Record one attempt of key
+        :Returns:
+            int number of attempts in the last window
+        """
+        now = now or time()
+        counts = []
+        with self._locked():
+            for offset in self._offsets(key):
+                window, current, previous, last, reached = self._read(
+                                                            offset, now)
+                reached = min(
+                    self._estimate(now, current, previous, last, reached)
+                    + 1, MAX_COUNT)
+                current = min(current + 1, MAX_COUNT)
+                SLOT.pack_into(self._buffer, offset, window, current,
+                               previous, int(now), reached)
+                counts.append(reached)
+        return min(counts)
+
+    def reset(self, key):
+        """
+        Clear the counters of key. Keys sharing a counter are
+        cleared as well, which can only under-count them once.
+        """
+        with self._locked():
+            for offset in self._offsets(key):
+                SLOT.pack_into(self._buffer, offset, 0, 0, 0, 0, 0)
+
+    def clear(self):
+        with self._locked():
+            self._buffer[:] = bytes(self.size)
+
+
+class LocalAttemptStore(AttemptStore):
+    """ Counters of this worker process only """
+
+    def __init__(self, window, **kwargs):
+        super().__init__(window, **kwargs)
+        self._buffer = bytearray(self.size)
+
+
+class SharedAttemptStore(AttemptStore):
+    """ Counters shared by the workers through a memory-mapped file """
+
+    def __init__(self, window, path, **kwargs):
+        super().__init__(window, **kwargs)
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != self.size:
+                # New file or sized for other settings, start over
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self._buffer = mmap.mmap(fd, self.size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    @contextmanager
+    def _locked(self):
+        # flock does not exclude threads sharing the descriptor
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
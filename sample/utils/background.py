@@ -0,0 +1,34 @@
+"""
+Runs small jobs outside of the request thread.
+Meant for writes the response does not depend on, e.g. upgrading a
+password hash after a successful login.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_pool = ThreadPoolExecutor(max_workers=1)
+
+
+def _run(func, *args):
+    try:
+        func(*args)
+    except Exception as e:
+        logger.exception('Background job %s failed: %s', func.__name__, e)
+    finally:
+        # Each worker thread has its own connection
+        connection.close()
+
+
+def run_in_background(func, *args):
+    """
+    Schedule func(*args) on the background worker
+    :Parameters:
+        func : (function)
+        args : arguments of func
+    :Returns:
+        Future
+    """
+    return _pool.submit(_run, func, *args)
@@ -1,16 +1,77 @@
 """ Pluggable email function. """
 from collections import OrderedDict
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.template import engines, Context
 from django.contrib.sites.shortcuts import get_current_site
 from sample.settings.settings import PROTOCOL, DEFAULT_FROM_EMAIL
+from authentication.models import EmailOutbox
+from utils.messages import EMAIL
+
+# Hosts whose domain is cached, ALLOWED_HOSTS normally bounds them
+MAX_HOSTS = 64
+
+_templates = {}
+_domains = {}
+
+
+def get_email_template(name):
+    """
+    Compiled email template, loaded once per process. Edited templates
+    are picked up on restart.
+    :Parameters:
+        name : (str) template name
+    :Returns:
+        django.template.Template
+    """
+    template = _templates.get(name)
+    if template is None:
+        template = engines['django'].engine.get_template(name)
+        _templates[name] = template
+    return template
+
+
+def precompile_email_templates():
+    """
+    Compile the templates of the EMAIL messages before the first request
+    """
+    for info in EMAIL.messages.values():
+        get_email_template(info['TEMPLATE'])
+
+
+def site_domain(request):
+    """
+    Domain the links of the emails point to, resolved once per host
+    :Parameters:
+        request: (obj) to get the requested domain
+    :Returns:
+        str
+    """
+    host = request.get_host()
+    domain = _domains.get(host)
+    if domain is None:
+        domain = get_current_site(request).domain
+        if len(_domains) < MAX_HOSTS:
+            _domains[host] = domain
+    return domain
+
+
+def render_email(template, params):
+    """
+    Render a compiled email template without the context processors
+    :Parameters:
+        template: (str) template email
+        params: (dict) values for the email template
+    :Returns:
+        str
+    """
+    return get_email_template(template).render(Context(params))
 
 
 def make_email(subject, message, to_email, template, options, request):
     """
     For sending emails.
     Build the emails parameters then render it to the templates
-    for output.
+    for output. The email is queued in the outbox and sent by
+    `manage.py send_emails`, call it in the transaction of the tokens.
 
     Parameters:
         subject: (str) email subject
@@ -20,18 +81,17 @@ def make_email(subject, message, to_email, template, options, request):
         options: (dict) dictionary of values for the email template
         request: (obj) to get the requested domain
     """
-    current_site = get_current_site(request)
     emailInfo = OrderedDict()
     emailInfo['subject'] = subject
     emailInfo['message'] = message
-    emailInfo['recipient_list'] = [to_email]
+    emailInfo['to_email'] = to_email
     emailInfo['from_email'] = DEFAULT_FROM_EMAIL
     params = {
         'email_id': to_email,
-        'domain': current_site.domain,
+        'domain': site_domain(request),
         'protocol': PROTOCOL,
     }
     if options:
         params.update(options)
-    emailInfo['html_message'] = render_to_string(template, params)
-    send_mail(**emailInfo)
+    emailInfo['html_message'] = render_email(template, params)
+    EmailOutbox.objects.enqueue(**emailInfo)
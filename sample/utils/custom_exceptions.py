@@ -11,4 +11,16 @@ class InternalError(APIException):
     def __init__(self, message, error):
         self.detail = message
         self.error = error
-        
\ No newline at end of file
+        
+
+class ServiceBusy(APIException):
+    """
+    Raised when a bounded resource (e.g. the password hashing pool)
+    is full. Returned right away instead of waiting in the queue.
+    """
+
+    status_code = 503
+    code = 'ServiceUnavailable'
+
+    def __init__(self, message):
+        self.detail = message
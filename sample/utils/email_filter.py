@@ -0,0 +1,202 @@
+"""
+Bloom filter of the registered email addresses.
+Answers "definitely not registered" without a query to the users
+table. A positive answer still has to be confirmed by the database.
+
+The bits live in a memory-mapped file (settings.EMAIL_FILTER_PATH) so
+all the workers of the host share one filter. It is rebuilt from the
+users table when the server starts (see sample/wsgi.py) or with
+`manage.py rebuild_email_filter`, and updated by UserManager._create.
+A missing filter is rebuilt in the background, the database answers
+meanwhile.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+from math import ceil, log
+from django.conf import settings
+from utils.background import run_in_background
+
+MAGIC = b'EMBF'
+VERSION = 1
+# magic, version, number of hashes, number of bits
+HEADER = struct.Struct('<4sHHQ')
+
+
+def normalize(email):
+    """
+    MySQL compares emails case-insensitively so the filter does too
+    """
+    return email.strip().lower()
+
+
+def filter_size(capacity, error_rate):
+    """
+    Optimal number of bits and hashes
+    :Parameters:
+        capacity : (int) expected number of emails
+        error_rate : (float) false positive rate at capacity
+    :Returns:
+        bits : (int)
+        hashes : (int)
+    """
+    bits = ceil(-capacity * log(error_rate) / (log(2) ** 2))
+    bits = ceil(bits / 8) * 8
+    hashes = max(1, round(bits / capacity * log(2)))
+    return bits, hashes
+
+
+class EmailFilter():
+
+    def __init__(self, path, capacity, error_rate):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.bits, self.hashes = filter_size(capacity, error_rate)
+        self._map = None
+        self._inode = None
+        self._rebuilding = threading.Lock()
+
+    def _positions(self, email):
+        digest = hashlib.blake2b(
+                    normalize(email).encode(), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _lock(self):
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        lock = open(self.lock_path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _open(self):
+        """
+        Map the filter file, (re)mapping it if it was replaced by a
+        rebuild in another process.
+        :Returns:
+            bool False if there is no filter file yet
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+        if inode == self._inode:
+            return True
+        with open(self.path, 'r+b') as f:
+            _map = mmap.mmap(f.fileno(), 0)
+        magic, version, hashes, bits = HEADER.unpack_from(_map)
+        if (magic, version, hashes, bits) != (
+                MAGIC, VERSION, self.hashes, self.bits):
+            # Built with other settings, unusable until rebuilt
+            _map.close()
+            return False
+        # The old map is not closed, request threads may still read it.
+        # It is unmapped once the last of them drops it.
+        self._map = _map
+        self._inode = inode
+        return True
+
+    def might_contain(self, email):
+        """
+        :Returns:
+            bool False if the email is definitely not registered
+        """
+        if not self._open():
+            # No usable filter, the database answers until the
+            # background rebuild swaps one in
+            if self._rebuilding.acquire(blocking=False):
+                run_in_background(self._rebuild_missing)
+            return True
+        # Same map for every position even if a rebuild swaps it
+        _map = self._map
+        offset = HEADER.size
+        for pos in self._positions(email):
+            if not _map[offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, email):
+        lock = self._lock()
+        try:
+            if not self._open():
+                return
+            _map = self._map
+            offset = HEADER.size
+            for pos in self._positions(email):
+                _map[offset + (pos >> 3)] |= 1 << (pos & 7)
+        finally:
+            lock.close()
+
+    def _rebuild_missing(self):
+        try:
+            self.rebuild(force=False)
+        finally:
+            self._rebuilding.release()
+
+    def rebuild(self, emails=None, force=True):
+        """
+        Build a new filter file from the users table and swap it in.
+        :Parameters:
+            emails : (iterable) defaults to every registered email
+            force : (bool) False to skip it when another process built
+                a usable filter while this one waited for the lock
+        :Returns:
+            int number of emails added
+        """
+        lock = self._lock()
+        try:
+            if not force and self._open():
+                return 0
+            if emails is None:
+                from authentication.models import User
+                emails = User.objects.values_list(
+                            'email', flat=True).iterator()
+            data = bytearray(self.bits // 8)
+            count = 0
+            for email in emails:
+                for pos in self._positions(email):
+                    data[pos >> 3] |= 1 << (pos & 7)
+                count += 1
+            tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, self.hashes, self.bits))
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        finally:
+            lock.close()
+        return count
+
+
+class _DisabledFilter():
+    """ Used when EMAIL_FILTER_ENABLED is off, always asks the DB """
+
+    def might_contain(self, email):
+        return True
+
+    def add(self, email):
+        pass
+
+    def rebuild(self, emails=None, force=True):
+        return 0
+
+
+_filter = None
+
+
+def get_email_filter():
+    """
+    Returns the email filter, created once per process.
+    """
+    global _filter
+    if _filter is None:
+        if settings.EMAIL_FILTER_ENABLED:
+            _filter = EmailFilter(settings.EMAIL_FILTER_PATH,
+                                  settings.EMAIL_FILTER_CAPACITY,
+                                  settings.EMAIL_FILTER_ERROR_RATE)
+        else:
+            _filter = _DisabledFilter()
+    return _filter
@@ -0,0 +1,220 @@
+"""
+Pluggable executor for password hashing.
+PBKDF2 is the most expensive work done per request, this moves it
+off the request thread (ProcessPoolHashExecutor) and bounds the number
+of hashes waiting so a login burst fails fast with 503 instead of
+queueing every other endpoint behind it.
+
+The executor is selected with settings.PASSWORD_HASH_EXECUTOR and
+is used by User.check_password and User.set_password.
+
+The queue depth and hash latency counters of metrics() are logged by
+every process every HASH_METRICS_INTERVAL seconds, as a JSON line with
+"message": "HASH_METRICS" (see `manage.py read_logs`).
+"""
+import os
+import logging
+import threading
+import simplejson as json
+from time import sleep, monotonic
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.utils.module_loading import import_string
+from utils.custom_exceptions import ServiceBusy
+from utils.messages import ERR
+
+logger = logging.getLogger(__name__)
+
+
+def _make_password(raw_password):
+    """ Runs in the worker process """
+    return hashers.make_password(raw_password)
+
+
+def _check_password(raw_password, encoded):
+    """ Runs in the worker process """
+    return hashers.check_password(raw_password, encoded)
+
+
+def _must_update(encoded):
+    """
+    Same rule as django's check_password, without hashing.
+    :Parameters:
+        encoded : (str) stored password hash
+    :Returns:
+        bool
+    """
+    preferred = hashers.get_hasher('default')
+    hasher = hashers.identify_hasher(encoded)
+    return (hasher.algorithm != preferred.algorithm
+            or preferred.must_update(encoded))
+
+
+class HashExecutor():
+    """
+    Base executor, hashes on the calling thread.
+    Keeps track of the pending hashes and rejects new ones with
+    ServiceBusy once max_pending is reached.
+    """
+
+    def __init__(self, max_pending=None, timeout=None):
+        self.max_pending = max_pending or settings.HASH_POOL_MAX_PENDING
+        self.timeout = timeout or settings.HASH_POOL_TIMEOUT
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._rejected = 0
+        self._count = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+        self._reporter_pid = None
+
+    def _start_reporter(self):
+        """
+        Log the metrics every HASH_METRICS_INTERVAL seconds in a daemon
+        thread of this process, again after a fork
+        """
+        interval = settings.HASH_METRICS_INTERVAL
+        with self._lock:
+            if interval is None or self._reporter_pid == os.getpid():
+                return
+            self._reporter_pid = os.getpid()
+        thread = threading.Thread(target=self._report_loop,
+                                  args=(interval,), name='hash-metrics',
+                                  daemon=True)
+        thread.start()
+
+    def _report_loop(self, interval):
+        while True:
+            sleep(interval)
+            self.log_metrics()
+
+    def log_metrics(self):
+        """
+        Log the metrics as one JSON line
+        :Returns:
+            dict logged
+        """
+        logInfo = OrderedDict()
+        logInfo['message'] = 'HASH_METRICS'
+        logInfo['pid'] = os.getpid()
+        logInfo.update(self.metrics())
+        logger.info(json.dumps(logInfo))
+        return logInfo
+
+    def _run(self, func, *args):
+        return func(*args)
+
+    def _submit(self, func, *args):
+        """
+        Admission control and metrics around _run
+        :Parameters:
+            func : (function) module level function to run
+            args : arguments of func
+        :Returns:
+            result of func
+        """
+        if self._reporter_pid != os.getpid():
+            self._start_reporter()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise ServiceBusy(ERR.SERVER_BUSY)
+        with self._lock:
+            self._pending += 1
+        start = monotonic()
+        try:
+            return self._run(func, *args)
+        finally:
+            elapsed = monotonic() - start
+            with self._lock:
+                self._pending -= 1
+                self._count += 1
+                self._total_time += elapsed
+                self._max_time = max(self._max_time, elapsed)
+            self._slots.release()
+
+    def make_password(self, raw_password):
+        return self._submit(_make_password, raw_password)
+
+    def check_password(self, raw_password, encoded, setter=None):
+        """
+        Same contract as django.contrib.auth.hashers.check_password
+        """
+        if raw_password is None or not hashers.is_password_usable(encoded):
+            return False
+        try:
+            must_update = _must_update(encoded)
+        except ValueError:
+            return False
+        is_correct = self._submit(_check_password, raw_password, encoded)
+        if setter and is_correct and must_update:
+            setter(raw_password)
+        return is_correct
+
+    def metrics(self):
+        """
+        Snapshot of the executor counters
+        :Returns:
+            dict
+        """
+        with self._lock:
+            metrics = OrderedDict()
+            metrics['queue_depth'] = self._pending
+            metrics['max_pending'] = self.max_pending
+            metrics['rejected'] = self._rejected
+            metrics['hashes'] = self._count
+            metrics['avg_latency_ms'] = (
+                self._total_time / self._count * 1000 if self._count else 0)
+            metrics['max_latency_ms'] = self._max_time * 1000
+        return metrics
+
+
+class InlineHashExecutor(HashExecutor):
+    """ Hashes on the request thread, with admission control only """
+    pass
+
+
+class ProcessPoolHashExecutor(HashExecutor):
+    """
+    Hashes in a dedicated pool of worker processes.
+    The pool is started on first use so management commands that never
+    hash do not fork.
+    """
+
+    def __init__(self, workers=None, **kwargs):
+        super().__init__(**kwargs)
+        self.workers = workers or settings.HASH_POOL_WORKERS
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                                    max_workers=self.workers)
+        return self._pool
+
+    def _run(self, func, *args):
+        future = self._get_pool().submit(func, *args)
+        return future.result(timeout=self.timeout)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+_executor = None
+
+
+def get_hash_executor():
+    """
+    Returns the configured executor, created once per process.
+    """
+    global _executor
+    if _executor is None:
+        _executor = import_string(settings.PASSWORD_HASH_EXECUTOR)()
+    return _executor
@@ -0,0 +1,78 @@
+"""
+Request scoped identity map of the users.
+The token decoders, serializers, views and CustomResponseLog ask it for
+the user of the request, so the row is fetched at most once per request
+and every one of them works on the same object.
+"""
+from django.contrib.auth import get_user_model
+
+
+class IdentityMap():
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_email = {}
+        self.user = None
+
+    def add(self, user):
+        """
+        Register a user loaded elsewhere, the first one added is the
+        user of the request
+        """
+        self._by_id[str(user.pk)] = user
+        self._by_email[user.email.lower()] = user
+        if self.user is None:
+            self.user = user
+        return user
+
+    def get(self, user_id):
+        """
+        :Parameters:
+            user_id : (str) or UUID
+        :Returns:
+            User object
+        :Raises:
+            User.DoesNotExist
+        """
+        user = self._by_id.get(str(user_id))
+        if user is None:
+            user = self.add(get_user_model().objects.get(pk=user_id))
+        return user
+
+    def get_by_email(self, email):
+        """
+        :Returns:
+            User object, None if the email is not registered
+        """
+        key = email.lower()
+        if key in self._by_email:
+            return self._by_email[key]
+        user = get_user_model().objects.filter(email=email).first()
+        if user is None:
+            # Remember the miss as well
+            self._by_email[key] = None
+            return None
+        return self.add(user)
+
+
+def identity_map(request):
+    """
+    Identity map of the request, made on first use.
+    Kept on the Django request so DRF's Request and the middlewares
+    share it.
+    """
+    request = getattr(request, '_request', request)
+    _map = getattr(request, '_identity_map', None)
+    if _map is None:
+        _map = request._identity_map = IdentityMap()
+    return _map
+
+
+def request_user(request):
+    """
+    :Returns:
+        User the request loaded, None if none was
+    """
+    request = getattr(request, '_request', request)
+    _map = getattr(request, '_identity_map', None)
+    return _map.user if _map is not None else None
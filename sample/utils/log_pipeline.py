@@ -0,0 +1,350 @@
+"""
+Ships the log events to logstash from a background thread.
+
+QueueLogstashHandler formats an event on the logging thread and puts it
+in a bounded in-memory queue, it never waits on the network. When the
+queue is full the event is dropped and counted. A shipper thread per
+process sends the queued events in batches over one TCP connection.
+
+Batches that cannot be sent (logstash slow, down or restarting) are
+appended to spill files in spill_dir and sent again, oldest first, once
+a batch goes through. Once the spill files of spill_dir reach
+spill_max_bytes in total, the events are counted as dropped.
+
+The counters of every process are written to spill_dir/<pid>.stats
+every stats_interval seconds, see `manage.py log_pipeline_stats`.
+
+Configured in sample/settings/site_logger.py. Django is not imported,
+the handler is made while the settings load.
+"""
+import os
+import glob
+import json
+import queue
+import socket
+import logging
+import threading
+from time import time, monotonic
+from uuid import uuid4
+from logstash import formatter
+
+COUNTERS = ('shipped', 'dropped', 'spilled', 'replayed', 'send_errors')
+
+
+class QueueLogstashHandler(logging.Handler):
+
+    def __init__(self, host, port=5959, message_type='logstash', tags=None,
+                 fqdn=False, version=0, max_queue=10000, batch_size=500,
+                 flush_interval=1.0, spill_dir=None,
+                 spill_max_bytes=100 * 1024 * 1024, timeout=5,
+                 stats_interval=10):
+        """
+        :Parameters:
+            host, port, message_type, tags, fqdn, version : as
+                logstash.TCPLogstashHandler
+            max_queue : (int) events waiting at most
+            batch_size : (int) events sent together
+            flush_interval : (float) seconds an event waits for its batch
+            spill_dir : (str) None to drop what cannot be sent
+            spill_max_bytes : (int) total size of the spill files of
+                spill_dir
+            timeout : (float) seconds of the connect and send
+            stats_interval : (float) seconds between the stats files
+        """
+        super().__init__()
+        self.host = host
+        self.port = port
+        if version == 1:
+            self.formatter = formatter.LogstashFormatterVersion1(
+                                message_type, tags, fqdn)
+        else:
+            self.formatter = formatter.LogstashFormatterVersion0(
+                                message_type, tags, fqdn)
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.timeout = timeout
+        self.stats_interval = stats_interval
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._sock = None
+        # Sink down until monotonic() passes it
+        self._retry_at = 0
+        self._retry_delay = 1
+
+    def _start(self):
+        """
+        Start the shipper of this process, again after a fork
+        """
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.max_queue)
+            self._sock = None
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._ship, name='log-shipper', daemon=True)
+            self._thread.start()
+
+    def _count(self, name, n=1):
+        # Counters are only read for the stats, a lost update is fine
+        self.counters[name] += n
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            event = self.formatter.format(record) + b'\n'
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('dropped')
+
+    def stats(self):
+        """
+        :Returns:
+            dict of the counters and the backlog of queued events
+        """
+        stats = dict(self.counters)
+        stats['backlog'] = self._queue.qsize() if self._queue else 0
+        stats['spill_bytes'] = self._spill_bytes()
+        return stats
+
+    # Shipper thread
+
+    def _next_batch(self):
+        batch = []
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, data):
+        """
+        :Returns:
+            bool True if sent
+        """
+        if monotonic() < self._retry_at:
+            return False
+        try:
+            if self._sock is None:
+                self._sock = socket.create_connection(
+                                (self.host, self.port), self.timeout)
+            self._sock.sendall(data)
+        except OSError:
+            self._count('send_errors')
+            self._close_socket()
+            # Back off up to 30 seconds while the sink is down
+            self._retry_at = monotonic() + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, 30)
+            return False
+        self._retry_delay = 1
+        return True
+
+    def _close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _spill_path(self):
+        return os.path.join(self.spill_dir, '%s.spill' % self._pid)
+
+    def _rest_path(self):
+        # Same length on every retry of the file
+        return os.path.join(self.spill_dir, '%s.%s.spill' % (
+                                self._pid, uuid4().hex[:8]))
+
+    def _spill_bytes(self):
+        if self.spill_dir is None:
+            return 0
+        total = 0
+        paths = (glob.glob(os.path.join(self.spill_dir, '*.spill'))
+                 + glob.glob(os.path.join(self.spill_dir, '*.replaying')))
+        for path in paths:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def _spill(self, batch):
+        if self.spill_dir is None:
+            self._count('dropped', len(batch))
+            return
+        path = self._spill_path()
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            if self._spill_bytes() >= self.spill_max_bytes:
+                self._count('dropped', len(batch))
+                return
+            with open(path, 'ab') as f:
+                f.write(b''.join(batch))
+            self._count('spilled', len(batch))
+        except OSError:
+            self._count('dropped', len(batch))
+
+    def _replay(self):
+        """
+        Send the spill files, of crashed processes too. A file is
+        claimed by renaming it, a failed one is put back.
+        :Returns:
+            bool True if nothing is left to replay
+        """
+        if self.spill_dir is None:
+            return True
+        if monotonic() < self._retry_at:
+            return False
+        paths = glob.glob(os.path.join(self.spill_dir, '*.spill'))
+        for path in sorted(paths, key=_mtime):
+            claimed = os.path.join(self.spill_dir, '%s.%s.replaying' % (
+                                       self._pid, uuid4().hex[:8]))
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                # Claimed by another process
+                continue
+            try:
+                sent = self._replay_file(claimed)
+            except Exception:
+                # Put the whole file back, events can be sent twice
+                # but are not lost
+                os.rename(claimed, self._rest_path())
+                raise
+            if not sent:
+                return False
+        return True
+
+    def _replay_file(self, claimed):
+        """
+        :Returns:
+            bool True if the whole file was sent, else the rest is put
+            back with the mtime of the file, so it stays first
+        """
+        with open(claimed, 'rb') as f:
+            lines = f.readlines()
+        for start in range(0, len(lines), self.batch_size):
+            chunk = lines[start:start + self.batch_size]
+            if not self._send(b''.join(chunk)):
+                rest = self._rest_path()
+                if start == 0:
+                    os.rename(claimed, rest)
+                    return False
+                stat = os.stat(claimed)
+                try:
+                    with open(rest, 'wb') as f:
+                        f.writelines(lines[start:])
+                    os.utime(rest, (stat.st_atime, stat.st_mtime))
+                except OSError:
+                    if os.path.exists(rest):
+                        os.remove(rest)
+                    raise
+                os.remove(claimed)
+                return False
+            self._count('replayed', len(chunk))
+        os.remove(claimed)
+        return True
+
+    def _write_stats(self):
+        if self.spill_dir is None:
+            return
+        stats = self.stats()
+        stats['pid'] = self._pid
+        stats['at'] = time()
+        path = os.path.join(self.spill_dir, '%s.stats' % self._pid)
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(stats, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+    def _ship(self):
+        spilled = self._spill_bytes() > 0
+        stats_at = 0
+        while True:
+            try:
+                batch = self._next_batch()
+                if batch:
+                    if spilled:
+                        # Older events first
+                        spilled = not self._replay()
+                    if spilled or not self._send(b''.join(batch)):
+                        self._spill(batch)
+                        spilled = self.spill_dir is not None
+                    else:
+                        self._count('shipped', len(batch))
+                elif spilled:
+                    spilled = not self._replay()
+                if monotonic() - stats_at >= self.stats_interval:
+                    self._write_stats()
+                    stats_at = monotonic()
+            except Exception:
+                # Logging here would queue more events, only count it
+                self._count('send_errors')
+            if self._stop.is_set() and self._queue.empty():
+                break
+        self._write_stats()
+        self._close_socket()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued events are sent or spilled
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        deadline = None if timeout is None else monotonic() + timeout
+        while not self._queue.empty():
+            if deadline is not None and monotonic() > deadline:
+                return
+            self._stop.wait(0.05)
+
+    def close(self):
+        """
+        Called by logging.shutdown at exit, the queued events are sent
+        or spilled within the timeout
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._thread.join(self.timeout)
+        super().close()
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def read_stats(spill_dir):
+    """
+    :Returns:
+        list of the stats dicts of the processes, newest first
+    """
+    stats = []
+    for path in glob.glob(os.path.join(spill_dir, '*.stats')):
+        try:
+            with open(path) as f:
+                stats.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(stats, key=lambda item: item['at'], reverse=True)
@@ -0,0 +1,204 @@
+"""
+Sampling and roll-ups of the success logs.
+
+CustomResponseLog only logs a success when sampled() picks it, at the
+rate of the view in SUCCESS_LOG_SAMPLE_RATES or SUCCESS_LOG_SAMPLE_RATE.
+Sampled lines carry their sample_rate when it is below 1. The error
+logs of utils.exception_handler are never sampled.
+
+LogRollupMiddleware counts every request per view in the aggregator of
+the process, which logs one roll-up line per view every
+SUCCESS_LOG_ROLLUP_INTERVAL seconds: requests, errors (status >= 400)
+and latency percentiles in milliseconds.
+"""
+import os
+import random
+import atexit
+import logging
+import threading
+from time import sleep, monotonic
+from datetime import datetime
+from collections import OrderedDict
+import simplejson as json
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Latencies kept per view and window, a uniform sample past it
+MAX_SAMPLES = 1000
+
+
+def sample_rate(app_name):
+    """
+    :Returns:
+        float share of the successes of the view that are logged
+    """
+    return settings.SUCCESS_LOG_SAMPLE_RATES.get(
+                app_name, settings.SUCCESS_LOG_SAMPLE_RATE)
+
+
+def sampled(app_name):
+    """
+    :Returns:
+        rate : (float) of the view
+        keep : (bool) True if this success is logged
+    """
+    rate = sample_rate(app_name)
+    return rate, rate >= 1 or random.random() < rate
+
+
+class _Window():
+    __slots__ = ('requests', 'errors', 'latencies')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, latency, error):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        if len(self.latencies) < MAX_SAMPLES:
+            self.latencies.append(latency)
+        else:
+            # Reservoir sampling keeps every request equally likely
+            i = random.randrange(self.requests)
+            if i < MAX_SAMPLES:
+                self.latencies[i] = latency
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class RollupLog():
+    """
+    Roll-up line of a view, formatted like SuccessLog
+    """
+    __slots__ = ('time', 'app_name', 'window', 'seconds', '_json')
+
+    def __init__(self, app_name, window, seconds):
+        self.time = datetime.now()
+        self.app_name = app_name
+        self.window = window
+        self.seconds = seconds
+        self._json = None
+
+    def as_dict(self):
+        latencies = sorted(self.window.latencies)
+        logInfo = OrderedDict()
+        logInfo['timestamp'] = self.time.strftime("%Y-%m-%d %H:%M:%S")
+        logInfo['message'] = 'ROLLUP'
+        logInfo['app_name'] = self.app_name
+        logInfo['seconds'] = round(self.seconds, 1)
+        logInfo['requests'] = self.window.requests
+        logInfo['errors'] = self.window.errors
+        for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            logInfo[name] = round(_percentile(latencies, p), 1)
+        return logInfo
+
+    def __str__(self):
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
+
+
+class Aggregator():
+
+    def __init__(self, interval):
+        """
+        :Parameters:
+            interval : (float) seconds between the roll-ups
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._started = monotonic()
+        self._pid = None
+
+    def _start(self):
+        """
+        Start the roll-up thread of this process, again after a fork
+        """
+        self._pid = os.getpid()
+        self._windows = {}
+        thread = threading.Thread(target=self._loop, name='log-rollup',
+                                  daemon=True)
+        thread.start()
+
+    def add(self, app_name, latency, error):
+        """
+        :Parameters:
+            app_name : (str) view class name
+            latency : (float) milliseconds
+            error : (bool)
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            window = self._windows.get(app_name)
+            if window is None:
+                window = self._windows[app_name] = _Window()
+            window.add(latency, error)
+
+    def flush(self):
+        """
+        Log the roll-ups of the views and start a new window
+        :Returns:
+            list of RollupLog
+        """
+        with self._lock:
+            windows, self._windows = self._windows, {}
+            now = monotonic()
+            seconds, self._started = now - self._started, now
+        rollups = [RollupLog(app_name, window, seconds)
+                   for app_name, window in sorted(windows.items())]
+        for rollup in rollups:
+            logger.info(rollup)
+        return rollups
+
+    def _loop(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+
+_aggregator = None
+
+
+def get_aggregator():
+    """
+    Returns the aggregator, created once per process. None if the
+    roll-ups are off.
+    """
+    global _aggregator
+    if _aggregator is None and settings.SUCCESS_LOG_ROLLUP_INTERVAL:
+        _aggregator = Aggregator(settings.SUCCESS_LOG_ROLLUP_INTERVAL)
+        atexit.register(_aggregator.flush)
+    return _aggregator
+
+
+class LogRollupMiddleware():
+    """
+    Counts the requests of the views in the aggregator
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = monotonic()
+        response = self.get_response(request)
+        aggregator = get_aggregator()
+        view_class = getattr(request, '_rollup_view', None)
+        if aggregator is not None and view_class is not None:
+            aggregator.add(view_class, (monotonic() - started) * 1000,
+                           response.status_code >= 400)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        request._rollup_view = (view_class.__name__ if view_class
+                                else view_func.__name__)
+        return None
@@ -0,0 +1,150 @@
+"""
+Pool of open EMAIL_BACKEND connections of the worker process.
+Emails are sent in batches through send_messages over a connection
+kept open between batches, so a burst of registrations pays the
+connect, TLS and login cost once per connection instead of per email.
+
+A connection is reopened once it was idle EMAIL_POOL_MAX_IDLE seconds
+(servers drop idle clients) or sent EMAIL_POOL_MAX_MESSAGES emails.
+A batch that fails is sent again one email at a time over a new
+connection, so a dropped connection is reconnected and a bad email
+only fails itself. Emails of that batch sent before the failure can be
+sent twice, delivery is at least once.
+"""
+import logging
+import threading
+from time import monotonic
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class _Connection():
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.sent = 0
+        self.used_at = monotonic()
+
+
+class MailConnectionPool():
+
+    def __init__(self, size, batch_size, max_idle=None, max_messages=None,
+                 **backend_kwargs):
+        """
+        :Parameters:
+            size : (int) connections open at most
+            batch_size : (int) emails per send_messages call
+            max_idle : (float) seconds a connection is reused after
+                its last email, None to reuse it until it fails
+            max_messages : (int) emails per connection, None for no limit
+            backend_kwargs : passed to django.core.mail.get_connection,
+                e.g. backend, host, port
+        """
+        self.batch_size = batch_size
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self.backend_kwargs = backend_kwargs
+        self.connects = 0
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _expired(self, conn):
+        return ((self.max_idle is not None
+                 and monotonic() - conn.used_at > self.max_idle)
+                or (self.max_messages is not None
+                    and conn.sent >= self.max_messages))
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is not None and self._expired(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                backend = get_connection(fail_silently=False,
+                                         **self.backend_kwargs)
+                backend.open()
+                conn = _Connection(backend)
+                with self._lock:
+                    self.connects += 1
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn):
+        conn.used_at = monotonic()
+        with self._lock:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def _discard(self, conn):
+        try:
+            conn.backend.close()
+        except Exception:
+            # The connection is gone already
+            pass
+
+    def _send(self, messages):
+        conn = self._acquire()
+        try:
+            conn.backend.send_messages(messages)
+        except Exception:
+            self._discard(conn)
+            self._slots.release()
+            raise
+        conn.sent += len(messages)
+        self._release(conn)
+
+    def send(self, messages):
+        """
+        :Parameters:
+            messages : (list) of EmailMessage
+        :Returns:
+            list of the exception of every email, None if it was sent
+        """
+        errors = [None] * len(messages)
+        for start in range(0, len(messages), self.batch_size):
+            batch = messages[start:start + self.batch_size]
+            try:
+                self._send(batch)
+                continue
+            except Exception as e:
+                logger.warning('Batch of %d emails failed, sending them'
+                               ' one by one: %s', len(batch), e)
+            for i, message in enumerate(batch, start):
+                try:
+                    self._send([message])
+                except Exception as e:
+                    errors[i] = e
+        return errors
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+_pool = None
+
+
+def get_mail_pool():
+    """
+    Returns the mail connection pool, created once per process.
+    """
+    global _pool
+    if _pool is None:
+        _pool = MailConnectionPool(settings.EMAIL_POOL_SIZE,
+                                   settings.EMAIL_POOL_BATCH_SIZE,
+                                   settings.EMAIL_POOL_MAX_IDLE,
+                                   settings.EMAIL_POOL_MAX_MESSAGES)
+    return _pool
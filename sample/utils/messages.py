@@ -23,10 +23,13 @@ class ERR():
     ACTIVATION_INVALID = 'Activation link is invalid. Please try again or contact support.'
     ACTIVATION_EXPIRED = 'Link has already expired. Please request again for a new activation link.'
     LINK_USED = 'Link has been used already. Please request again for another.'
+    TOKEN_INVALID = 'Token is invalid or expired.'
     # ROLES
     ROLE_INVALID = 'Role does not exists. Please contact support.'
     # SERVER RELATED
     SERVER_ERROR = 'Server error. Please try again or contact support.'
+    SERVER_BUSY = 'Server is busy. Please try again later.'
+    TOO_MANY_REQUESTS = 'Too many requests. Please try again later.'
 
 
 class SCS():
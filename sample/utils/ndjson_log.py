@@ -0,0 +1,328 @@
+"""
+Append-only NDJSON log files, one JSON object per line.
+
+NDJSONFileHandler adds the line of an event to an in-memory buffer, a
+writer thread per process appends the buffer to the segment of the
+process in one write once it holds buffer_bytes or every
+flush_interval seconds. Nothing on the logging thread touches the file.
+
+Every process writes its own segment <prefix>-<start>-<pid>.ndjson.part,
+so the processes never rotate a file under each other. The writer
+thread rotates it once it is max_bytes large or max_age seconds old:
+the segment is renamed to .ndjson, compressed to .ndjson.gz if
+compress is on, and the oldest rotated segments over backup_count are
+deleted. Segments left by crashed processes are rotated on start, also
+when their pid was reused (e.g. by a restarted container): a segment of
+this pid started before the handler, or one older than twice max_age,
+is not written anymore.
+
+Lines carry the time, level and logger of the event. Messages with an
+as_dict() method (utils.res_handler.SuccessLog) add their fields, any
+other message is kept as "message". See read_segments and
+`manage.py read_logs`.
+
+Configured in sample/settings/site_logger.py. Django is not imported,
+the handler is made while the settings load.
+"""
+import os
+import glob
+import gzip
+import json
+import shutil
+import logging
+import threading
+from time import time, mktime, strftime, strptime, localtime
+
+FLUSH_MAX_BYTES = 1024 * 1024
+
+
+def _segment_info(path, prefix):
+    """
+    :Returns:
+        started : (float) epoch seconds the segment was opened
+        pid : (int) of its writer
+    :Raises:
+        ValueError if the name is not of a segment
+    """
+    name = os.path.basename(path)[len(prefix) + 1:-len('.ndjson.part')]
+    started, pid = name.rsplit('-', 1)
+    seconds, millis = started.split('.')
+    return (mktime(strptime(seconds, '%Y%m%dT%H%M%S')) + int(millis) / 1000,
+            int(pid))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class NDJSONFileHandler(logging.Handler):
+
+    def __init__(self, directory, prefix='server', max_bytes=64 * 1024 * 1024,
+                 max_age=3600, backup_count=48, compress=True,
+                 buffer_bytes=256 * 1024, flush_interval=1.0):
+        """
+        :Parameters:
+            directory : (str) of the segments
+            prefix : (str) of the segment files
+            max_bytes : (int) segment size that rotates it
+            max_age : (float) seconds a segment is written at most,
+                None for size only
+            backup_count : (int) rotated segments kept
+            compress : (bool) gzip the rotated segments
+            buffer_bytes : (int) buffered bytes that wake the writer
+            flush_interval : (float) seconds a line waits at most
+        """
+        super().__init__()
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.compress = compress
+        self.buffer_bytes = buffer_bytes
+        self.flush_interval = flush_interval
+        self._pid = None
+        self._lines = []
+        self._buffered = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._fd = None
+        self._path = None
+        self._size = 0
+        self._opened_at = 0
+        self._created = time()
+
+    def _start(self):
+        """
+        Start the writer of this process, again after a fork
+        """
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._lines = []
+            self._buffered = 0
+            self._fd = None
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._write_loop, name='ndjson-writer', daemon=True)
+            self._thread.start()
+
+    def format(self, record):
+        line = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        as_dict = getattr(record.msg, 'as_dict', None)
+        if as_dict is not None and not record.args:
+            line.update(as_dict())
+        else:
+            line['message'] = record.getMessage()
+        if record.exc_info:
+            line['exc_info'] = logging.Formatter().formatException(
+                                record.exc_info)
+        return json.dumps(line, default=str) + '\n'
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            line = self.format(record).encode()
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lock:
+            self._lines.append(line)
+            self._buffered += len(line)
+            full = self._buffered >= self.buffer_bytes
+        if full:
+            self._wake.set()
+
+    # Writer thread
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._opened_at = time()
+        # Milliseconds so a segment rotated within a second is not
+        # overwritten
+        started = '%s.%03d' % (
+            strftime('%Y%m%dT%H%M%S', localtime(self._opened_at)),
+            self._opened_at * 1000 % 1000)
+        self._path = os.path.join(
+            self.directory,
+            '%s-%s-%s.ndjson.part' % (self.prefix, started, self._pid))
+        self._fd = os.open(self._path,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        self._size = 0
+
+    def _rotate(self):
+        os.close(self._fd)
+        self._fd = None
+        self._finish_segment(self._path)
+        self._prune()
+
+    def _finish_segment(self, path):
+        rotated = path[:-len('.part')]
+        os.rename(path, rotated)
+        if self.compress:
+            with open(rotated, 'rb') as src, \
+                    gzip.open(rotated + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+
+    def _prune(self):
+        if self.backup_count is None:
+            return
+        pattern = os.path.join(self.directory, '%s-*.ndjson' % self.prefix)
+        rotated = sorted(glob.glob(pattern) + glob.glob(pattern + '.gz'),
+                         key=os.path.basename)
+        for path in rotated[:-self.backup_count or None]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _recover(self):
+        """
+        Rotate the segments of processes that are gone
+        """
+        pattern = os.path.join(
+                    self.directory, '%s-*.ndjson.part' % self.prefix)
+        for path in glob.glob(pattern):
+            if path == self._path:
+                continue
+            try:
+                started, pid = _segment_info(path, self.prefix)
+            except ValueError:
+                continue
+            if pid == self._pid:
+                # Same pid, a previous run if opened before this handler
+                stale = started < self._created
+            else:
+                stale = not _pid_alive(pid)
+            if (not stale and self.max_age is not None
+                    and time() - started > 2 * self.max_age):
+                # A live writer rotates it after max_age, the pid was
+                # reused by another process
+                stale = True
+            if stale:
+                try:
+                    self._finish_segment(path)
+                except OSError:
+                    continue
+
+    def _write(self):
+        with self.lock:
+            lines, self._lines = self._lines, []
+            self._buffered = 0
+        if not lines:
+            return
+        if self._fd is None:
+            self._open()
+        # Large writes, bounded so memory stays flat
+        for start in range(0, len(lines), 1024):
+            data = b''.join(lines[start:start + 1024])
+            while data:
+                written = os.write(self._fd, data[:FLUSH_MAX_BYTES])
+                data = data[written:]
+                self._size += written
+
+    def _due(self):
+        return (self._fd is not None
+                and (self._size >= self.max_bytes
+                     or (self.max_age is not None
+                         and time() - self._opened_at >= self.max_age)))
+
+    def _write_loop(self):
+        try:
+            self._recover()
+        except OSError:
+            pass
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            stopping = self._stop.is_set()
+            try:
+                self._write()
+                if self._due():
+                    self._rotate()
+            except Exception:
+                # The lines are lost, logging here would loop
+                pass
+            if stopping:
+                break
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def flush(self):
+        """
+        Wake the writer, the lines are written within flush_interval
+        """
+        self._wake.set()
+
+    def close(self):
+        """
+        Called by logging.shutdown at exit, the buffered lines are
+        written
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(5)
+        super().close()
+
+
+def segments(directory, prefix='server'):
+    """
+    :Returns:
+        list of the segment paths, oldest first, the written ones last
+    """
+    pattern = os.path.join(directory, '%s-*.ndjson' % prefix)
+    paths = (glob.glob(pattern) + glob.glob(pattern + '.gz')
+             + glob.glob(pattern + '.part'))
+    return sorted(paths, key=os.path.basename)
+
+
+def read_segments(paths, **filters):
+    """
+    Stream the lines of the segments, one at a time
+    :Parameters:
+        paths : (list) segment paths
+        filters : field=value the lines must have, e.g. email='a@b.com'
+    :Returns:
+        generator of dict
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for text in f:
+                try:
+                    line = json.loads(text)
+                except ValueError:
+                    # Last line of a crashed process
+                    continue
+                if _matches(line, filters):
+                    yield line
+
+
+def _matches(line, filters):
+    if not filters:
+        return True
+    fields = line
+    if 'message' in line and isinstance(line['message'], str) \
+            and line['message'].startswith('{'):
+        # Lines of the JSON string messages, e.g. custom_errlog
+        try:
+            fields = dict(line, **json.loads(line['message']))
+        except (ValueError, TypeError):
+            pass
+    return all(fields.get(key) == value for key, value in filters.items())
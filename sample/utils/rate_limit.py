@@ -0,0 +1,209 @@
+"""
+Token bucket rate limiting for the unauthenticated endpoints.
+Runs as a middleware in process_view, so limited requests are
+rejected before DRF parses the body or runs the serializers.
+
+Policies are set per url name in settings.RATE_LIMITS, e.g.
+
+    'users-api:login': {
+        'rate': 10,        # tokens added per period
+        'period': 60,      # seconds
+        'burst': 10,       # bucket size
+        'keys': ('ip', 'email'),
+    }
+
+Every worker keeps its own buckets, updated without locks. Every
+RATE_LIMIT_SYNC_INTERVAL seconds a bucket pushes what it consumed to
+the shared cache (RATE_LIMIT_CACHE) and takes off what the other
+workers consumed, so the limit holds across processes.
+"""
+import json
+from time import time
+from datetime import datetime
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from utils.client_ip import client_ip
+from utils.messages import ERR
+
+
+class Bucket():
+    __slots__ = ('tokens', 'stamp', 'window', 'seen', 'pending', 'synced')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.stamp = now
+        self.window = None
+        self.seen = 0
+        self.pending = 0
+        self.synced = now
+
+
+class RateLimiter():
+
+    def __init__(self, cache_alias=None, sync_interval=None,
+                 max_buckets=None):
+        self.cache_alias = cache_alias or settings.RATE_LIMIT_CACHE
+        self.sync_interval = (sync_interval if sync_interval is not None
+                              else settings.RATE_LIMIT_SYNC_INTERVAL)
+        self.max_buckets = max_buckets or settings.RATE_LIMIT_MAX_BUCKETS
+        # Least recently used first
+        self.buckets = OrderedDict()
+
+    def _sweep(self, now):
+        """
+        Drop the buckets that refilled completely and have nothing
+        left to sync, they are the same as a new bucket.
+        """
+        for name, (bucket, policy) in list(self.buckets.items()):
+            refill = policy['burst'] * policy['period'] / policy['rate']
+            if not bucket.pending and now - bucket.stamp >= refill:
+                self.buckets.pop(name, None)
+
+    def _sync(self, name, bucket, policy, now):
+        """
+        Push the local consumption to the shared counter of the
+        current period, and remove the tokens other workers used.
+        """
+        cache = caches[self.cache_alias]
+        window = int(now // policy['period'])
+        if window != bucket.window:
+            bucket.window = window
+            bucket.seen = 0
+        key = 'ratelimit:%s:%s' % (name, window)
+        cache.add(key, 0, policy['period'] * 2)
+        try:
+            total = cache.incr(key, bucket.pending)
+        except ValueError:
+            # Expired between add and incr
+            cache.set(key, bucket.pending, policy['period'] * 2)
+            total = bucket.pending
+        others = total - bucket.seen - bucket.pending
+        bucket.tokens -= max(others, 0)
+        bucket.seen = total
+        bucket.pending = 0
+        bucket.synced = now
+
+    def _bucket(self, name, policy, now):
+        entry = self.buckets.get(name)
+        if entry is not None:
+            self.buckets.move_to_end(name)
+            return entry[0]
+        if len(self.buckets) >= self.max_buckets:
+            self._sweep(now)
+            while len(self.buckets) >= self.max_buckets:
+                # Still full, e.g. a flood of random emails. The
+                # pending tokens of the oldest bucket are not synced.
+                self.buckets.popitem(last=False)
+        bucket = Bucket(policy['burst'], now)
+        self.buckets[name] = (bucket, policy)
+        return bucket
+
+    def consume_all(self, names, policy, now=None):
+        """
+        Take one token from each bucket of names, or from none of
+        them if one is empty
+        :Parameters:
+            names : (list) policy and client keys
+            policy : (dict)
+        :Returns:
+            float seconds to wait, 0 if the request is allowed
+        """
+        now = now or time()
+        rate = policy['rate'] / policy['period']
+        buckets = []
+        wait = 0
+        for name in names:
+            bucket = self._bucket(name, policy, now)
+            bucket.tokens = min(
+                policy['burst'], bucket.tokens + (now - bucket.stamp) * rate)
+            bucket.stamp = now
+            if now - bucket.synced >= self.sync_interval:
+                self._sync(name, bucket, policy, now)
+            if bucket.tokens < 1:
+                wait = max(wait, (1 - bucket.tokens) / rate)
+            buckets.append(bucket)
+        if wait:
+            return wait
+        for bucket in buckets:
+            bucket.tokens -= 1
+            bucket.pending += 1
+        return 0
+
+    def consume(self, name, policy, now=None):
+        """
+        Take one token from the bucket of name
+        :Returns:
+            float seconds to wait, 0 if the request is allowed
+        """
+        return self.consume_all([name], policy, now)
+
+    def reset(self):
+        self.buckets.clear()
+
+
+limiter = RateLimiter()
+
+
+def _submitted_email(request):
+    """
+    Email from the JSON or form body, without DRF parsing
+    """
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+    else:
+        data = request.POST
+    email = data.get('email')
+    if not isinstance(email, str) or not email:
+        return None
+    return email.strip().lower()
+
+
+def _limited_response(request, view_func, wait):
+    """
+    Same format as utils.exception_handler error responses
+    """
+    view_class = getattr(view_func, 'view_class', view_func)
+    data = OrderedDict()
+    data['errors'] = ERR.TOO_MANY_REQUESTS
+    data['path'] = view_class.__name__
+    data['time'] = datetime.now()
+    data['status'] = 429
+    data['message'] = 'Throttled'
+    response = JsonResponse(data, status=429)
+    response['Retry-After'] = str(int(wait) + 1)
+    return response
+
+
+class RateLimitMiddleware():
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        policy = settings.RATE_LIMITS.get(request.resolver_match.view_name)
+        if policy is None or request.method != 'POST':
+            return None
+        values = {}
+        if 'ip' in policy['keys']:
+            values['ip'] = client_ip(request)
+        if 'email' in policy['keys']:
+            values['email'] = _submitted_email(request)
+        names = [
+            '%s:%s:%s' % (request.resolver_match.view_name, key, value)
+            for key, value in values.items() if value
+        ]
+        # A request rejected on one key spends no token of the others
+        wait = limiter.consume_all(names, policy)
+        if wait:
+            return _limited_response(request, view_func, wait)
+        return None
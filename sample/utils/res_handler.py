@@ -7,15 +7,53 @@ import simplejson as json
 from collections import OrderedDict
 from datetime import datetime
 from .client_ip import client_ip
+from .identity_map import request_user
+from .log_sampling import sampled
 
 logger = logging.getLogger(__name__)
 
 
+class SuccessLog():
+    """
+    Log line of a successful request. Passed to the logger as the
+    message, the JSON is only made when a handler formats it.
+    """
+    __slots__ = ('time', 'email', 'ip', 'app_name', 'sample_rate', '_json')
+
+    def __init__(self, email, ip, app_name, sample_rate=1):
+        self.time = datetime.now()
+        self.email = email
+        self.ip = ip
+        self.app_name = app_name
+        self.sample_rate = sample_rate
+        self._json = None
+
+    def as_dict(self):
+        logInfo = OrderedDict()
+        logInfo['timestamp'] = self.time.strftime("%Y-%m-%d %H:%M:%S")
+        logInfo['email'] = self.email
+        logInfo['ip'] = self.ip
+        logInfo['message'] = 'OK'
+        logInfo['success'] = True
+        logInfo['app_name'] = self.app_name
+        if self.sample_rate < 1:
+            # One line stands for 1 / sample_rate successes
+            logInfo['sample_rate'] = self.sample_rate
+        return logInfo
+
+    def __str__(self):
+        # Formatted once for all the handlers
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
+
+
 class CustomResponseLog():
     """
     Single entry point of response back to the web/api
     Will log selected values before returning the response
     """
+    __slots__ = ('app_name', 'request', 'params', 'email')
 
     def __init__(self, app_name=None, request=None,
                 params={}, email=None):
@@ -24,7 +62,7 @@ class CustomResponseLog():
             app_name: (str) class name
             request: (obj) request object
             params: (dict) dictionary of additional info
-        
+
         :Returns:
             dict
         """
@@ -32,41 +70,33 @@ class CustomResponseLog():
         self.request = request
         self.params = params
         self.email = email
-        self.logInfo = OrderedDict()
+
+    def _log_email(self):
+        if str(self.request.user) != 'AnonymousUser':
+            return self.request.user.email
+        # This is for the scenario of email was provided but it
+        # was a JSON payload. Mostly will be used by the reset-
+        # password API.
+        if 'email' in self.request.data:
+            return self.request.data['email']
+        if self.email:
+            return self.email
+        user = request_user(self.request)
+        # User the request already loaded
+        return user.email if user is not None else ''
 
     def custom_response(self):
-        self.logInfo['timestamp'] = datetime.now().strftime(
-                "%Y-%m-%d %H:%M:%S")
-        if hasattr(self, 'request') and self.request:
-            if str(self.request.user) != 'AnonymousUser':
-                self.logInfo['email'] = self.request.user.email
-            else:
-                # This is for the scenario of email was provided but it
-                # was a JSON payload. Mostly will be used by the reset-
-                # password API.
-                if 'email' in self.request.data:
-                    self.logInfo['email'] = self.request.data['email']
-                elif self.email:
-                    self.logInfo['email'] = self.email
-                else:
-                    self.logInfo['email'] = ''
-            self.logInfo['ip'] = client_ip(self.request)
-        else:
-            self.logInfo['email'] = ''
-            self.logInfo['ip'] = ''
-        self.logInfo['message'] = 'OK'
-        self.logInfo['success'] = True
-        self.logInfo['app_name'] = self.app_name
-        log_data = json.dumps(self.logInfo)
-        logger.info(log_data)
-        # Delete keys which are not to be shown in response
-        del self.logInfo['timestamp']
-        del self.logInfo['email']
-        del self.logInfo['ip']
-        del self.logInfo['app_name']
+        rate, keep = sampled(self.app_name)
+        if keep and self.request:
+            logger.info(SuccessLog(self._log_email(),
+                                   client_ip(self.request),
+                                   self.app_name, rate))
+        elif keep:
+            logger.info(SuccessLog('', '', self.app_name, rate))
+        response = OrderedDict()
+        response['message'] = 'OK'
+        response['success'] = True
         if len(self.params) != 0:
-            self.logInfo['data'] = self.params
-        return json.loads(
-                json.dumps(self.logInfo),
-                object_pairs_hook=OrderedDict
-        )
+            # Callers build params per request, it is not copied
+            response['data'] = self.params
+        return response